@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+"""
+HTTP load generator for comparing the WSGI and ASGI deployments.
+
+Usage:
+  python loadtest.py --url http://127.0.0.1:8000 --email bob@jyomail --password secret \
+      --path / --path /email/1/ --concurrency 32 --duration 20
+
+Run it once against the WSGI server (sync views), e.g.
+  python manage.py runserver --noreload
+and once against uvicorn (async views), e.g.
+  uvicorn postguard.asgi:application --workers 1
+then compare requests/sec and latency percentiles. Only the standard
+library is used, so it can run from any machine.
+"""
+import argparse
+import http.client
+import http.cookies
+import statistics
+import threading
+import time
+import urllib.parse
+
+
+def login(base, email, password):
+    """Log in through the normal form and return the session Cookie header."""
+    url = urllib.parse.urlsplit(base)
+    conn = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=30)
+    conn.request("GET", "/login/")
+    response = conn.getresponse()
+    response.read()
+    cookies = http.cookies.SimpleCookie(response.getheader("Set-Cookie", ""))
+    csrf = cookies["csrftoken"].value
+
+    form = urllib.parse.urlencode({"username": email, "password": password, "csrfmiddlewaretoken": csrf})
+    conn.request("POST", "/login/", body=form, headers={
+        "Content-Type": "application/x-www-form-urlencoded",
+        "Cookie": f"csrftoken={csrf}",
+        "Referer": base,
+    })
+    response = conn.getresponse()
+    response.read()
+    cookies.load(response.getheader("Set-Cookie", ""))
+    if "sessionid" not in cookies:
+        raise SystemExit(f"Login failed for {email} (HTTP {response.status})")
+    conn.close()
+    return f"csrftoken={csrf}; sessionid={cookies['sessionid'].value}"
+
+
+def worker(base, cookie, paths, deadline, latencies, errors):
+    url = urllib.parse.urlsplit(base)
+    conn = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=60)
+    i = 0
+    while time.perf_counter() < deadline:
+        path = paths[i % len(paths)]
+        i += 1
+        start = time.perf_counter()
+        try:
+            conn.request("GET", path, headers={"Cookie": cookie})
+            response = conn.getresponse()
+            response.read()
+            if response.status != 200:
+                errors.append(response.status)
+                continue
+        except (OSError, http.client.HTTPException) as e:
+            errors.append(type(e).__name__)
+            conn.close()
+            conn = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=60)
+            continue
+        latencies.append((time.perf_counter() - start) * 1000)
+    conn.close()
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--email", required=True)
+    parser.add_argument("--password", required=True)
+    parser.add_argument("--path", action="append", dest="paths", help="Path to request (repeatable).")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds to run.")
+    args = parser.parse_args()
+
+    cookie = login(args.url, args.email, args.password)
+    paths = args.paths or ["/"]
+    latencies, errors = [], []
+    deadline = time.perf_counter() + args.duration
+    threads = [
+        threading.Thread(target=worker, args=(args.url, cookie, paths, deadline, latencies, errors))
+        for _ in range(args.concurrency)
+    ]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    if not latencies:
+        raise SystemExit(f"No successful requests ({len(errors)} errors: {errors[:5]})")
+    print(f"requests: {len(latencies)}  errors: {len(errors)}  elapsed: {elapsed:.1f}s")
+    print(f"throughput: {len(latencies) / elapsed:.1f} req/s")
+    print(f"latency ms: p50={statistics.median(latencies):.1f}  p99={percentile(latencies, 99):.1f}  "
+          f"max={max(latencies):.1f}")
+
+
+if __name__ == "__main__":
+    main()
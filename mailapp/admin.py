@@ -1,7 +1,14 @@
 from django.contrib import admin
-from .models import Email
+from .models import Delivery, Email
 
 @admin.register(Email)
 class EmailAdmin(admin.ModelAdmin):
     list_display = ("subject", "sender", "recipients", "is_read", "timestamp")
     search_fields = ("subject", "sender", "recipients", "body")
+
+
+@admin.register(Delivery)
+class DeliveryAdmin(admin.ModelAdmin):
+    list_display = ("email", "user", "folder", "is_read", "timestamp")
+    list_filter = ("folder", "is_read")
+    raw_id_fields = ("email", "user")
@@ -3,3 +3,7 @@ from django.apps import AppConfig
 class MailappConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "mailapp"
+
+    def ready(self):
+        # Connects the per-request query counter before any connection opens
+        from . import metrics  # noqa: F401
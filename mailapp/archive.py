@@ -0,0 +1,332 @@
+"""
+Retention and archival of old mail into compressed, append-only segments.
+
+Each user's mail older than their archive_after_days (or ARCHIVE_AFTER_DAYS)
+is moved out of the hot tables. The user's copy of each message (headers,
+stored body, read state) is written to one of their segment files under
+ARCHIVE_ROOT, packed into zlib-compressed blocks of about ARCHIVE_BLOCK_SIZE.
+Writing a batch means appending blocks, fsyncing, then committing, in one
+transaction:
+
+- the batch's ArchivedMessage index rows (segment, block offset and length,
+  position in the block);
+- the deletion of its deliveries, and of the emails nobody else still has.
+
+Segment files are only appended to (compaction writes a new one). Bytes
+past a segment's committed size, left by a crash, are overwritten by the
+next append.
+
+An archived message is read by decompressing its one block. The detail and
+attachment views fall back to the archive, so links keep working, and mbox
+exports include it. Archived mail leaves the folder listings, counts,
+threads and search, so the hot tables stay the size of the archive window.
+Archiving is off unless ARCHIVE_AFTER_DAYS (or the user's setting) is set.
+
+Mail older than delete_after_days (or DELETE_AFTER_DAYS) is deleted, hot or
+archived. A segment is removed once all its messages are; one that still
+holds kept messages is rewritten without the deleted ones (compact_segment),
+so deleted mail does not linger on disk. Segments fill oldest mail first, so
+mostly whole segments expire and little is rewritten.
+
+Run one archiver at a time (manage.py archive_mail).
+"""
+import functools
+import itertools
+import json
+import logging
+import os
+import struct
+import time
+import zlib
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .attachments import prune_blobs
+from .models import (
+    ArchivedAttachment, ArchivedMessage, ArchiveSegment, Attachment, CustomUser, Delivery, Email,
+)
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 500
+# Record framing: lengths of the JSON header and of the binary body
+_RECORD_HEADER = struct.Struct(">II")
+
+
+def archive_root():
+    return Path(getattr(settings, "ARCHIVE_ROOT", settings.BASE_DIR / "archive"))
+
+
+def segment_path(segment):
+    return archive_root() / str(segment.user_id) / f"{segment.pk:08d}.seg"
+
+
+def _policy(user, field, setting):
+    # The user's own setting wins; 0 (or None in settings) turns it off
+    days = getattr(user, field)
+    if days is None:
+        days = getattr(settings, setting, None)
+    return timezone.now() - timedelta(days=days) if days else None
+
+
+def archive_cutoff(user):
+    """Mail older than this is archived; None if the user keeps everything hot."""
+    return _policy(user, "archive_after_days", "ARCHIVE_AFTER_DAYS")
+
+
+def delete_cutoff(user):
+    """Mail older than this is deleted; None if the user keeps mail forever."""
+    return _policy(user, "delete_after_days", "DELETE_AFTER_DAYS")
+
+
+def _encode(delivery):
+    email = delivery.email
+    header = json.dumps({
+        "id": email.id,
+        "sender": email.sender,
+        "recipients": email.recipients,
+        "subject": email.subject,
+        "body": email.body,
+        "timestamp": email.timestamp.isoformat(),
+        "is_encrypted": email.is_encrypted,
+        "message_id": email.message_id,
+        "in_reply_to": email.in_reply_to,
+        "references": email.references,
+        "folder": delivery.folder,
+        "is_read": delivery.is_read,
+    }).encode()
+    blob = bytes(email.body_blob) if email.body_blob is not None else b""
+    return _RECORD_HEADER.pack(len(header), len(blob)) + header + blob
+
+
+def _raw_record(block, position):
+    # The encoded record at `position` in a decompressed block
+    offset = 0
+    for _ in range(position + 1):
+        start = offset
+        header_size, blob_size = _RECORD_HEADER.unpack_from(block, offset)
+        offset += _RECORD_HEADER.size + header_size + blob_size
+    return block[start:offset]
+
+
+def _to_email(raw):
+    header_size, blob_size = _RECORD_HEADER.unpack_from(raw)
+    record = json.loads(raw[_RECORD_HEADER.size:_RECORD_HEADER.size + header_size])
+    blob = raw[_RECORD_HEADER.size + header_size:]
+    return Email(
+        id=record["id"], sender=record["sender"], recipients=record["recipients"], subject=record["subject"],
+        body=record["body"], body_blob=blob or None, timestamp=datetime.fromisoformat(record["timestamp"]),
+        is_read=record["is_read"], is_encrypted=record["is_encrypted"], message_id=record["message_id"],
+        in_reply_to=record["in_reply_to"], references=record["references"],
+    )
+
+
+def _read_block(path, offset, length):
+    with open(path, "rb") as fh:
+        fh.seek(offset)
+        return zlib.decompress(fh.read(length))
+
+
+def _blocks(records):
+    # Group encoded records into blocks of about ARCHIVE_BLOCK_SIZE bytes
+    block_size = getattr(settings, "ARCHIVE_BLOCK_SIZE", 64 * 1024)
+    block, size = [], 0
+    for record in records:
+        if block and size + len(record) > block_size:
+            yield block
+            block, size = [], 0
+        block.append(record)
+        size += len(record)
+    if block:
+        yield block
+
+
+def _open_segment(user):
+    limit = getattr(settings, "ARCHIVE_SEGMENT_SIZE", 64 * 1024 * 1024)
+    segment = ArchiveSegment.objects.filter(user=user, size__lt=limit).order_by("-id").first()
+    return segment or ArchiveSegment.objects.create(user=user)
+
+
+def _append(segment, records):
+    """Write records to the end of a segment; returns [(offset, length, count)] per block and the new size."""
+    path = segment_path(segment)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    blocks = []
+    with open(path, "r+b" if path.exists() else "wb") as fh:
+        fh.seek(segment.size)
+        fh.truncate()
+        for block in _blocks(records):
+            data = zlib.compress(b"".join(block))
+            blocks.append((fh.tell(), len(data), len(block)))
+            fh.write(data)
+        fh.flush()
+        os.fsync(fh.fileno())
+        return blocks, fh.tell()
+
+
+def delete_orphan_emails(email_ids):
+    """Delete the emails (and their attachments and keys) no delivery refers to any more."""
+    return Email.objects.filter(id__in=email_ids, deliveries__isnull=True).delete()[0]
+
+
+def _archive_batch(user, deliveries):
+    attachments = {}
+    for attachment in Attachment.objects.filter(email_id__in={d.email_id for d in deliveries}):
+        attachments.setdefault(attachment.email_id, []).append(attachment)
+
+    segment = _open_segment(user)
+    blocks, size = _append(segment, [_encode(delivery) for delivery in deliveries])
+    entries = []
+    remaining = iter(deliveries)
+    for offset, length, count in blocks:
+        for position in range(count):
+            delivery = next(remaining)
+            entries.append(ArchivedMessage(
+                user=user, email_id=delivery.email_id, folder=delivery.folder, timestamp=delivery.timestamp,
+                segment=segment, offset=offset, length=length, position=position,
+            ))
+
+    with transaction.atomic():
+        ArchivedMessage.objects.bulk_create(entries)
+        ArchivedAttachment.objects.bulk_create([
+            ArchivedAttachment(message=entry, attachment_id=attachment.id, blob_id=attachment.blob_id,
+                               filename=attachment.filename, content_type=attachment.content_type,
+                               key=attachment.key)
+            for entry in entries for attachment in attachments.get(entry.email_id, ())
+        ])
+        Delivery.objects.filter(id__in=[delivery.id for delivery in deliveries]).delete()
+        delete_orphan_emails({delivery.email_id for delivery in deliveries})
+        ArchiveSegment.objects.filter(pk=segment.pk).update(size=size)
+
+
+def archive_user(user, before, batch_size=BATCH_SIZE):
+    """Move the user's mail older than `before` to their archive; returns the number of messages."""
+    archived = 0
+    for folder in (Delivery.INBOX, Delivery.SENT):
+        # Oldest first, from the (user, folder, timestamp) index
+        old = Delivery.objects.filter(user=user, folder=folder, timestamp__lt=before).order_by("timestamp", "id")
+        while batch := list(old.select_related("email")[:batch_size]):
+            _archive_batch(user, batch)
+            archived += len(batch)
+    return archived
+
+
+def purge_user(user, before):
+    """Delete the user's mail older than `before`, hot and archived; returns the number of messages."""
+    deleted = 0
+    for folder in (Delivery.INBOX, Delivery.SENT):
+        old = Delivery.objects.filter(user=user, folder=folder, timestamp__lt=before)
+        while ids := list(old.values_list("id", "email_id")[:BATCH_SIZE]):
+            with transaction.atomic():
+                Delivery.objects.filter(id__in=[delivery_id for delivery_id, _ in ids]).delete()
+                delete_orphan_emails({email_id for _, email_id in ids})
+            deleted += len(ids)
+    expired = ArchivedMessage.objects.filter(user=user, timestamp__lt=before)
+    touched = set(expired.values_list("segment_id", flat=True).distinct())
+    with transaction.atomic():
+        _, counts = expired.delete()
+        deleted += counts.get(ArchivedMessage._meta.label, 0)
+        empty = list(ArchiveSegment.objects.filter(user=user, messages__isnull=True))
+        ArchiveSegment.objects.filter(pk__in=[segment.pk for segment in empty]).delete()
+    for segment in empty:
+        segment_path(segment).unlink(missing_ok=True)
+    # The deleted messages' bytes are still in the segments they shared with
+    # kept ones; rewrite those so deleted mail leaves the disk too
+    for segment in ArchiveSegment.objects.filter(pk__in=touched):
+        compact_segment(segment)
+    return deleted
+
+
+def compact_segment(segment):
+    """
+    Copy a segment's remaining messages to a new segment and remove the old
+    one. The copy is fsynced before the index rows move to it, so a crash
+    leaves either segment intact (and the unused one to remove_stray_segments).
+    """
+    entries = list(segment.messages.order_by("offset", "position"))
+    path = segment_path(segment)
+    records = []
+    for (offset, length), group in itertools.groupby(entries, key=lambda entry: (entry.offset, entry.length)):
+        block = _read_block(path, offset, length)
+        records.extend(_raw_record(block, entry.position) for entry in group)
+
+    new = ArchiveSegment.objects.create(user_id=segment.user_id)
+    blocks, size = _append(new, records)
+    remaining = iter(entries)
+    for offset, length, count in blocks:
+        for position in range(count):
+            entry = next(remaining)
+            entry.segment, entry.offset, entry.length, entry.position = new, offset, length, position
+    with transaction.atomic():
+        ArchivedMessage.objects.bulk_update(entries, ["segment", "offset", "length", "position"])
+        ArchiveSegment.objects.filter(pk=new.pk).update(size=size)
+        segment.delete()
+    path.unlink(missing_ok=True)
+    return new
+
+
+def run(users=None, batch_size=BATCH_SIZE):
+    """
+    Apply every user's retention policy: archive, then delete expired mail,
+    then remove attachment blobs and segment files nothing refers to.
+    Returns (archived, deleted).
+    """
+    archived = deleted = 0
+    for user in users if users is not None else CustomUser.objects.order_by("id"):
+        cutoff = archive_cutoff(user)
+        if cutoff is not None and (count := archive_user(user, cutoff, batch_size)):
+            logger.info("Archived %d messages of %s", count, user.email)
+            archived += count
+        cutoff = delete_cutoff(user)
+        if cutoff is not None and (count := purge_user(user, cutoff)):
+            logger.info("Deleted %d expired messages of %s", count, user.email)
+            deleted += count
+    prune_blobs()
+    remove_stray_segments()
+    return archived, deleted
+
+
+def read_archived(user, email_id):
+    """
+    The user's archived copy of an email as (unsaved Email with the user's
+    read state, its ArchivedAttachments), or None if the user has none.
+    """
+    entry = ArchivedMessage.objects.select_related("segment").filter(user=user, email_id=email_id).first()
+    if entry is None:
+        return None
+    block = _read_block(segment_path(entry.segment), entry.offset, entry.length)
+    return _to_email(_raw_record(block, entry.position)), list(entry.attachments.select_related("blob"))
+
+
+def iter_archived(user, folder=None, chunk_size=BATCH_SIZE):
+    """
+    The user's archived messages (one folder, or all) as (ArchivedMessage,
+    unsaved Email), oldest first. Recently read blocks are kept decompressed,
+    so a block is normally inflated once however many of its messages follow.
+    """
+    entries = ArchivedMessage.objects.filter(user=user).select_related("segment").order_by("timestamp", "id")
+    if folder:
+        entries = entries.filter(folder=folder)
+    read_block = functools.lru_cache(maxsize=16)(_read_block)
+    for entry in entries.iterator(chunk_size=chunk_size):
+        block = read_block(segment_path(entry.segment), entry.offset, entry.length)
+        yield entry, _to_email(_raw_record(block, entry.position))
+
+
+def remove_stray_segments(grace=3600):
+    """Delete segment files without a segment row (e.g. of deleted users), untouched for `grace` seconds."""
+    root = archive_root()
+    if not root.exists():
+        return 0
+    cutoff = time.time() - grace
+    known = {segment_path(segment) for segment in ArchiveSegment.objects.only("id", "user_id")}
+    removed = 0
+    for path in root.glob("*/*.seg"):
+        if path not in known and path.stat().st_mtime < cutoff:
+            path.unlink(missing_ok=True)
+            removed += 1
+    return removed
@@ -0,0 +1,202 @@
+"""
+Async versions of the mailbox views, served when ASYNC_VIEWS is enabled
+(the default under postguard.asgi).
+
+Queries use Django's async ORM. PGP work (and the sync code paths that wrap
+it) runs on a bounded thread pool so a slow decrypt never blocks the event
+loop and concurrent crypto is capped at CRYPTO_THREADS.
+
+events_view streams new-mail headers as Server-Sent Events; it only exists
+under ASGI, where an idle stream is just a suspended coroutine.
+"""
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.decorators import login_required
+from django.core.exceptions import PermissionDenied
+from django.db import connections
+from django.http import Http404, JsonResponse, StreamingHttpResponse
+from django.shortcuts import redirect, render
+
+from .forms import ComposeForm
+from .attachments import attachment_key, attachment_response
+from .mail_utils import read_email_body
+from .events import broker, sse_message
+from .mailbox import (
+    INBOX, SENT, InvalidCursor, afolder_counts, amark_read, apaginate, mailbox_queryset,
+)
+from .archive import read_archived
+from .models import ArchivedAttachment, Attachment, Delivery, Email, Thread
+from .threads import thread_deliveries, thread_queryset
+from .views import _email_context, reply_initial, send_compose_form
+
+_crypto_executor = ThreadPoolExecutor(
+    max_workers=getattr(settings, "CRYPTO_THREADS", 4),
+    thread_name_prefix="crypto",
+)
+
+# Template rendering may touch request.user lazily, which is sync-only
+arender = sync_to_async(render)
+
+
+async def run_crypto(func, *args):
+    """Run a blocking (crypto-bound) call on the bounded crypto executor."""
+    # In the request's context, so its queries are counted (metrics.py)
+    call = functools.partial(contextvars.copy_context().run, func, *args)
+    return await asyncio.get_running_loop().run_in_executor(_crypto_executor, call)
+
+
+async def _mailbox_page(request, folder, template):
+    user = await request.auser()
+    try:
+        page, next_cursor = await apaginate(mailbox_queryset(user, folder), request.GET.get("cursor"))
+    except InvalidCursor:
+        return redirect(folder)
+    return await arender(request, template, {
+        "inbox": page,
+        "next_cursor": next_cursor,
+        "counts": await afolder_counts(user, folder),
+    })
+
+
+@login_required
+async def inbox_view(request):
+    return await _mailbox_page(request, INBOX, "inbox.html")
+
+
+@login_required
+async def sent_view(request):
+    return await _mailbox_page(request, SENT, "sent.html")
+
+
+@login_required
+async def threads_view(request):
+    user = await request.auser()
+    try:
+        page, next_cursor = await apaginate(thread_queryset(user), request.GET.get("cursor"), field="last_activity")
+    except InvalidCursor:
+        return redirect("threads")
+    return await arender(request, "threads.html", {"threads": page, "next_cursor": next_cursor})
+
+
+@login_required
+async def thread_view(request, thread_id):
+    user = await request.auser()
+    try:
+        thread = await Thread.objects.aget(id=thread_id, user=user)
+    except Thread.DoesNotExist:
+        raise Http404("No Thread matches the given query.")
+    return await arender(request, "thread.html", {
+        "thread": thread,
+        "deliveries": [delivery async for delivery in thread_deliveries(user, thread)],
+    })
+
+
+@login_required
+async def email_detail_view(request, email_id):
+    user = await request.auser()
+    # Only the sender and recipients of an email have a delivery for it
+    email = await Email.objects.filter(deliveries__user=user).distinct().filter(id=email_id).afirst()
+    if email is None:
+        archived = await run_crypto(read_archived, user, email_id)
+        if archived is None:
+            raise Http404("No Email matches the given query.")
+        email, attachments = archived
+        body = await run_crypto(functools.partial(read_email_body, archived=True), email, user, request.session)
+        return await arender(request, "email_detail.html", _email_context(email, body, attachments, archived=True))
+    if request.method == "POST":
+        is_read = request.POST.get("action") != "unread"
+        await amark_read(user, email.id, is_read)
+        return redirect("email_detail", email_id=email.id) if is_read else redirect("inbox")
+    await amark_read(user, email.id)
+    body = await run_crypto(read_email_body, email, user, request.session)
+    attachments = [attachment async for attachment in email.attachments.select_related("blob")]
+    return await arender(request, "email_detail.html", _email_context(email, body, attachments))
+
+
+async def attachment_view(request, attachment_id):
+    user = await request.auser()
+    if not user.is_authenticated:
+        return redirect("login")
+    attachments = Attachment.objects.select_related("blob").filter(email__deliveries__user=user).distinct()
+    attachment = await attachments.filter(id=attachment_id).afirst()
+    if attachment is None:
+        archived = ArchivedAttachment.objects.select_related("blob").filter(message__user=user)
+        attachment = await archived.filter(attachment_id=attachment_id).afirst()
+    if attachment is None:
+        raise Http404("No Attachment matches the given query.")
+    key = await run_crypto(attachment_key, attachment, user)
+    if key is None:
+        raise PermissionDenied("This attachment cannot be decrypted with your key.")
+    # Streamed from an async iterator: Django buffers sync ones under ASGI
+    return attachment_response(attachment, key, request.headers.get("Range"), asynchronous=True)
+
+
+@login_required
+async def compose_email_view(request):
+    context = {}
+    if request.method == "POST":
+        # Parsing the multipart body spools uploads to disk: off the loop
+        files = await sync_to_async(lambda: request.FILES)()
+        form = ComposeForm(request.POST, files)
+        if form.is_valid():
+            if not await run_crypto(send_compose_form, await request.auser(), form):
+                return await arender(request, "compose.html", {"form": form})
+            context["success"] = "Email sent successfully!"
+            form = ComposeForm()
+    else:
+        reply_to = request.GET.get("reply_to", "")
+        initial = None
+        if reply_to.isdigit():
+            initial = await sync_to_async(reply_initial)(await request.auser(), reply_to)
+        form = ComposeForm(initial=initial)
+
+    context["form"] = form
+    return await arender(request, "compose.html", context)
+
+
+# Seconds between keep-alive comments on idle event streams, and the most
+# missed deliveries replayed when a client reconnects with Last-Event-ID
+SSE_KEEPALIVE = getattr(settings, "SSE_KEEPALIVE", 25)
+SSE_REPLAY_LIMIT = 100
+
+
+async def _event_stream(user, last_event_id):
+    queue = broker.subscribe(user.pk)
+    try:
+        yield "retry: 5000\n\n"
+        if last_event_id is not None:
+            # Catch up on anything stored while disconnected (or by another process)
+            missed = Delivery.objects.headers().filter(user=user, id__gt=last_event_id).order_by("id")
+            async for delivery in missed[:SSE_REPLAY_LIMIT]:
+                yield sse_message(delivery)
+        # Nothing below touches the database: don't hold a connection for
+        # the life of an idle stream
+        await sync_to_async(connections.close_all)()
+        while True:
+            try:
+                message = await asyncio.wait_for(queue.get(), SSE_KEEPALIVE)
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+                continue
+            yield message
+    finally:
+        broker.unsubscribe(user.pk, queue)
+
+
+async def events_view(request):
+    user = await request.auser()
+    if not user.is_authenticated:
+        return JsonResponse({"error": "Authentication required."}, status=401)
+    try:
+        last_event_id = int(request.headers["Last-Event-ID"])
+    except (KeyError, ValueError):
+        last_event_id = None
+    response = StreamingHttpResponse(_event_stream(user, last_event_id), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"  # stop reverse proxies from buffering the stream
+    return response
@@ -0,0 +1,230 @@
+"""
+Encrypted, deduplicated attachment storage with ranged, streaming reads.
+
+Django spools uploads to disk, and from there each file is hashed and then
+encrypted in CHUNK_SIZE pieces with AES-GCM, so no step holds a whole file in
+memory. The key and the blob id are HMACs (keyed with SECRET_KEY) of the
+content hash: the same file always encrypts to the same blob and is stored
+once, at ATTACHMENT_ROOT/ab/cd/<id>, however many messages carry it.
+
+Chunk i is sealed with nonce i and authenticated together with its index and
+whether it is the last chunk, so chunks cannot be reordered or dropped, and
+any byte range is decrypted by reading only the chunks it covers. Each
+Attachment keeps the blob key as a PGP message encrypted to the email's
+readers, like the body.
+"""
+import hashlib
+import os
+import re
+import struct
+import tempfile
+import time
+from pathlib import Path
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.crypto import salted_hmac
+from django.utils.http import content_disposition_header
+
+from .crypto import aead, decrypt_message, encrypt_message
+from .keycache import private_key_for
+from .models import Attachment, AttachmentBlob
+
+CHUNK_SIZE = 64 * 1024
+TAG_SIZE = 16
+
+_RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def storage_root():
+    return Path(getattr(settings, "ATTACHMENT_ROOT", settings.BASE_DIR / "attachments"))
+
+
+def blob_path(blob_id):
+    return storage_root() / blob_id[:2] / blob_id[2:4] / blob_id
+
+
+def chunk_count(size, chunk_size=CHUNK_SIZE):
+    # An empty file is still one (empty) final chunk
+    return max(1, -(-size // chunk_size))
+
+
+def _nonce(index):
+    return index.to_bytes(12, "big")
+
+
+def _aad(index, last):
+    return struct.pack(">Q?", index, last)
+
+
+def _read_chunks(fh):
+    fh.seek(0)
+    while chunk := fh.read(CHUNK_SIZE):
+        yield chunk
+
+
+def store_blob(upload):
+    """
+    Encrypt an uploaded file into content-addressed storage, unless the same
+    content is already there. Returns (unsaved AttachmentBlob, AES key).
+    """
+    sha256 = hashlib.sha256()
+    for chunk in _read_chunks(upload):
+        sha256.update(chunk)
+    digest = sha256.digest()
+    blob_id = salted_hmac("mailapp.attachments.id", digest, algorithm="sha256").hexdigest()
+    key = salted_hmac("mailapp.attachments.key", digest, algorithm="sha256").digest()
+
+    path = blob_path(blob_id)
+    if path.exists():
+        os.utime(path)  # in use again: keep prune_blobs() off it
+    else:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        gcm = aead(key)
+        last = chunk_count(upload.size) - 1
+        upload.seek(0)
+        with tempfile.NamedTemporaryFile(dir=path.parent, delete=False) as out:
+            try:
+                for index in range(last + 1):
+                    out.write(gcm.encrypt(_nonce(index), upload.read(CHUNK_SIZE), _aad(index, index == last)))
+            except BaseException:
+                os.unlink(out.name)
+                raise
+        os.replace(out.name, path)
+    return AttachmentBlob(id=blob_id, size=upload.size, chunk_size=CHUNK_SIZE), key
+
+
+def prepare_attachment(upload, reader_keys):
+    """
+    Store an uploaded file and return an unsaved Attachment (email not yet
+    set) whose key is encrypted to `reader_keys`, parsed public keys.
+    """
+    blob, key = store_blob(upload)
+    return Attachment(
+        blob=blob,
+        filename=os.path.basename(upload.name)[:255],
+        content_type=(upload.content_type or "application/octet-stream")[:100],
+        key=encrypt_message(key.hex(), reader_keys, binary=True),
+    )
+
+
+def attachment_key(attachment, user):
+    """The attachment's AES key, decrypted with user's private key, or None."""
+    body, error = decrypt_message(bytes(attachment.key), private_key_for(user))
+    return None if error else bytes.fromhex(body)
+
+
+def parse_range(header, size):
+    """
+    The inclusive (start, end) of a single "bytes=" Range header, or None to
+    send the whole file (no header, or one this parser ignores, such as
+    multiple ranges). Raises ValueError if the range is unsatisfiable.
+    """
+    match = _RANGE_RE.match(header or "")
+    if not match or match.groups() == ("", ""):
+        return None
+    first, last = match.groups()
+    if first == "":
+        # Suffix range: the last N bytes
+        if int(last) == 0 or size == 0:
+            raise ValueError("unsatisfiable range")
+        return max(0, size - int(last)), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if last and int(last) < start:
+        return None
+    if start >= size:
+        raise ValueError("unsatisfiable range")
+    return start, end
+
+
+def _unseal(fh, key, size, chunk_size, first_index, last_index):
+    # Decrypt chunks first_index..last_index, read in order from fh
+    gcm = aead(key)
+    last = chunk_count(size, chunk_size) - 1
+    for index in range(first_index, last_index + 1):
+        yield gcm.decrypt(_nonce(index), fh.read(chunk_size + TAG_SIZE), _aad(index, index == last))
+
+
+def unseal(fh, key, size, chunk_size=CHUNK_SIZE):
+    """Yield the decrypted chunks of a whole blob read from `fh`, such as one carried in an mbox export."""
+    return _unseal(fh, key, size, chunk_size, 0, chunk_count(size, chunk_size) - 1)
+
+
+def iter_plaintext(blob, key, start, end):
+    """Yield the decrypted bytes start..end (inclusive) of a blob, one chunk at a time."""
+    first_index = start // blob.chunk_size
+    with open(blob_path(blob.id), "rb") as fh:
+        fh.seek(first_index * (blob.chunk_size + TAG_SIZE))
+        chunks = _unseal(fh, key, blob.size, blob.chunk_size, first_index, end // blob.chunk_size)
+        for index, chunk in enumerate(chunks, first_index):
+            offset = index * blob.chunk_size
+            yield chunk[max(start - offset, 0):end - offset + 1]
+
+
+async def aiter_plaintext(blob, key, start, end):
+    # Under ASGI Django would buffer a sync iterator into a list, so
+    # decrypt each chunk in a worker thread and stream it from here
+    chunks = iter_plaintext(blob, key, start, end)
+    read = sync_to_async(next, thread_sensitive=False)
+    try:
+        while (chunk := await read(chunks, None)) is not None:
+            yield chunk
+    finally:
+        chunks.close()
+
+
+def attachment_response(attachment, key, range_header, asynchronous=False):
+    """A streaming (206 for a Range request) download of the decrypted attachment."""
+    blob = attachment.blob
+    try:
+        byte_range = parse_range(range_header, blob.size)
+    except ValueError:
+        response = HttpResponse(status=416)
+        response["Content-Range"] = f"bytes */{blob.size}"
+        return response
+    start, end = byte_range or (0, blob.size - 1)
+    stream = aiter_plaintext if asynchronous else iter_plaintext
+    response = StreamingHttpResponse(
+        stream(blob, key, start, end),
+        content_type=attachment.content_type,
+        status=206 if byte_range else 200,
+    )
+    response["Content-Length"] = end - start + 1
+    response["Accept-Ranges"] = "bytes"
+    if byte_range:
+        response["Content-Range"] = f"bytes {start}-{end}/{blob.size}"
+    response["Content-Disposition"] = content_disposition_header(True, attachment.filename)
+    return response
+
+
+def prune_blobs(grace=3600):
+    """
+    Delete blobs no attachment (hot or archived) refers to any more, and
+    stray files (e.g. from interrupted uploads), once untouched for `grace`
+    seconds.
+    Returns (blobs, files) deleted.
+    """
+    cutoff = time.time() - grace
+    blobs = 0
+    unreferenced = AttachmentBlob.objects.filter(attachments__isnull=True, archived_attachments__isnull=True)
+    for blob in unreferenced.iterator():
+        path = blob_path(blob.id)
+        if path.exists() and path.stat().st_mtime > cutoff:
+            continue
+        # Only if still unreferenced: a send may have reused it meanwhile
+        deleted, _ = unreferenced.filter(pk=blob.pk).delete()
+        if deleted:
+            path.unlink(missing_ok=True)
+            blobs += 1
+
+    files = 0
+    root = storage_root()
+    if root.exists():
+        known = set(AttachmentBlob.objects.values_list("id", flat=True))
+        for path in root.glob("*/*/*"):
+            if path.name not in known and path.stat().st_mtime < cutoff:
+                path.unlink(missing_ok=True)
+                files += 1
+    return blobs, files
@@ -0,0 +1,10 @@
+from django.utils.functional import SimpleLazyObject
+
+from .mailbox import all_folder_counts
+
+
+def folder_counts(request):
+    """Per-folder counts for the sidebar, queried only if a template uses them."""
+    if not request.user.is_authenticated:
+        return {}
+    return {"folder_counts": SimpleLazyObject(lambda: all_folder_counts(request.user))}
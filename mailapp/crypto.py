@@ -0,0 +1,174 @@
+"""
+PGP primitives that do not depend on Django.
+
+Kept free of model imports so functions here can run inside worker
+processes that never call django.setup().
+
+The OpenPGP work is done by a backend module, named by the
+JYOMAIL_CRYPTO_BACKEND environment variable (default mailapp.pgpy_backend)
+and only imported when a key or message is first handled, so commands that
+never touch one skip loading it. Keys are the backend's own objects; the
+rest of the app only hands them back. A backend module provides:
+
+    new_key()                        bare key, no user id
+    add_user_id(key, email)          the key, with email bound
+    load_key(armored)                parsed key
+    armor_keypair(key)               (armored public key, armored private key)
+    prepare_private_key(key)         the key, made ready for repeated use
+    encrypt(body, public_keys, binary)
+    decrypt(ciphertext, private_key)                     body
+    decrypt_and_key(ciphertext, private_key)             body, (cipher, session_key)
+    decrypt_with_session_key(ciphertext, cipher, session_key)   body
+    to_binary(armored) / to_armored(binary)
+
+where cipher is an OpenPGP symmetric algorithm id. The decrypt functions
+raise on failure; the wrappers here turn that into a DecryptResult.
+
+aead() is the AES-GCM used for JyoMail's own symmetric encryption
+(attachments, recorded message keys, the preview cache), loaded lazily too.
+"""
+import functools
+import importlib
+import os
+from collections import namedtuple
+
+DEFAULT_BACKEND = "mailapp.pgpy_backend"
+
+# Outcome of decrypting one message in a batch: exactly one field is set
+DecryptResult = namedtuple("DecryptResult", ["body", "error"])
+
+_backend = None
+
+
+def backend():
+    """The crypto backend module, imported on first use."""
+    global _backend
+    if _backend is None:
+        _backend = importlib.import_module(os.environ.get("JYOMAIL_CRYPTO_BACKEND", DEFAULT_BACKEND))
+    return _backend
+
+
+def aead(key):
+    """AES-GCM (cryptography's AESGCM) under a 128, 192 or 256-bit key; cryptography is imported on first use."""
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    return AESGCM(key)
+
+
+def new_key():
+    """Generate a bare primary key with no user id attached."""
+    return backend().new_key()
+
+
+def add_user_id(key, email):
+    """Bind `email` to `key` with the preferences JyoMail advertises."""
+    return backend().add_user_id(key, email)
+
+
+def generate_armored_key():
+    """Generate a bare key and return it ASCII-armored (process-pool entry point)."""
+    return armor_keypair(new_key())[1]
+
+
+def load_key(armored):
+    """Parse an armored public or private key."""
+    return backend().load_key(armored)
+
+
+def armor_keypair(key):
+    """(armored public key, armored private key) of a parsed private key."""
+    return backend().armor_keypair(key)
+
+
+def prepare_private_key(key):
+    """Ready a parsed private key that is kept around (caches, pool workers) for repeated use, in place."""
+    return backend().prepare_private_key(key)
+
+
+@functools.lru_cache(maxsize=256)
+def parse_key(armored):
+    """Parse an armored key, memoised per process (used by pool workers)."""
+    return load_key(armored)
+
+
+def encrypt_message(body, public_keys, binary=False):
+    """
+    Compress and encrypt body once under a fresh session key, then wrap that
+    session key for each public key. The result is a single PGP message any
+    of the key holders can decrypt: armored text, or the raw packets as
+    bytes when `binary` is set.
+    """
+    return backend().encrypt(body, public_keys, binary)
+
+
+def encrypt_for_armored_keys(body, armored_public_keys, binary=False):
+    """encrypt_message() for armored keys (process-pool entry point)."""
+    return encrypt_message(body, [parse_key(armored) for armored in armored_public_keys], binary)
+
+
+def to_binary(ciphertext):
+    """Strip the ASCII armor from a PGP message; bytes pass through."""
+    if isinstance(ciphertext, (bytes, bytearray, memoryview)):
+        return bytes(ciphertext)
+    return backend().to_binary(ciphertext)
+
+
+def to_armored(ciphertext):
+    """ASCII-armor a binary PGP message; armored text passes through."""
+    if isinstance(ciphertext, str):
+        return ciphertext
+    return backend().to_armored(bytes(ciphertext))
+
+
+def decrypt(ciphertext, private_key):
+    """Decrypt one message, armored (str) or binary (bytes); raises if it cannot."""
+    return backend().decrypt(ciphertext, private_key)
+
+
+def decrypt_message(ciphertext, private_key):
+    """
+    Decrypt one message, armored (str) or binary (bytes), returning a
+    DecryptResult instead of raising.
+    """
+    try:
+        return DecryptResult(decrypt(ciphertext, private_key), None)
+    except Exception as e:
+        return DecryptResult(None, str(e) or type(e).__name__)
+
+
+def decrypt_message_and_key(ciphertext, private_key):
+    """
+    decrypt_message() that also returns the recovered session key, so later
+    reads can skip the RSA step: (DecryptResult, (cipher, session_key) or None).
+    """
+    try:
+        body, session_key = backend().decrypt_and_key(ciphertext, private_key)
+        return DecryptResult(body, None), session_key
+    except Exception as e:
+        return DecryptResult(None, str(e) or type(e).__name__), None
+
+
+def decrypt_with_session_key(ciphertext, cipher, session_key):
+    """Decrypt one message with a previously recovered session key (AES only)."""
+    try:
+        return DecryptResult(backend().decrypt_with_session_key(ciphertext, cipher, session_key), None)
+    except Exception as e:
+        return DecryptResult(None, str(e) or type(e).__name__)
+
+
+_worker_key = None
+
+
+def init_decrypt_worker(armored_private_key):
+    """Process-pool initializer: parse the private key once per worker."""
+    global _worker_key
+    _worker_key = prepare_private_key(load_key(armored_private_key))
+
+
+def decrypt_with_worker_key(ciphertext):
+    """decrypt_message() using the key loaded by init_decrypt_worker (process-pool entry point)."""
+    return decrypt_message(ciphertext, _worker_key)
+
+
+def decrypt_and_key_with_worker_key(ciphertext):
+    """decrypt_message_and_key() using the key loaded by init_decrypt_worker (process-pool entry point)."""
+    return decrypt_message_and_key(ciphertext, _worker_key)
@@ -0,0 +1,154 @@
+"""
+In-process publish/subscribe for new-mail notifications.
+
+Each open Server-Sent Events stream (async_views.events_view) subscribes a
+small bounded asyncio.Queue for its user. Senders publish delivery headers,
+already formatted as SSE messages, after their transaction commits, from
+any thread; events are handed to each
+subscriber's event loop with call_soon_threadsafe, so an idle stream costs
+one queue and one suspended coroutine, with no thread or polling.
+
+Publishing only reaches subscribers in the same process. Mail stored by
+other processes (the SMTP listener, import_mailbox, another ASGI worker) is
+found by a poller, one per event loop with open streams. Every
+SSE_POLL_INTERVAL seconds it fetches the deliveries above the last id it
+saw, for the users with streams, in one query. Each delivery is published
+once, whichever way it is found first.
+"""
+import asyncio
+import json
+import logging
+import threading
+from collections import OrderedDict, defaultdict
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max
+
+from .mailbox import delivery_json
+from .models import Delivery, DeliveryQuerySet
+
+logger = logging.getLogger(__name__)
+
+QUEUE_SIZE = 100
+# Delivery ids remembered as published, so the poller does not repeat them
+PUBLISHED_SIZE = 10000
+
+
+class Broker:
+    def __init__(self, poll_interval=0):
+        self._subscribers = defaultdict(set)  # user_id -> {(loop, queue)}
+        self._lock = threading.Lock()
+        self._published = OrderedDict()
+        self._pollers = {}  # loop -> task
+        self.poll_interval = poll_interval
+
+    def subscribe(self, user_id):
+        """Register a queue for user_id on the running loop and return it."""
+        loop = asyncio.get_running_loop()
+        subscriber = (loop, asyncio.Queue(maxsize=QUEUE_SIZE))
+        with self._lock:
+            self._subscribers[user_id].add(subscriber)
+        if self.poll_interval and loop not in self._pollers:
+            self._pollers[loop] = loop.create_task(self._poll(loop))
+        return subscriber[1]
+
+    def unsubscribe(self, user_id, queue):
+        with self._lock:
+            subscribers = self._subscribers.get(user_id, set())
+            subscribers.difference_update({s for s in subscribers if s[1] is queue})
+            if not subscribers:
+                self._subscribers.pop(user_id, None)
+
+    def publish(self, user_id, event, delivery_id=None):
+        """
+        Deliver event to every stream of user_id; safe to call from any
+        thread. An event for a delivery_id already published is dropped.
+        """
+        with self._lock:
+            if delivery_id is not None:
+                if delivery_id in self._published:
+                    return
+                self._published[delivery_id] = None
+                if len(self._published) > PUBLISHED_SIZE:
+                    self._published.popitem(last=False)
+            subscribers = list(self._subscribers.get(user_id, ()))
+        for loop, queue in subscribers:
+            loop.call_soon_threadsafe(_offer, queue, event)
+
+    def has_subscribers(self):
+        return bool(self._subscribers)
+
+    def connections(self):
+        with self._lock:
+            return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+    def _user_ids(self, loop):
+        with self._lock:
+            return [
+                user_id for user_id, subscribers in self._subscribers.items()
+                if any(subscriber[0] is loop for subscriber in subscribers)
+            ]
+
+    async def _poll(self, loop):
+        try:
+            last_id = await sync_to_async(_latest_delivery_id)()
+            while user_ids := self._user_ids(loop):
+                await asyncio.sleep(self.poll_interval)
+                try:
+                    deliveries, last_id = await sync_to_async(_deliveries_after)(last_id, user_ids)
+                except Exception:
+                    # e.g. the database is locked: try again next time
+                    logger.exception("Polling for new deliveries failed")
+                    continue
+                for delivery in deliveries:
+                    self.publish(delivery.user_id, sse_message(delivery), delivery.id)
+        finally:
+            self._pollers.pop(loop, None)
+
+
+def _offer(queue, event):
+    try:
+        queue.put_nowait(event)
+    except asyncio.QueueFull:
+        pass  # a stalled client misses events; it catches up on reconnect
+
+
+def _latest_delivery_id():
+    return Delivery.objects.aggregate(latest=Max("id"))["latest"] or 0
+
+
+def _deliveries_after(last_id, user_ids):
+    # The new high-water mark is read first, so a delivery committed between
+    # the two queries is left for the next poll rather than skipped
+    latest = Delivery.objects.filter(id__gt=last_id).aggregate(latest=Max("id"))["latest"]
+    if latest is None:
+        return [], last_id
+    deliveries = (
+        Delivery.objects.select_related("email").only(*DeliveryQuerySet.HEADER_FIELDS, "user")
+        .filter(id__gt=last_id, id__lte=latest, user_id__in=user_ids).order_by("id")
+    )
+    return list(deliveries), latest
+
+
+broker = Broker(getattr(settings, "SSE_POLL_INTERVAL", 5))
+
+
+def sse_message(delivery):
+    """Format a delivery's headers as one Server-Sent Events message."""
+    return f"id: {delivery.id}\nevent: delivery\ndata: {json.dumps(delivery_json(delivery))}\n\n"
+
+
+def publish_deliveries(deliveries):
+    """Notify each delivery's owner once the current transaction commits."""
+    deliveries = list(deliveries)
+    if not deliveries or not broker.has_subscribers():
+        return
+
+    def send():
+        # Formatted once here, not once per open stream
+        for delivery in deliveries:
+            broker.publish(delivery.user_id, sse_message(delivery), delivery.id)
+
+    transaction.on_commit(send)
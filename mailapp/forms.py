@@ -1,6 +1,8 @@
 from django import forms
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.forms import UserCreationForm, AuthenticationForm
+from django.template.defaultfilters import filesizeformat
 
 User = get_user_model()
 
@@ -25,7 +27,39 @@ class SignupForm(forms.ModelForm):
 class LoginForm(AuthenticationForm):
     username = forms.CharField(widget=forms.TextInput(attrs={'autofocus': True}), label="Email Address")
 
+class MultipleFileInput(forms.ClearableFileInput):
+    allow_multiple_selected = True
+
+class MultipleFileField(forms.FileField):
+    """A FileField that accepts several files and cleans to a list."""
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault("widget", MultipleFileInput())
+        super().__init__(*args, **kwargs)
+
+    def clean(self, data, initial=None):
+        if isinstance(data, (list, tuple)):
+            return [super(MultipleFileField, self).clean(item, initial) for item in data]
+        return [super().clean(data, initial)] if data else []
+
 class ComposeForm(forms.Form):
     recipients = forms.CharField(label="To", widget=forms.TextInput(attrs={'placeholder': 'recipient@example.com'}))
     subject = forms.CharField(widget=forms.TextInput(attrs={'placeholder': "What's this about?"}))
     body = forms.CharField(widget=forms.Textarea(attrs={'rows': 12, 'placeholder': 'Write your message here...'}), label="Message")
+    attachments = MultipleFileField(required=False)
+    # The Email being replied to, if any (set by the Reply link)
+    in_reply_to = forms.IntegerField(required=False, widget=forms.HiddenInput)
+
+    def clean_subject(self):
+        subject = self.cleaned_data["subject"]
+        if "\r" in subject or "\n" in subject:
+            raise forms.ValidationError("The subject cannot contain line breaks.")
+        return subject
+
+    def clean_attachments(self):
+        files = self.cleaned_data["attachments"]
+        limit = getattr(settings, "ATTACHMENT_MAX_SIZE", 100 * 1024 * 1024)
+        for upload in files:
+            if upload.size > limit:
+                raise forms.ValidationError(f"{upload.name} is larger than {filesizeformat(limit)}.")
+        return files
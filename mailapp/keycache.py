@@ -0,0 +1,75 @@
+"""
+Per-process cache of parsed PGP keys.
+
+Parsing an ASCII-armored key is expensive, and the same user key is
+needed for every message in a mailbox. Parsed keys are cached per user and per
+key digest (so a rotated key can never be served stale) with LRU eviction.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .crypto import load_key, prepare_private_key
+
+PUBLIC = "public"
+PRIVATE = "private"
+
+
+class KeyCache:
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id, kind, armored):
+        """Return the parsed key for `armored`, parsing it at most once."""
+        cache_key = (user_id, kind, hashlib.sha256(armored.encode()).hexdigest())
+        with self._lock:
+            key = self._keys.get(cache_key)
+            if key is not None:
+                self._keys.move_to_end(cache_key)
+                self.hits += 1
+                return key
+            self.misses += 1
+
+        key = load_key(armored)
+        if kind == PRIVATE:
+            prepare_private_key(key)
+
+        with self._lock:
+            self._keys[cache_key] = key
+            self._keys.move_to_end(cache_key)
+            while len(self._keys) > self.maxsize:
+                self._keys.popitem(last=False)
+        return key
+
+    def invalidate(self, user_id):
+        """Drop every cached key belonging to `user_id`."""
+        with self._lock:
+            for cache_key in [k for k in self._keys if k[0] == user_id]:
+                del self._keys[cache_key]
+
+    def clear(self):
+        with self._lock:
+            self._keys.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._keys), "maxsize": self.maxsize}
+
+
+key_cache = KeyCache(getattr(settings, "PGP_KEY_CACHE_SIZE", 256))
+
+
+def public_key_for(user):
+    return key_cache.get(user.pk, PUBLIC, user.pgp_public_key)
+
+
+def private_key_for(user):
+    return key_cache.get(user.pk, PRIVATE, user.pgp_private_key)
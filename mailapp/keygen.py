@@ -0,0 +1,126 @@
+"""
+Background PGP key generation.
+
+RSA key generation is too slow to run inside a request. Keys are generated in
+a process pool (outside the GIL) and kept in a pool of SpareKey rows; signup
+claims a spare key and only binds the user id to it, which is a single cheap
+signature. When the pool is empty the user is left with keys pending and a
+key is generated for them in the background.
+"""
+import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import Q
+
+from .crypto import add_user_id, generate_armored_key, load_key
+from .mail_utils import install_key
+from .models import CustomUser, SpareKey
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_lock = threading.Lock()
+_spares_in_flight = 0
+
+
+def get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=getattr(settings, "KEYGEN_WORKERS", 2))
+        return _executor
+
+
+def shutdown(wait=True):
+    """Stop the worker pool (it is recreated on next use)."""
+    global _executor
+    with _lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=wait)
+
+
+def pending_users():
+    """Users whose keypair has not been assigned yet."""
+    return CustomUser.objects.filter(
+        Q(pgp_public_key__isnull=True) | Q(pgp_public_key="")
+        | Q(pgp_private_key__isnull=True) | Q(pgp_private_key="")
+    )
+
+
+def claim_spare_key():
+    """Remove and return one spare key (parsed), or None if the pool is empty."""
+    while True:
+        spare = SpareKey.objects.order_by("id").first()
+        if spare is None:
+            return None
+        # Another request may claim the same row; only the one whose delete
+        # succeeds gets to use it.
+        deleted, _ = SpareKey.objects.filter(pk=spare.pk).delete()
+        if deleted:
+            return load_key(spare.private_key)
+
+
+def assign_keys(user):
+    """
+    Give `user` a keypair without waiting for RSA key generation.
+
+    Returns True if keys were assigned immediately from the spare pool and
+    False if generation was queued (the user's keys are pending).
+    """
+    if not user.keys_pending:
+        return True
+    key = claim_spare_key()
+    top_up()
+    if key is None:
+        future = get_executor().submit(generate_armored_key)
+        future.add_done_callback(lambda f: _on_done(_install_generated, user.pk, f))
+        return False
+    install_key(user, add_user_id(key, user.email))
+    return True
+
+
+def top_up():
+    """Queue enough background generations to refill the spare pool."""
+    global _spares_in_flight
+    target = getattr(settings, "KEYGEN_SPARE_KEYS", 10)
+    with _lock:
+        missing = target - SpareKey.objects.count() - _spares_in_flight
+        if missing <= 0:
+            return
+        _spares_in_flight += missing
+    executor = get_executor()
+    for _ in range(missing):
+        future = executor.submit(generate_armored_key)
+        future.add_done_callback(lambda f: _on_done(_store_spare, f))
+
+
+def _on_done(func, *args):
+    # Done callbacks run on the executor's management thread; do the DB work
+    # there and release that thread's connection afterwards.
+    try:
+        func(*args)
+    except Exception:
+        logger.exception("Background key generation failed")
+    finally:
+        connections.close_all()
+
+
+def _store_spare(future):
+    global _spares_in_flight
+    with _lock:
+        _spares_in_flight -= 1
+    SpareKey.objects.create(private_key=future.result())
+
+
+def _install_generated(user_id, future):
+    armored = future.result()
+    user = CustomUser.objects.filter(pk=user_id).first()
+    if user is None or not user.keys_pending:
+        # Keys were assigned some other way meanwhile; keep the key as a spare.
+        SpareKey.objects.create(private_key=armored)
+        return
+    install_key(user, add_user_id(load_key(armored), user.email))
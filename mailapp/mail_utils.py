@@ -1,102 +1,398 @@
-import pgpy
-from .models import Email, CustomUser
-from pathlib import Path
+import logging
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 
-KEYS_DIR = Path("keys")
-KEYS_DIR.mkdir(exist_ok=True)
+from django.conf import settings
+from django.db import transaction
+from django.db.models.functions import Lower
+from .attachments import prepare_attachment
+from .crypto import (
+    DecryptResult, add_user_id, armor_keypair, decrypt, decrypt_and_key_with_worker_key, decrypt_message,
+    decrypt_message_and_key, decrypt_with_worker_key, encrypt_for_armored_keys, encrypt_message,
+    init_decrypt_worker, new_key,
+)
+from .events import publish_deliveries
+from .keycache import key_cache, public_key_for, private_key_for
+from .metrics import timed, timer
+from .messagekeys import decrypt_cached, decrypt_with_secret, record_keys, secret_for, wrapped_keys
+from .models import Attachment, AttachmentBlob, Delivery, Email, CustomUser
+from .previewcache import preview_cache
+from .search import index_body
+from .threads import assign_threads, new_message_id, reply_headers
+from .writer import WriteQueue
 
+# A resolved message ready to store: sender is the local sending user (or
+# None for mail from outside), recipients the local users to deliver to,
+# attachments unsaved Attachment rows (see attachments.prepare_attachment),
+# and the threading headers (a message_id is generated when left blank)
+Outgoing = namedtuple(
+    "Outgoing",
+    ["sender_email", "sender", "addresses", "subject", "body", "recipients", "attachments",
+     "message_id", "in_reply_to", "references"],
+    defaults=[(), "", "", ""],
+)
 
-def generate_keys(user: CustomUser):
-    """Generate PGP keys for a user if they don't already exist, and store in the model."""
-    if user.pgp_private_key and user.pgp_public_key:
-        return user.pgp_public_key, user.pgp_private_key
+# Rows per INSERT in bulk_send, and the batch size at which encryption and
+# decryption move to a process pool
+BULK_BATCH_SIZE = 500
+PARALLEL_THRESHOLD = 32
 
-    key = pgpy.PGPKey.new(pgpy.constants.PubKeyAlgorithm.RSAEncryptOrSign, 2048)
-    uid = pgpy.PGPUID.new(user.email)
-    key.add_uid(
-        uid,
-        usage={pgpy.constants.KeyFlags.Sign, pgpy.constants.KeyFlags.EncryptCommunications},
-        hashes=[pgpy.constants.HashAlgorithm.SHA256],
-        ciphers=[pgpy.constants.SymmetricKeyAlgorithm.AES256],
-        compression=[pgpy.constants.CompressionAlgorithm.ZLIB]
-    )
+logger = logging.getLogger(__name__)
+
+
+def generate_keys(user: CustomUser, rotate=False):
+    """Generate PGP keys for a user if they don't already exist, and store in the model.
+    Pass rotate=True to replace an existing keypair."""
+    if user.pgp_private_key and user.pgp_public_key and not rotate:
+        return user.pgp_public_key, user.pgp_private_key
 
-    user.pgp_public_key = str(key.pubkey)
-    user.pgp_private_key = str(key)
-    user.save()
+    with timer("generate_keys"):
+        install_key(user, add_user_id(new_key(), user.email))
     return user.pgp_public_key, user.pgp_private_key
 
 
-def encrypt_email(body: str, recipient: CustomUser) -> str:
-    public_key = pgpy.PGPKey.from_blob(recipient.pgp_public_key)[0]
-    message = pgpy.PGPMessage.new(body)
-    encrypted_message = public_key.encrypt(message)
-    return str(encrypted_message)
+def install_key(user: CustomUser, key):
+    """Store a parsed private key (with the user's uid bound) as the user's keypair."""
+    user.pgp_public_key, user.pgp_private_key = armor_keypair(key)
+    user.save(update_fields=["pgp_public_key", "pgp_private_key"])
+    key_cache.invalidate(user.pk)
+
+
+def binary_bodies():
+    """Whether new ciphertext is stored as binary PGP in Email.body_blob."""
+    return getattr(settings, "EMAIL_BINARY_BODIES", True)
+
 
+@timed
+def encrypt_email(body: str, *recipients: CustomUser, binary=False):
+    """Encrypt body once for all recipients (see crypto.encrypt_message)."""
+    return encrypt_message(body, [public_key_for(recipient) for recipient in recipients], binary)
 
-def decrypt_email(encrypted_body: str, user: CustomUser) -> str:
-    private_key = pgpy.PGPKey.from_blob(user.pgp_private_key)[0]
-    message = pgpy.PGPMessage.from_blob(encrypted_body)
-    return private_key.decrypt(message).message
 
+@timed
+def decrypt_email(encrypted_body, user: CustomUser) -> str:
+    return decrypt(encrypted_body, private_key_for(user))
 
-def send_local_email(sender, recipient_email, subject, body, is_encrypted=False):
+
+def parse_recipients(recipients):
+    """Split a comma-separated string (or list) of addresses into unique, normalised addresses."""
+    if isinstance(recipients, str):
+        recipients = recipients.split(",")
+    addresses = []
+    for address in recipients:
+        address = address.strip().lower()
+        if address and address not in addresses:
+            addresses.append(address)
+    return addresses
+
+
+def deliver_email(email: Email, sender, recipients):
+    """Place a stored email in each recipient's inbox and in the sender's sent folder."""
+    deliveries = [
+        Delivery(email=email, user=recipient, folder=Delivery.INBOX, timestamp=email.timestamp)
+        for recipient in recipients
+    ]
+    if sender is not None:
+        deliveries.append(Delivery(email=email, user=sender, folder=Delivery.SENT,
+                                   is_read=True, timestamp=email.timestamp))
+    assign_threads(deliveries)
+    Delivery.objects.bulk_create(deliveries)
+    # Push the new headers to any open event streams once committed
+    publish_deliveries(deliveries)
+
+
+def resolve_recipients(addresses):
+    """Map normalised addresses to local users with a single query."""
+    users = {}
+    matches = CustomUser.objects.annotate(email_lower=Lower("email")).filter(email_lower__in=addresses)
+    for user in matches.order_by("id"):
+        users.setdefault(user.email_lower, user)
+    return users
+
+
+@timed
+def decrypt_emails(emails, user: CustomUser, workers=None, secret=None):
     """
-    Send an email to a single recipient and save it to the database.
-    If encrypt=True, the body will be encrypted with recipient's public key.
+    Decrypt a batch of Email rows for `user`, preserving order.
+
+    Returns one crypto.DecryptResult(body, error) per email; plaintext emails
+    pass straight through. Large batches are spread across a process pool
+    whose workers each parse the user's private key once. With the user's
+    key-wrapping `secret` (see messagekeys), messages whose session key is
+    recorded are decrypted with AES only, and the rest have theirs recorded.
     """
-    try:
-        recipient = CustomUser.objects.get(email=recipient_email)
-    except CustomUser.DoesNotExist:
-        print(f"Recipient {recipient_email} does not exist.")
+    results = [DecryptResult(mail.body, None) if not mail.is_encrypted else None for mail in emails]
+    pending = [i for i, result in enumerate(results) if result is None]
+    if pending and secret is not None:
+        wrapped = wrapped_keys(user, [emails[i].pk for i in pending])
+        for i in pending:
+            results[i] = decrypt_cached(emails[i], user, secret, wrapped.get(emails[i].pk))
+        pending = [i for i in pending if results[i] is None]
+    if not pending:
+        return results
+    if user.keys_pending:
+        for i in pending:
+            results[i] = DecryptResult(None, "no private key")
+        return results
+
+    ciphertexts = [emails[i].ciphertext for i in pending]
+    workers = workers or getattr(settings, "CRYPTO_WORKERS", None) or os.cpu_count() or 1
+    if workers == 1 or len(pending) < PARALLEL_THRESHOLD:
+        private_key = private_key_for(user)
+        if secret is None:
+            decrypted = [decrypt_message(ciphertext, private_key) for ciphertext in ciphertexts]
+        else:
+            decrypted = [decrypt_message_and_key(ciphertext, private_key) for ciphertext in ciphertexts]
+    else:
+        worker = decrypt_with_worker_key if secret is None else decrypt_and_key_with_worker_key
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_decrypt_worker,
+                                 initargs=(user.pgp_private_key,)) as executor:
+            chunksize = max(1, len(ciphertexts) // (workers * 4))
+            decrypted = list(executor.map(worker, ciphertexts, chunksize=chunksize))
+
+    if secret is not None:
+        record_keys(user, secret, [(emails[i].pk, key) for i, (_, key) in zip(pending, decrypted)])
+        decrypted = [result for result, _ in decrypted]
+    for i, result in zip(pending, decrypted):
+        results[i] = result
+    return results
+
+
+def send_local_email(sender, recipient_emails, subject, body, is_encrypted=False, attachments=(), in_reply_to=None):
+    """
+    Send an email to one or more local recipients and save it to the database.
+    recipient_emails may be a comma-separated string or a list of addresses.
+    If is_encrypted=True, the body is encrypted once and its session key is
+    wrapped for every recipient (and the sender, so they can read their sent copy).
+    attachments are uploaded files; they are always stored encrypted, with
+    their keys wrapped for the same readers. in_reply_to is the Email being
+    answered, which threads the new message with it.
+    """
+    addresses = parse_recipients(recipient_emails)
+    users = resolve_recipients(addresses)
+    missing = [address for address in addresses if address not in users]
+    if missing:
+        logger.info("Recipient %s does not exist.", missing[0])
         return False
+    recipients = [users[address] for address in addresses]
 
     if is_encrypted:
-        body = encrypt_email(body, recipient)
-
-    # Save email to the database
-    Email.objects.create(
-        sender=sender.email,
-        recipients=recipient.email,
-        subject=subject,
-        body=body,
-        is_encrypted=is_encrypted
-    )
+        body = encrypt_email(body, *_readers(sender, recipients), binary=binary_bodies())
+    if attachments:
+        reader_keys = [public_key_for(user) for user in _readers(sender, recipients)]
+        attachments = [prepare_attachment(upload, reader_keys) for upload in attachments]
+
+    # Save email to the database once, with a delivery per mailbox. The
+    # writer queue, when enabled, commits it together with concurrent sends
+    message = Outgoing(sender.email, sender, addresses, subject, body, recipients, attachments,
+                       "", *(reply_headers(in_reply_to) if in_reply_to is not None else ("", "")))
+    if write_queue.enabled and not transaction.get_connection().in_atomic_block:
+        write_queue.submit(message, is_encrypted)
+    else:
+        write_messages([message], is_encrypted)
     return True
 
-def fetch_inbox(user: CustomUser):
-    from .models import Email
 
-    print(f"[DEBUG] Fetching inbox for user: {user.email}")
+def _readers(sender, recipients):
+    # Everyone whose key the body is encrypted to: recipients plus a local sender
+    if sender is None or sender.keys_pending or sender in recipients:
+        return recipients
+    return recipients + [sender]
 
-    # Print all emails in the database for debugging
-    all_emails = Email.objects.all().values("id", "sender", "recipients", "subject", "is_encrypted")
-    print("[DEBUG] All emails in DB:")
-    for e in all_emails:
-        print(e)
 
-    # Fetch emails where recipient exactly matches user email
-    emails = Email.objects.filter(recipients=user.email).order_by('-timestamp')
-    print(f"[DEBUG] Emails found for user {user.email}: {emails.count()}")
+def bulk_send(sender, messages, is_encrypted=False, workers=None):
+    """
+    Deliver many messages from one sender with batched queries.
 
-    inbox = []
-    for mail in emails:
-        body = mail.body
-        if mail.is_encrypted:
-            try:
-                body = decrypt_email(mail.body, user)
-            except Exception as e:
-                body = f"[Encrypted email – cannot decrypt: {e}]"
+    messages is an iterable of (recipient_emails, subject, body). Recipients
+    for every message are resolved with one query, bodies are encrypted in a
+    process pool, and all rows are written with bulk_create in a single
+    transaction. Unknown recipients (or ones without keys when encrypting)
+    are skipped and reported rather than failing the whole batch.
+
+    Returns {"emails": int, "deliveries": int, "failures": [(address, reason), ...]}.
+    """
+    messages = [(parse_recipients(to), subject, body) for to, subject, body in messages]
+    users = resolve_recipients({address for addresses, _, _ in messages for address in addresses})
+
+    failures = []
+    pending = []
+    for addresses, subject, body in messages:
+        recipients = []
+        for address in addresses:
+            user = users.get(address)
+            if user is None:
+                failures.append((address, "no such user"))
+            elif is_encrypted and user.keys_pending:
+                failures.append((address, "encryption keys pending"))
+            else:
+                recipients.append(user)
+        if recipients:
+            pending.append((addresses, subject, body, recipients))
 
+    emails = store_messages(
+        [Outgoing(sender.email, sender, addresses, subject, body, recipients)
+         for addresses, subject, body, recipients in pending],
+        is_encrypted=is_encrypted,
+        workers=workers,
+    )
+    deliveries = sum(len(recipients) for _, _, _, recipients in pending)
+    return {"emails": len(emails), "deliveries": deliveries, "failures": failures}
+
+
+def store_messages(messages, is_encrypted=False, workers=None, executor=None):
+    """
+    Encrypt and write a batch of resolved Outgoing messages in one transaction.
+
+    Each message is stored once, with an inbox delivery per recipient and a
+    sent delivery when the sender is a local user. Bodies are encrypted to the
+    recipients (and local sender) in a process pool for large batches; pass
+    `executor` to reuse a long-lived pool. Returns the created Email rows.
+    """
+    if is_encrypted:
+        messages = encrypt_messages(messages, workers, executor)
+    return write_messages(messages, is_encrypted)
+
+
+@timed
+def encrypt_messages(messages, workers=None, executor=None):
+    """Return the Outgoing messages with each body replaced by its stored ciphertext."""
+    jobs = [
+        (message.body, [user.pgp_public_key for user in _readers(message.sender, message.recipients)])
+        for message in messages
+    ]
+    bodies = _encrypt_in_parallel(jobs, workers, executor)
+    return [message._replace(body=body) for message, body in zip(messages, bodies)]
+
+
+def write_messages(messages, is_encrypted=False):
+    """
+    Write Outgoing messages whose bodies are already in stored form (see
+    encrypt_messages) and their deliveries in one transaction. Returns the
+    created Email rows.
+    """
+    with transaction.atomic():
+        emails = Email.objects.bulk_create(
+            [
+                Email(sender=message.sender_email, recipients=", ".join(message.addresses),
+                      subject=message.subject, is_encrypted=is_encrypted,
+                      message_id=message.message_id or new_message_id(), in_reply_to=message.in_reply_to,
+                      references=message.references, **Email.body_fields(message.body))
+                for message in messages
+            ],
+            batch_size=BULK_BATCH_SIZE,
+        )
+        deliveries = []
+        for email, message in zip(emails, messages):
+            deliveries += [Delivery(email=email, user=user, folder=Delivery.INBOX, timestamp=email.timestamp)
+                           for user in message.recipients]
+            if message.sender is not None:
+                deliveries.append(Delivery(email=email, user=message.sender, folder=Delivery.SENT,
+                                           is_read=True, timestamp=email.timestamp))
+        assign_threads(deliveries)
+        Delivery.objects.bulk_create(deliveries, batch_size=BULK_BATCH_SIZE)
+
+        attachments = []
+        for email, message in zip(emails, messages):
+            for attachment in message.attachments:
+                attachment.email = email
+                attachments.append(attachment)
+        if attachments:
+            # Blobs are shared by identical files: keep the existing row
+            blobs = {attachment.blob.id: attachment.blob for attachment in attachments}
+            AttachmentBlob.objects.bulk_create(blobs.values(), ignore_conflicts=True)
+            Attachment.objects.bulk_create(attachments, batch_size=BULK_BATCH_SIZE)
+        publish_deliveries(deliveries)
+    return emails
+
+
+def _write_batch(items):
+    # Commit queued (Outgoing, is_encrypted) sends together, results in order
+    emails = [None] * len(items)
+    with transaction.atomic():
+        for is_encrypted in (False, True):
+            positions = [i for i, (_, encrypted) in enumerate(items) if encrypted == is_encrypted]
+            if positions:
+                stored = write_messages([items[i][0] for i in positions], is_encrypted)
+                for i, email in zip(positions, stored):
+                    emails[i] = email
+    return emails
+
+
+write_queue = WriteQueue(
+    _write_batch,
+    enabled=getattr(settings, "DB_WRITE_QUEUE", False),
+    batch_size=getattr(settings, "DB_WRITE_BATCH_SIZE", 200),
+)
+
+
+def _encrypt_in_parallel(jobs, workers=None, executor=None):
+    """
+    Encrypt (body, armored_public_keys) jobs, fanning out to processes for
+    large batches. Ciphertext comes back in the configured storage format.
+    """
+    workers = workers or getattr(settings, "CRYPTO_WORKERS", None) or os.cpu_count() or 1
+    if not jobs:
+        return []
+    binary = binary_bodies()
+    if executor is None and (workers == 1 or len(jobs) < PARALLEL_THRESHOLD):
+        return [encrypt_for_armored_keys(body, keys, binary) for body, keys in jobs]
+    chunksize = max(1, len(jobs) // (workers * 4))
+    bodies, keys = zip(*jobs)
+    if executor is not None:
+        return list(executor.map(encrypt_for_armored_keys, bodies, keys, repeat(binary), chunksize=chunksize))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(encrypt_for_armored_keys, bodies, keys, repeat(binary), chunksize=chunksize))
+
+
+def fetch_inbox(user: CustomUser):
+    # Fetch the user's inbox deliveries. Only headers are loaded; use
+    # read_email_body() to decrypt a single message on demand.
+    deliveries = Delivery.objects.headers().filter(user=user, folder=Delivery.INBOX).order_by('-timestamp', '-id')
+
+    inbox = []
+    for delivery in deliveries:
+        mail = delivery.email
         inbox.append({
             "id": mail.id,
             "from": mail.sender,
             "to": mail.recipients,
             "subject": mail.subject,
-            "body": body,
-            "timestamp": mail.timestamp,
-            "is_read": mail.is_read
+            "timestamp": delivery.timestamp,
+            "is_read": delivery.is_read,
+            "is_encrypted": mail.is_encrypted,
         })
 
-    print(f"[DEBUG] Inbox built with {len(inbox)} emails")
+    logger.debug("Fetched %d inbox messages for user %s", len(inbox), user.pk)
     return inbox
+
+
+def read_email_body(mail: Email, user: CustomUser, session=None, archived=False) -> str:
+    """Return the readable body of a single email, decrypting it if needed.
+    Pass the request session to use the decrypted-preview cache and recorded
+    message session keys. An archived email (see archive.py) has no rows to
+    record keys or search terms against, so it only uses the preview cache."""
+    if not mail.is_encrypted:
+        return mail.body
+    if session is not None:
+        body = preview_cache.get(session, user.pk, mail.pk)
+        if body is not None:
+            return body
+    secret = None if archived else secret_for(session)
+    try:
+        if secret is None:
+            body = decrypt_email(mail.ciphertext, user)
+        else:
+            # AES only once the message's session key has been recorded
+            body, error = decrypt_with_secret(mail, user, secret)
+            if error is not None:
+                raise ValueError(error)
+    except Exception as e:
+        return f"[Encrypted email – cannot decrypt: {e}]"
+    if not archived:
+        index_body(user, mail, body)
+    if session is not None:
+        preview_cache.put(session, user.pk, mail.pk, body)
+    return body
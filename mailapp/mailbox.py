@@ -0,0 +1,187 @@
+"""
+Mailbox queries, folder counts and keyset pagination.
+
+Listings are ordered by (timestamp, id) descending and paged with an opaque
+cursor that encodes the last row seen, so fetching page N costs the same as
+fetching page 1 regardless of mailbox size. Folder counts come from the
+FolderCounter rows kept current by triggers (SQLite), so they cost one
+indexed lookup; other backends aggregate over the user's deliveries.
+"""
+import base64
+from datetime import datetime
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count, Q
+from django.urls import reverse
+from django.utils.dateformat import format as date_format
+from django.utils.timezone import localtime
+
+from .models import Delivery, FolderCounter
+
+INBOX = Delivery.INBOX
+SENT = Delivery.SENT
+FOLDERS = (INBOX, SENT)
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def page_size():
+    return getattr(settings, "MAILBOX_PAGE_SIZE", 50)
+
+
+def mailbox_queryset(user, folder):
+    """Header-only deliveries for one of the user's folders, newest first."""
+    if folder not in FOLDERS:
+        raise ValueError(f"Unknown folder: {folder}")
+    return Delivery.objects.headers().filter(user=user, folder=folder).order_by("-timestamp", "-id")
+
+
+def counters_available():
+    return connection.vendor == "sqlite"
+
+
+def delivery_json(delivery):
+    """Header fields of one delivery, as served by the JSON APIs and event stream."""
+    return {
+        "id": delivery.email_id,
+        "delivery_id": delivery.id,
+        "folder": delivery.folder,
+        "sender": delivery.email.sender,
+        "recipients": delivery.email.recipients,
+        "subject": delivery.email.subject,
+        "timestamp": delivery.timestamp.isoformat(),
+        "display_time": date_format(localtime(delivery.timestamp), "M d, H:i"),
+        "is_read": delivery.is_read,
+        "is_encrypted": delivery.email.is_encrypted,
+        "url": reverse("email_detail", args=[delivery.email_id]),
+    }
+
+
+def _counts_query(user, folder):
+    return Delivery.objects.filter(user=user, folder=folder), {
+        "total": Count("id"),
+        "unread": Count("id", filter=Q(is_read=False)),
+    }
+
+
+def _counter_query(user, folder):
+    return FolderCounter.objects.filter(user=user, folder=folder).values("total", "unread")
+
+
+def folder_counts(user, folder):
+    """Total and unread message counts for one folder."""
+    if counters_available():
+        return _counter_query(user, folder).first() or {"total": 0, "unread": 0}
+    queryset, aggregates = _counts_query(user, folder)
+    return queryset.aggregate(**aggregates)
+
+
+async def afolder_counts(user, folder):
+    if counters_available():
+        return await _counter_query(user, folder).afirst() or {"total": 0, "unread": 0}
+    queryset, aggregates = _counts_query(user, folder)
+    return await queryset.aaggregate(**aggregates)
+
+
+def all_folder_counts(user):
+    """{folder: {"total": n, "unread": n}} for every folder, in one query."""
+    counts = {folder: {"total": 0, "unread": 0} for folder in FOLDERS}
+    if counters_available():
+        rows = FolderCounter.objects.filter(user=user).values("folder", "total", "unread")
+    else:
+        rows = Delivery.objects.filter(user=user).values("folder").annotate(
+            total=Count("id"), unread=Count("id", filter=Q(is_read=False)),
+        )
+    for row in rows:
+        counts[row["folder"]] = {"total": row["total"], "unread": row["unread"]}
+    return counts
+
+
+def mark_read(user, email_id, is_read=True):
+    """Set the read state of the user's copies of an email; counters follow."""
+    return Delivery.objects.filter(user=user, email_id=email_id).exclude(is_read=is_read).update(is_read=is_read)
+
+
+async def amark_read(user, email_id, is_read=True):
+    return await Delivery.objects.filter(user=user, email_id=email_id).exclude(is_read=is_read).aupdate(is_read=is_read)
+
+
+def reconcile_counters(fix=True):
+    """
+    Recompute every FolderCounter from the deliveries table.
+
+    Returns the drifted entries as (user_id, folder, stored, actual) tuples,
+    where stored/actual are (total, unread). With fix=True the counters are
+    rewritten to match, in the same transaction as the recount.
+    """
+    with transaction.atomic():
+        actual = {
+            (row["user_id"], row["folder"]): (row["total"], row["unread"])
+            for row in Delivery.objects.values("user_id", "folder").annotate(
+                total=Count("id"), unread=Count("id", filter=Q(is_read=False)),
+            ).order_by()
+        }
+        stored = {
+            (row["user_id"], row["folder"]): (row["total"], row["unread"])
+            for row in FolderCounter.objects.values("user_id", "folder", "total", "unread")
+        }
+        drift = [
+            (user_id, folder, stored.get((user_id, folder), (0, 0)), actual.get((user_id, folder), (0, 0)))
+            for user_id, folder in sorted(actual.keys() | stored.keys())
+            if stored.get((user_id, folder), (0, 0)) != actual.get((user_id, folder), (0, 0))
+        ]
+        if fix and drift:
+            for user_id, folder, _, (total, unread) in drift:
+                FolderCounter.objects.update_or_create(
+                    user_id=user_id, folder=folder, defaults={"total": total, "unread": unread},
+                )
+    return drift
+
+
+def encode_cursor(row, field="timestamp"):
+    raw = f"{getattr(row, field).isoformat()}|{row.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        timestamp, row_id = base64.urlsafe_b64decode(padded.encode()).decode().split("|")
+        return datetime.fromisoformat(timestamp), int(row_id)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise InvalidCursor(f"Invalid cursor: {cursor!r}") from e
+
+
+def _page_query(queryset, cursor, size, field):
+    size = size or page_size()
+    if cursor:
+        timestamp, row_id = decode_cursor(cursor)
+        queryset = queryset.filter(
+            Q(**{f"{field}__lt": timestamp}) | Q(**{field: timestamp, "id__lt": row_id})
+        )
+    # Fetch one extra row to learn whether another page exists.
+    return queryset[:size + 1], size
+
+
+def _split_page(rows, size, field):
+    page = rows[:size]
+    next_cursor = encode_cursor(page[-1], field) if len(rows) > size else None
+    return page, next_cursor
+
+
+def paginate(queryset, cursor=None, size=None, field="timestamp"):
+    """
+    Return (page, next_cursor) for a queryset ordered by -field, -id, where
+    field is a datetime (timestamp, or a thread's last_activity).
+    next_cursor is None on the last page.
+    """
+    queryset, size = _page_query(queryset, cursor, size, field)
+    return _split_page(list(queryset), size, field)
+
+
+async def apaginate(queryset, cursor=None, size=None, field="timestamp"):
+    queryset, size = _page_query(queryset, cursor, size, field)
+    return _split_page([row async for row in queryset], size, field)
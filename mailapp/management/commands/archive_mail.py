@@ -0,0 +1,44 @@
+"""
+Apply the retention policies: archive old mail and delete expired mail.
+
+Usage:
+  python manage.py archive_mail                      # one pass over every user
+  python manage.py archive_mail --user a@example.com # one user only
+  python manage.py archive_mail --loop 3600          # keep running, hourly
+
+Each batch is archived in its own transaction, so the command can be stopped
+and rerun at any point. Run only one at a time.
+"""
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from mailapp import archive
+from mailapp.models import CustomUser
+
+
+class Command(BaseCommand):
+    help = "Move mail past its archive age to the archive and delete mail past its retention age."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--user", help="Only this user's mail (email address).")
+        parser.add_argument("--batch-size", type=int, default=archive.BATCH_SIZE,
+                            help=f"Messages archived per transaction (default {archive.BATCH_SIZE}).")
+        parser.add_argument("--loop", type=int, metavar="SECONDS",
+                            help="Run again every SECONDS instead of exiting.")
+
+    def handle(self, *args, **options):
+        users = None
+        if options["user"]:
+            users = CustomUser.objects.filter(email=options["user"])
+            if not users.exists():
+                raise CommandError(f"No user {options['user']}.")
+        while True:
+            started = time.perf_counter()
+            # A fresh queryset each pass, so policy changes are picked up
+            archived, deleted = archive.run(users.all() if users is not None else None, options["batch_size"])
+            self.stdout.write(f"Archived {archived} and deleted {deleted} messages "
+                              f"in {time.perf_counter() - started:.1f}s.")
+            if not options["loop"]:
+                break
+            time.sleep(options["loop"])
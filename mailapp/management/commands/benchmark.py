@@ -0,0 +1,641 @@
+"""
+Benchmark mailbox views against a throwaway test database.
+
+Usage:
+  python manage.py benchmark inbox --sizes 100 1000 10000
+  python manage.py benchmark multi_recipient --sizes 1 10 200
+  python manage.py benchmark bulk_send --sizes 1000 10000
+  python manage.py benchmark storage --sizes 1000
+  python manage.py benchmark contention --sizes 1 2 4 8
+  python manage.py benchmark views --sizes 100 10000 100000 --key-fixtures bench-keys.json \
+      --output BASE.json
+  python manage.py benchmark views --sizes 100 10000 100000 --key-fixtures bench-keys.json \
+      --compare BASE.json
+
+The real db.sqlite3 is never touched: a fresh test database is created,
+seeded with real PGP-encrypted mail, measured and destroyed again.
+
+--output saves the results with the commit and versions they were measured
+on; --compare matches rows against such a file (or --json output) and fails
+if any median latency grew by more than --tolerance percent or any query
+count grew.
+"""
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import secrets
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection, connections
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, setup_test_environment, teardown_test_environment
+from django.urls import reverse
+from django.utils import timezone
+
+from mailapp.mail_utils import (
+    binary_bodies, bulk_send, decrypt_emails, encrypt_email, generate_keys, install_key, send_local_email,
+    write_queue,
+)
+from mailapp.crypto import add_user_id, decrypt_message, generate_armored_key, load_key
+from mailapp.keycache import private_key_for
+from mailapp.messagekeys import decrypt_cached, derive_secret, wrapped_keys
+from mailapp.previewcache import preview_cache
+from mailapp.search import search
+from mailapp.models import CustomUser, Delivery, Email, SpareKey
+
+SEED_BATCH = 1000
+CONTENTION_SECONDS = 3
+CONTENTION_READERS = 2
+CONTENTION_THREADS = 4
+
+
+def create_user(email):
+    user = CustomUser.objects.create_user(username=email, email=email, password="bench-pass")
+    generate_keys(user)
+    return user
+
+
+def create_users_sharing_key(prefix, count, template):
+    """Bulk-create users that reuse template's keypair, skipping RSA key generation."""
+    CustomUser.objects.bulk_create(
+        CustomUser(username=f"{prefix}{i}@bench.local", email=f"{prefix}{i}@bench.local",
+                   pgp_public_key=template.pgp_public_key, pgp_private_key=template.pgp_private_key)
+        for i in range(count)
+    )
+    return [f"{prefix}{i}@bench.local" for i in range(count)]
+
+
+def seed_mailbox(sender, recipient, count, encrypted=True, binary=None):
+    """Add `count` messages from sender to recipient using bulk inserts.
+
+    One real ciphertext is produced and reused so seeding large mailboxes is
+    not dominated by PGP encryption time.
+    """
+    body = "Benchmark message body.\n" * 20
+    if encrypted:
+        body = encrypt_email(body, recipient, binary=binary_bodies() if binary is None else binary)
+    for start in range(0, count, SEED_BATCH):
+        emails = Email.objects.bulk_create(
+            Email(
+                sender=sender.email,
+                recipients=recipient.email,
+                subject=f"Benchmark message {start + i}",
+                is_encrypted=encrypted,
+                **Email.body_fields(body),
+            )
+            for i in range(min(SEED_BATCH, count - start))
+        )
+        Delivery.objects.bulk_create(
+            Delivery(email=email, user=user, folder=folder, is_read=folder == Delivery.SENT,
+                     timestamp=email.timestamp)
+            for email in emails
+            for user, folder in ((recipient, Delivery.INBOX), (sender, Delivery.SENT))
+        )
+
+
+def time_request(client, url, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        response = client.get(url)
+        samples.append((time.perf_counter() - start) * 1000)
+        if response.status_code != 200:
+            raise RuntimeError(f"GET {url} returned {response.status_code}")
+    return samples
+
+
+def bench_mailbox_view(url_name, sizes, repeat):
+    """Measure a mailbox listing view as the mailbox grows through `sizes`."""
+    alice = create_user("alice@bench.local")
+    bob = create_user("bob@bench.local")
+    client = Client()
+    client.force_login(bob if url_name == "inbox" else alice)
+
+    results = []
+    seeded = 0
+    for size in sorted(sizes):
+        seed_mailbox(alice, bob, size - seeded)
+        seeded = size
+        samples = time_request(client, reverse(url_name), repeat)
+        results.append({
+            "view": url_name,
+            "messages": size,
+            "median_ms": round(statistics.median(samples), 2),
+            "max_ms": round(max(samples), 2),
+        })
+    return results
+
+
+def bench_multi_recipient(sizes, repeat):
+    """Compare one ciphertext per recipient with one hybrid ciphertext for all."""
+    # Random text so compression does not hide the body size
+    body = secrets.token_hex(16 * 1024)
+    users = []
+    results = []
+    for size in sorted(sizes):
+        users += [create_user(f"member{i}@bench.local") for i in range(len(users), size)]
+        recipients = users[:size]
+        for mode in ("per_recipient", "hybrid"):
+            samples = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                if mode == "hybrid":
+                    stored = len(encrypt_email(body, *recipients))
+                else:
+                    stored = sum(len(encrypt_email(body, recipient)) for recipient in recipients)
+                samples.append((time.perf_counter() - start) * 1000)
+            results.append({
+                "mode": mode,
+                "recipients": size,
+                "median_ms": round(statistics.median(samples), 2),
+                "stored_bytes": stored,
+            })
+    return results
+
+
+def bench_bulk_send(sizes, repeat):
+    """Deliveries per second for individual messages sent with bulk_send."""
+    sender = create_user("sender@bench.local")
+    results = []
+    for size in sorted(sizes):
+        addresses = create_users_sharing_key(f"bulk{size}-", size, sender)
+        for encrypted in (False, True):
+            samples = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                bulk_send(sender, [([a], "Bulk message", "Hello from the benchmark.") for a in addresses],
+                          is_encrypted=encrypted)
+                samples.append(time.perf_counter() - start)
+            elapsed = statistics.median(samples)
+            results.append({
+                "recipients": size,
+                "encrypted": encrypted,
+                "median_ms": round(elapsed * 1000, 2),
+                "deliveries_per_sec": round(size / elapsed),
+            })
+    return results
+
+
+def bench_search(sizes, repeat):
+    """Search latency for a rare and a common term as the indexed corpus grows."""
+    alice = create_user("alice@bench.local")
+    bob = create_user("bob@bench.local")
+    results = []
+    seeded = 0
+    for size in sorted(sizes):
+        seed_mailbox(alice, bob, size - seeded, encrypted=False)
+        seeded = size
+        for query in (f"Benchmark message {size - 1}", "benchmark"):
+            samples = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                search(bob, query)
+                samples.append((time.perf_counter() - start) * 1000)
+            results.append({
+                "messages": size,
+                "query": query,
+                "median_ms": round(statistics.median(samples), 2),
+            })
+    return results
+
+
+def bench_batch_decrypt(sizes, repeat):
+    """Batch decryption throughput with 1 worker versus a process pool."""
+    alice = create_user("alice@bench.local")
+    bob = create_user("bob@bench.local")
+    seed_mailbox(alice, bob, max(sizes))
+    emails = list(Email.objects.order_by("id"))
+    results = []
+    for size in sorted(sizes):
+        for workers in sorted({1, 2, os.cpu_count() or 1}):
+            samples = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                decrypt_emails(emails[:size], bob, workers=workers)
+                samples.append(time.perf_counter() - start)
+            elapsed = statistics.median(samples)
+            results.append({
+                "messages": size,
+                "workers": workers,
+                "median_ms": round(elapsed * 1000, 2),
+                "messages_per_sec": round(size / elapsed),
+            })
+    return results
+
+
+def bench_storage(sizes, repeat):
+    """Stored body size and read latency for armored versus binary ciphertext."""
+    alice = create_user("alice@bench.local")
+    bob = create_user("bob@bench.local")
+    client = Client()
+    client.force_login(bob)
+    results = []
+    for size in sorted(sizes):
+        for binary in (False, True):
+            seed_mailbox(alice, bob, size, binary=binary)
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT SUM(LENGTH(body)) + COALESCE(SUM(LENGTH(body_blob)), 0) FROM mailapp_email")
+                stored = cursor.fetchone()[0]
+            email = Email.objects.latest("id")
+            samples = time_request(client, reverse("email_detail", args=[email.id]), repeat)
+            results.append({
+                "messages": size,
+                "format": "binary" if binary else "armored",
+                "body_bytes": stored,
+                "read_median_ms": round(statistics.median(samples), 2),
+            })
+            Email.objects.all().delete()
+    return results
+
+
+def bench_preview_cache(sizes, repeat):
+    """Repeat detail views of the same messages with the preview cache off and on."""
+    alice = create_user("alice@bench.local")
+    bob = create_user("bob@bench.local")
+    client = Client()
+    client.force_login(bob)
+    seed_mailbox(alice, bob, max(sizes))
+    ids = list(Email.objects.order_by("id").values_list("id", flat=True))
+    ttl = preview_cache.ttl
+    results = []
+    try:
+        for size in sorted(sizes):
+            for cached in (False, True):
+                preview_cache.clear()
+                preview_cache.ttl = 300 if cached else 0
+                samples = []
+                for _ in range(repeat):
+                    for email_id in ids[:size]:
+                        samples += time_request(client, reverse("email_detail", args=[email_id]), 1)
+                results.append({
+                    "messages": size,
+                    "cache": cached,
+                    "median_ms": round(statistics.median(samples), 2),
+                    "hits": preview_cache.stats()["hits"],
+                })
+    finally:
+        preview_cache.ttl = ttl
+    return results
+
+
+def bench_session_keys(sizes, repeat):
+    """Per-message decrypt latency: RSA private-key path versus recorded session keys."""
+    alice = create_user("alice@bench.local")
+    bob = create_user("bob@bench.local")
+    seed_mailbox(alice, bob, max(sizes))
+    secret = derive_secret(bob, "bench-pass")
+    private_key = private_key_for(bob)
+    results = []
+    for size in sorted(sizes):
+        emails = list(Email.objects.order_by("id")[:size])
+        decrypt_emails(emails, bob, workers=1, secret=secret)  # record the keys
+        wrapped = wrapped_keys(bob, [email.pk for email in emails])
+        for path in ("rsa", "session_key"):
+            samples = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                for email in emails:
+                    if path == "rsa":
+                        decrypt_message(email.ciphertext, private_key)
+                    else:
+                        decrypt_cached(email, bob, secret, wrapped[email.pk])
+                samples.append((time.perf_counter() - start) / size)
+            results.append({
+                "messages": size,
+                "path": path,
+                "per_message_ms": round(statistics.median(samples) * 1000, 3),
+            })
+    return results
+
+
+def bench_contention(sizes, repeat):
+    """
+    Inbox read latency and send throughput while `sizes` writer processes
+    (CONTENTION_THREADS sending threads each, like busy server workers) send
+    mail flat out, with the stock SQLite setup versus the production profile.
+    """
+    alice = create_user("alice@bench.local")
+    bob = create_user("bob@bench.local")
+    seed_mailbox(alice, bob, 1000, encrypted=False)
+    options = connection.settings_dict["OPTIONS"]
+    profiles = {
+        "default": ({}, False),
+        "production": (dict(settings.SQLITE_PRODUCTION_OPTIONS), True),
+    }
+    queue_enabled = write_queue.enabled
+    saved = dict(options)
+    results = []
+    try:
+        for writers in sorted(sizes):
+            for profile, (profile_options, queued) in profiles.items():
+                options.clear()
+                options.update(profile_options)
+                write_queue.enabled = queued
+                connections.close_all()  # reconnect with the profile's options
+                if profile == "default":
+                    # WAL is a property of the file: undo the previous run's
+                    with connection.cursor() as cursor:
+                        cursor.execute("PRAGMA journal_mode=DELETE")
+                results.append({"writers": writers, "profile": profile,
+                                **run_contention(alice, bob, writers, repeat)})
+    finally:
+        options.clear()
+        options.update(saved)
+        write_queue.enabled = queue_enabled
+        connections.close_all()
+    return results
+
+
+def contention_writer(sender, recipient, stop, totals):
+    """Body of one writer process: send until `stop` is set, then report (sent, errors)."""
+    sent, errors = [], []
+
+    def send():
+        try:
+            while not stop.is_set():
+                try:
+                    send_local_email(sender, recipient.email, "Contention", "Written under load.")
+                    sent.append(1)
+                except OperationalError:  # "database is locked"
+                    errors.append(1)
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=send) for _ in range(CONTENTION_THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    totals.put((len(sent), len(errors)))
+
+
+def run_contention(sender, reader, writers, repeat):
+    # Writers are forked so they inherit the test database settings
+    context = multiprocessing.get_context("fork")
+    stop, totals = context.Event(), context.Queue()
+    connections.close_all()
+    processes = [context.Process(target=contention_writer, args=(sender, reader, stop, totals))
+                 for _ in range(writers)]
+    for process in processes:
+        process.start()
+
+    reads, read_errors = [], []
+    done = threading.Event()
+
+    def read():
+        client = Client()
+        client.force_login(reader)
+        try:
+            while not done.is_set():
+                try:
+                    reads.extend(time_request(client, reverse("inbox"), repeat))
+                except OperationalError as e:
+                    read_errors.append(e)
+        finally:
+            connection.close()
+
+    readers = [threading.Thread(target=read) for _ in range(CONTENTION_READERS)]
+    for thread in readers:
+        thread.start()
+    time.sleep(CONTENTION_SECONDS)
+    stop.set()
+    done.set()
+    for thread in readers:
+        thread.join()
+    sent = errors = 0
+    for _ in processes:
+        process_sent, process_errors = totals.get()
+        sent += process_sent
+        errors += process_errors
+    for process in processes:
+        process.join()
+
+    reads = sorted(reads) or [float("nan")]  # nan: every read failed
+    return {
+        "sends_per_sec": round(sent / CONTENTION_SECONDS),
+        "send_errors": errors,
+        "read_errors": len(read_errors),
+        "read_median_ms": round(statistics.median(reads), 2),
+        "read_p99_ms": round(reads[min(len(reads) - 1, len(reads) * 99 // 100)], 2),
+    }
+
+def fixture_keys(path, count):
+    """
+    `count` armored private keys for benchmark users. With `path`, keys are
+    read from that JSON file and any missing ones generated and saved to it,
+    so repeat runs skip RSA key generation; without it every run generates.
+    """
+    keys = []
+    if path and os.path.exists(path):
+        with open(path) as fh:
+            keys = json.load(fh)
+    if len(keys) < count:
+        with ProcessPoolExecutor() as executor:
+            futures = [executor.submit(generate_armored_key) for _ in range(count - len(keys))]
+            keys += [future.result() for future in futures]
+        if path:
+            with open(path, "w") as fh:
+                json.dump(keys, fh)
+    return keys[:count]
+
+
+def create_user_with_key(email, armored):
+    user = CustomUser.objects.create_user(username=email, email=email, password="bench-pass")
+    install_key(user, add_user_id(load_key(armored), email))
+    return user
+
+
+def logged_in_client(user):
+    # Through the login view, so the session holds the message-key secret
+    client = Client()
+    response = client.post(reverse("login"), {"username": user.email, "password": "bench-pass"})
+    if response.status_code != 302:
+        raise RuntimeError(f"Login as {user.email} failed")
+    return client
+
+
+def measure(request, repeat):
+    """Call request() `repeat` times; return (latencies in ms, queries per call)."""
+    samples = []
+    for _ in range(repeat):
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            response = request()
+            samples.append((time.perf_counter() - start) * 1000)
+        if response.status_code not in (200, 302):
+            raise RuntimeError(f"{response.request['PATH_INFO']} returned {response.status_code}")
+    return samples, len(queries)
+
+
+def bench_views(options):
+    """
+    Latency and query count of signup, compose, inbox, sent and detail as one
+    mailbox grows through `sizes`, among --users users with real keys.
+    """
+    sizes, repeat = options["sizes"], options["repeat"]
+    keys = fixture_keys(options["key_fixtures"], max(options["users"], 2))
+    users = [create_user_with_key(f"user{i}@bench.local", key) for i, key in enumerate(keys)]
+    alice, bob = users[:2]
+    sender, reader, anonymous = logged_in_client(alice), logged_in_client(bob), Client()
+    signups = itertools.count()
+    results = []
+    seeded = 0
+    for size in sorted(sizes):
+        seed_mailbox(alice, bob, size - seeded)
+        seeded = size
+        # Enough spare keys that signups never wait for, or start, key generation
+        spares = repeat + getattr(settings, "KEYGEN_SPARE_KEYS", 10) - SpareKey.objects.count()
+        SpareKey.objects.bulk_create(SpareKey(private_key=keys[0]) for _ in range(max(0, spares)))
+        # A different message per detail request, so each is a first open; with
+        # fewer unread messages than --repeat they are opened again in turn
+        inbox = Delivery.objects.filter(user=bob, folder=Delivery.INBOX).order_by("-id")
+        unread = itertools.cycle(
+            list(inbox.filter(is_read=False).values_list("email_id", flat=True)[:repeat])
+            or list(inbox.values_list("email_id", flat=True)[:1])
+        )
+        requests = {
+            "signup": lambda: anonymous.post(reverse("signup"), {
+                "email": f"new{next(signups)}@bench.local", "password": "bench-pass", "name": "Bench User",
+            }),
+            "compose": lambda: sender.post(reverse("compose"), {
+                "recipients": bob.email, "subject": "Benchmark", "body": "Composed by the benchmark.\n" * 20,
+            }),
+            "inbox": lambda: reader.get(reverse("inbox")),
+            "sent": lambda: sender.get(reverse("sent")),
+            "detail": lambda: reader.get(reverse("email_detail", args=[next(unread)])),
+        }
+        for view, request in requests.items():
+            samples, queries = measure(request, repeat)
+            results.append({
+                "view": view,
+                "messages": size,
+                "median_ms": round(statistics.median(samples), 2),
+                "max_ms": round(max(samples), 2),
+                "queries": queries,
+            })
+    return results
+
+
+# Result fields that are measurements; the rest identify the row
+MEASUREMENT_SUFFIXES = ("_ms", "_per_sec", "_bytes", "_errors", "queries", "hits")
+
+
+def row_key(row):
+    return tuple((key, value) for key, value in row.items() if not key.endswith(MEASUREMENT_SUFFIXES))
+
+
+def compare(results, baseline, tolerance):
+    """Yield (line, regressed) comparing each result row with its baseline row."""
+    previous = {row_key(row): row for row in baseline}
+    for row in results:
+        before = previous.get(row_key(row))
+        if before is None:
+            continue
+        changes, regressed = [], False
+        for key, value in row.items():
+            if not key.endswith(MEASUREMENT_SUFFIXES) or not isinstance(before.get(key), (int, float)):
+                continue
+            change = (value - before[key]) / before[key] * 100 if before[key] else 0.0
+            changes.append(f"{key} {before[key]} -> {value} ({change:+.1f}%)")
+            if key == "median_ms" and change > tolerance or key == "queries" and value > before[key]:
+                regressed = True
+        label = "  ".join(f"{key}={value}" for key, value in row_key(row))
+        yield f"{'REGRESSION ' if regressed else ''}{label}: {', '.join(changes)}", regressed
+
+
+def git_commit():
+    try:
+        output = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=settings.BASE_DIR)
+    except OSError:
+        return None
+    return output.stdout.strip() or None
+
+
+SCENARIOS = {
+    "inbox": lambda options: bench_mailbox_view("inbox", options["sizes"], options["repeat"]),
+    "sent": lambda options: bench_mailbox_view("sent", options["sizes"], options["repeat"]),
+    "multi_recipient": lambda options: bench_multi_recipient(options["sizes"], options["repeat"]),
+    "bulk_send": lambda options: bench_bulk_send(options["sizes"], options["repeat"]),
+    "search": lambda options: bench_search(options["sizes"], options["repeat"]),
+    "batch_decrypt": lambda options: bench_batch_decrypt(options["sizes"], options["repeat"]),
+    "storage": lambda options: bench_storage(options["sizes"], options["repeat"]),
+    "preview_cache": lambda options: bench_preview_cache(options["sizes"], options["repeat"]),
+    "session_keys": lambda options: bench_session_keys(options["sizes"], options["repeat"]),
+    "contention": lambda options: bench_contention(options["sizes"], options["repeat"]),
+    "views": bench_views,
+}
+
+
+class Command(BaseCommand):
+    help = "Run performance benchmarks against a temporary test database."
+
+    def add_arguments(self, parser):
+        parser.add_argument("scenario", choices=sorted(SCENARIOS))
+        parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000],
+                            help="Mailbox sizes (or recipient counts) to measure.")
+        parser.add_argument("--repeat", type=int, default=5, help="Requests per measurement.")
+        parser.add_argument("--json", action="store_true", help="Emit results as JSON.")
+        parser.add_argument("--users", type=int, default=10, help="Users to create (views scenario).")
+        parser.add_argument("--key-fixtures", help="JSON file caching generated PGP keys between runs.")
+        parser.add_argument("--output", help="Save results with commit and version details as JSON.")
+        parser.add_argument("--compare", help="Results file (--output or --json) to compare against.")
+        parser.add_argument("--tolerance", type=float, default=20.0,
+                            help="Allowed median latency growth in percent before --compare fails.")
+
+    def handle(self, *args, **options):
+        # Thousands of per-request log lines would drown out the results
+        logging.getLogger("mailapp.metrics").setLevel(logging.WARNING)
+        setup_test_environment()
+        if options["scenario"] == "contention":
+            # Locking and WAL need a database file; the default test database is in memory
+            connection.settings_dict["TEST"]["NAME"] = os.path.join(tempfile.mkdtemp(), "bench.sqlite3")
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            results = SCENARIOS[options["scenario"]](options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        if options["output"]:
+            with open(options["output"], "w") as fh:
+                json.dump({
+                    "scenario": options["scenario"],
+                    "commit": git_commit(),
+                    "created": timezone.now().isoformat(),
+                    "python": platform.python_version(),
+                    "django": django.get_version(),
+                    "db_profile": getattr(settings, "DB_PROFILE", "default"),
+                    "sizes": options["sizes"],
+                    "repeat": options["repeat"],
+                    "results": results,
+                }, fh, indent=2)
+
+        if options["json"]:
+            self.stdout.write(json.dumps(results, indent=2))
+        else:
+            for row in results:
+                self.stdout.write("  ".join(f"{key}={value}" for key, value in row.items()))
+
+        if options["compare"]:
+            with open(options["compare"]) as fh:
+                baseline = json.load(fh)
+            if isinstance(baseline, dict):
+                baseline = baseline["results"]
+            regressions = 0
+            for line, regressed in compare(results, baseline, options["tolerance"]):
+                self.stderr.write(line)
+                regressions += regressed
+            if regressions:
+                raise CommandError(f"{regressions} measurement(s) regressed against {options['compare']}")
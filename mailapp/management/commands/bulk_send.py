@@ -0,0 +1,64 @@
+"""
+Send one message to many local users in a single batched transaction.
+
+Usage:
+  python manage.py bulk_send --sender alice@jyomail --to-file members.txt \
+      --subject "Maintenance tonight" --body-file notice.txt --encrypt
+
+Each address in --to-file (one per line, '-' for stdin) gets its own copy
+unless --together is given, in which case one message is addressed to all.
+"""
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from mailapp.mail_utils import bulk_send, parse_recipients
+from mailapp.models import CustomUser
+
+
+class Command(BaseCommand):
+    help = "Deliver a message to many recipients using batched inserts."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sender", required=True, help="Email address of the sending user.")
+        parser.add_argument("--to-file", required=True, help="File with one recipient per line ('-' for stdin).")
+        parser.add_argument("--subject", required=True)
+        body = parser.add_mutually_exclusive_group(required=True)
+        body.add_argument("--body")
+        body.add_argument("--body-file")
+        parser.add_argument("--encrypt", action="store_true", help="PGP-encrypt the message bodies.")
+        parser.add_argument("--together", action="store_true",
+                            help="Send one message addressed to every recipient.")
+        parser.add_argument("--workers", type=int, default=None, help="Encryption worker processes.")
+
+    def handle(self, *args, **options):
+        sender = CustomUser.objects.filter(email__iexact=options["sender"]).first()
+        if sender is None:
+            raise CommandError(f"Sender {options['sender']} does not exist.")
+
+        if options["to_file"] == "-":
+            addresses = parse_recipients(sys.stdin.read().split())
+        else:
+            with open(options["to_file"]) as f:
+                addresses = parse_recipients(f.read().split())
+        if options["body_file"]:
+            with open(options["body_file"]) as f:
+                body = f.read()
+        else:
+            body = options["body"]
+
+        if options["together"]:
+            messages = [(addresses, options["subject"], body)]
+        else:
+            messages = [([address], options["subject"], body) for address in addresses]
+
+        start = time.perf_counter()
+        result = bulk_send(sender, messages, is_encrypted=options["encrypt"], workers=options["workers"])
+        elapsed = time.perf_counter() - start
+
+        for address, reason in result["failures"]:
+            self.stderr.write(f"{address}: {reason}")
+        rate = result["deliveries"] / elapsed if elapsed else 0
+        self.stdout.write(f"Stored {result['emails']} emails, {result['deliveries']} deliveries "
+                          f"in {elapsed:.2f}s ({rate:.0f} deliveries/s); {len(result['failures'])} failed.")
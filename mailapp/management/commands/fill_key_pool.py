@@ -0,0 +1,47 @@
+"""
+Pre-generate spare PGP keys and give keys to users still waiting for them.
+
+Usage:
+  python manage.py fill_key_pool --count 50
+
+Run at deploy time (or from cron) so signups are served from the spare pool,
+and after a restart to recover users whose background generation was lost.
+"""
+from concurrent.futures import as_completed
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from mailapp.crypto import add_user_id, generate_armored_key
+from mailapp.keygen import claim_spare_key, get_executor, pending_users, shutdown
+from mailapp.mail_utils import install_key
+from mailapp.models import SpareKey
+
+
+class Command(BaseCommand):
+    help = "Fill the spare PGP key pool and assign keys to users with keys pending."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--count", type=int, default=None,
+                            help="Spare keys to keep in the pool (default: KEYGEN_SPARE_KEYS).")
+
+    def handle(self, *args, **options):
+        pending = list(pending_users())
+        target = options["count"] if options["count"] is not None else getattr(settings, "KEYGEN_SPARE_KEYS", 10)
+        missing = max(0, target - SpareKey.objects.count()) + len(pending)
+
+        executor = get_executor()
+        try:
+            futures = [executor.submit(generate_armored_key) for _ in range(missing)]
+            for future in as_completed(futures):
+                SpareKey.objects.create(private_key=future.result())
+        finally:
+            shutdown()
+
+        for user in pending:
+            key = claim_spare_key()
+            if key is not None:
+                install_key(user, add_user_id(key, user.email))
+
+        self.stdout.write(f"Generated {missing} keys; assigned keys to {len(pending)} pending users; "
+                          f"{SpareKey.objects.count()} spare keys in pool.")
@@ -0,0 +1,56 @@
+"""
+Import an mbox file into a user's mailbox with batched inserts.
+
+Usage:
+  python manage.py import_mailbox alice@jyomail --input alice.mbox
+  gunzip -c inbox.mbox.gz | python manage.py import_mailbox alice@jyomail --input - --encrypt
+
+Folder and read state come from the X-JyoMail-* headers written by
+export_mailbox; mail from other clients is filed in the inbox. Attachments
+are stored encrypted to the user's key, like uploaded ones.
+"""
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from mailapp.mail_utils import BULK_BATCH_SIZE
+from mailapp.mailbox import FOLDERS
+from mailapp.mbox import import_mailbox
+from mailapp.models import CustomUser
+
+
+class Command(BaseCommand):
+    help = "Import an mbox file into a user's mailbox."
+
+    def add_arguments(self, parser):
+        parser.add_argument("user", help="Email address of the mailbox owner.")
+        parser.add_argument("--input", required=True, help="mbox file to read ('-' for stdin).")
+        parser.add_argument("--folder", choices=FOLDERS, help="File every message in this folder.")
+        parser.add_argument("--encrypt", action="store_true",
+                            help="Encrypt plaintext bodies to the user's public key.")
+        parser.add_argument("--batch-size", type=int, default=BULK_BATCH_SIZE, help="Messages per transaction.")
+
+    def handle(self, *args, **options):
+        user = CustomUser.objects.filter(email__iexact=options["user"]).first()
+        if user is None:
+            raise CommandError(f"User {options['user']} does not exist.")
+        if options["encrypt"] and user.keys_pending:
+            raise CommandError(f"{user.email} has no PGP keys yet.")
+
+        start = time.perf_counter()
+        if options["input"] == "-":
+            result = import_mailbox(user, sys.stdin.buffer, options["folder"], options["encrypt"],
+                                    options["batch_size"])
+        else:
+            with open(options["input"], "rb") as fh:
+                result = import_mailbox(user, fh, options["folder"], options["encrypt"], options["batch_size"])
+        elapsed = time.perf_counter() - start
+
+        messages, size, skipped = result
+        if skipped:
+            self.stderr.write(f"{skipped} attachments were skipped: {user.email} has no PGP keys yet or they "
+                              f"could not be decrypted.")
+        self.stdout.write(f"Imported {messages} messages ({size / 1e6:.1f} MB) in {elapsed:.2f}s "
+                          f"({messages / elapsed if elapsed else 0:.0f} msgs/s, "
+                          f"{size / 1e6 / elapsed if elapsed else 0:.1f} MB/s).")
@@ -0,0 +1,25 @@
+"""
+Delete attachment blobs that no message refers to any more.
+
+Usage:
+  python manage.py prune_attachments               # blobs untouched for an hour
+  python manage.py prune_attachments --grace 0     # everything unreferenced now
+
+Files without a database row (left by interrupted uploads) are removed too.
+The grace period spares blobs that a send in progress may be reusing.
+"""
+from django.core.management.base import BaseCommand
+
+from mailapp.attachments import prune_blobs
+
+
+class Command(BaseCommand):
+    help = "Delete unreferenced attachment blobs and stray attachment files."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--grace", type=int, default=3600,
+                            help="Keep blobs touched within this many seconds (default 3600).")
+
+    def handle(self, *args, **options):
+        blobs, files = prune_blobs(grace=options["grace"])
+        self.stdout.write(f"Deleted {blobs} unreferenced blobs and {files} stray files.")
@@ -0,0 +1,28 @@
+"""
+Check (and repair) the denormalised folder counters against the deliveries.
+
+Usage:
+  python manage.py reconcile_counters            # report and fix drift
+  python manage.py reconcile_counters --dry-run  # report only
+
+The counters are kept in step by database triggers, so drift should only
+appear after manual SQL edits or restores; run this after either.
+"""
+from django.core.management.base import BaseCommand
+
+from mailapp.mailbox import reconcile_counters
+
+
+class Command(BaseCommand):
+    help = "Recompute per-user folder counters from the deliveries table."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", help="Report drift without fixing it.")
+
+    def handle(self, *args, **options):
+        drift = reconcile_counters(fix=not options["dry_run"])
+        for user_id, folder, (total, unread), (actual_total, actual_unread) in drift:
+            self.stdout.write(f"user {user_id} {folder}: stored {total}/{unread} unread, "
+                              f"actual {actual_total}/{actual_unread} unread")
+        action = "Found" if options["dry_run"] else "Fixed"
+        self.stdout.write(f"{action} {len(drift)} drifted counters.")
@@ -0,0 +1,397 @@
+"""
+Streaming mbox (mboxrd) export and import of a user's mailbox.
+
+Export walks the user's archived messages, then their deliveries, with
+QuerySet.iterator(), so only one chunk of rows is in memory at a time. Bodies are written as stored (armored
+ciphertext for encrypted mail) unless decryption is requested. Import reads
+the file line by line and writes each batch of messages with bulk_create.
+Memory use is bounded by the chunk/batch size, not the mailbox size.
+
+JyoMail-specific state (folder, read flag, whether the body is ciphertext) is
+carried in X-JyoMail-* headers so an export can be imported back losslessly.
+Attachments follow the body as MIME parts: decrypted when decryption is
+requested, otherwise the blob as stored together with its encrypted key. On
+import both kinds are stored again through attachments.prepare_attachment(),
+so a part is never trusted as a blob as-is. A message is parsed whole on
+import, so its attachments are in memory while its batch is.
+"""
+import base64
+import datetime
+import io
+import re
+import secrets
+import textwrap
+from collections import defaultdict
+from email.errors import HeaderParseError
+from email.header import Header, decode_header, make_header
+from email.parser import BytesParser
+from email.utils import encode_rfc2231, format_datetime, parsedate_to_datetime, quote
+from itertools import chain, islice
+
+from django.core.files.uploadedfile import TemporaryUploadedFile
+from django.db import transaction
+from django.utils import timezone
+
+from .archive import iter_archived
+from .attachments import attachment_key, blob_path, iter_plaintext, prepare_attachment, unseal
+from .crypto import to_armored, to_binary
+from .keycache import public_key_for
+from .mail_utils import BULK_BATCH_SIZE, _encrypt_in_parallel, binary_bodies, decrypt_emails
+from .models import ArchivedAttachment, Attachment, AttachmentBlob, Delivery, Email
+from .threads import assign_threads, threading_headers
+
+EXPORT_CHUNK_SIZE = 500
+# Bytes read at a time from a blob exported as stored
+EXPORT_READ_SIZE = 64 * 1024
+PGP_ARMOR = "-----BEGIN PGP MESSAGE-----"
+
+# mboxrd quoting: any body line matching ^>*From gains (or loses) one '>'
+_QUOTE_RE = re.compile(rb"^(>*From )", re.M)
+_UNQUOTE_RE = re.compile(rb"^>(>*From )")
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def _header(value):
+    # A line break in a value would end the header block, or start a forged
+    # entry; fold it to a space
+    value = " ".join(str(value).splitlines())
+    return value if value.isascii() else Header(value, "utf-8").encode()
+
+
+def _disposition(filename):
+    filename = " ".join(filename.splitlines())
+    if filename.isascii():
+        return f'attachment; filename="{quote(filename)}"'
+    return f"attachment; filename*={encode_rfc2231(filename, 'utf-8')}"
+
+
+def _base64(chunks):
+    # 57 bytes encode to exactly one 76-character line
+    pending = b""
+    for chunk in chunks:
+        pending += chunk
+        cut = len(pending) - len(pending) % 57
+        if cut:
+            yield base64.encodebytes(pending[:cut])
+            pending = pending[cut:]
+    if pending:
+        yield base64.encodebytes(pending)
+
+
+def _read_file(path):
+    with open(path, "rb") as fh:
+        while chunk := fh.read(EXPORT_READ_SIZE):
+            yield chunk
+
+
+def attachment_part(attachment, key=None):
+    """
+    One attachment as a MIME part: (header lines, body chunks). With its AES
+    `key` the content is decrypted; without, the part carries the blob as
+    stored and its key as encrypted to the readers, for import to open.
+    """
+    blob = attachment.blob
+    headers = [
+        f"Content-Type: {_header(attachment.content_type) if key else 'application/octet-stream'}",
+        f"Content-Disposition: {_disposition(attachment.filename)}",
+        "Content-Transfer-Encoding: base64",
+    ]
+    if key:
+        return headers, iter_plaintext(blob, key, 0, blob.size - 1)
+    headers += [
+        f"X-JyoMail-Content-Type: {_header(attachment.content_type)}",
+        f"X-JyoMail-Blob: {blob.size} {blob.chunk_size}",
+        "X-JyoMail-Key: " + "\n ".join(textwrap.wrap(base64.b64encode(bytes(attachment.key)).decode(), 76)),
+    ]
+    return headers, _read_file(blob_path(blob.id))
+
+
+def format_message(delivery, body, encrypted, attachments=()):
+    """
+    Render one delivery as an mbox entry, including the 'From ' line, in
+    pieces of bytes. `attachments` are attachment_part() results; with any,
+    the entry is multipart/mixed and they stream after the body.
+    """
+    email = delivery.email
+    headers = [
+        f"From {_header(email.sender) or 'MAILER-DAEMON'} {email.timestamp:%a %b %d %H:%M:%S %Y}",
+        f"From: {_header(email.sender)}",
+        f"To: {_header(email.recipients)}",
+        f"Subject: {_header(email.subject)}",
+        f"Date: {format_datetime(email.timestamp)}",
+        f"X-JyoMail-Id: {email.id}",
+        f"X-JyoMail-Folder: {delivery.folder}",
+        f"X-JyoMail-Read: {'yes' if delivery.is_read else 'no'}",
+        f"X-JyoMail-Encrypted: {'yes' if encrypted else 'no'}",
+        "MIME-Version: 1.0",
+    ]
+    # Threading headers, when the message has them, follow Date
+    headers[5:5] = [
+        f"{name}: {_header(value)}"
+        for name, value in (("Message-ID", email.message_id), ("In-Reply-To", email.in_reply_to),
+                            ("References", email.references))
+        if value
+    ]
+    body = _QUOTE_RE.sub(rb">\1", body.replace("\r\n", "\n").encode("utf-8"))
+    if not body.endswith(b"\n"):
+        body += b"\n"
+    text = ["Content-Type: text/plain; charset=utf-8", "Content-Transfer-Encoding: 8bit"]
+    if not attachments:
+        yield "\n".join(headers + text).encode("utf-8") + b"\n\n" + body + b"\n"
+        return
+    boundary = f"=_{secrets.token_hex(16)}"
+    headers.append(f'Content-Type: multipart/mixed; boundary="{boundary}"')
+    yield "\n".join(headers + ["", f"--{boundary}"] + text).encode("utf-8") + b"\n\n" + body
+    for part_headers, chunks in attachments:
+        yield "\n".join(["", f"--{boundary}"] + part_headers).encode("utf-8") + b"\n\n"
+        yield from _base64(chunks)
+    yield f"\n--{boundary}--\n\n".encode()
+
+
+def _attachments(chunk):
+    # The attachments of each (delivery, ArchivedMessage or None) in chunk
+    archived, hot = defaultdict(list), defaultdict(list)
+    entry_ids = [entry.id for _, entry in chunk if entry is not None]
+    rows = ArchivedAttachment.objects.filter(message_id__in=entry_ids).select_related("blob").order_by("id")
+    for attachment in rows:
+        archived[attachment.message_id].append(attachment)
+    email_ids = [delivery.email_id for delivery, entry in chunk if entry is None]
+    for attachment in Attachment.objects.filter(email_id__in=email_ids).select_related("blob").order_by("id"):
+        hot[attachment.email_id].append(attachment)
+    return [archived[entry.id] if entry is not None else hot[delivery.email_id] for delivery, entry in chunk]
+
+
+def export_mailbox(user, out, folder=None, decrypt=False, chunk_size=EXPORT_CHUNK_SIZE, secret=None):
+    """
+    Write `user`'s mailbox (one folder, or all) to the binary file `out`,
+    oldest first. Pass the user's key-wrapping `secret` to decrypt with
+    recorded session keys. Returns (messages, bytes_written, decrypt_failures),
+    where failures count bodies and attachments exported encrypted.
+    """
+    deliveries = Delivery.objects.filter(user=user).select_related("email").order_by("timestamp", "id")
+    if folder:
+        deliveries = deliveries.filter(folder=folder)
+    # Archived mail (see archive.py) is older than any still in the mailbox
+    archived = (
+        (Delivery(email=email, user=user, folder=entry.folder, is_read=email.is_read, timestamp=entry.timestamp),
+         entry)
+        for entry, email in iter_archived(user, folder, chunk_size)
+    )
+    hot = ((delivery, None) for delivery in deliveries.iterator(chunk_size=chunk_size))
+
+    messages = written = failures = 0
+    for chunk in _chunks(chain(archived, hot), chunk_size):
+        emails = [delivery.email for delivery, _ in chunk]
+        if decrypt:
+            results = decrypt_emails(emails, user, secret=secret)
+        else:
+            results = [None] * len(emails)
+        for (delivery, _), email, result, attachments in zip(chunk, emails, results, _attachments(chunk)):
+            if result is not None and result.error is None:
+                body, encrypted = result.body, False
+            else:
+                # Not decrypting, or decryption failed: keep the armored ciphertext
+                body = to_armored(email.ciphertext) if email.is_encrypted else email.body
+                encrypted = email.is_encrypted
+                failures += result is not None
+            parts = []
+            for attachment in attachments:
+                key = attachment_key(attachment, user) if decrypt else None
+                failures += decrypt and key is None
+                parts.append(attachment_part(attachment, key))
+            for piece in format_message(delivery, body, encrypted, parts):
+                out.write(piece)
+                written += len(piece)
+            messages += 1
+    return messages, written, failures
+
+
+def iter_messages(fh):
+    """Yield the raw bytes of each message in an mbox file, one at a time."""
+    lines = None
+    for line in fh:
+        if line.startswith(b"From "):
+            if lines:
+                yield _finish(lines)
+            lines = []
+        elif lines is not None:
+            lines.append(_UNQUOTE_RE.sub(rb"\1", line))
+    if lines:
+        yield _finish(lines)
+
+
+def _finish(lines):
+    # Drop the blank line that separates entries
+    if lines[-1].strip() == b"":
+        lines.pop()
+    return b"".join(lines)
+
+
+def _text_body(message):
+    for part in message.walk():
+        if part.get_content_type() == "text/plain" and part.get_content_disposition() != "attachment":
+            payload = part.get_payload(decode=True) or b""
+            try:
+                return payload.decode(part.get_content_charset() or "utf-8", "replace")
+            except LookupError:
+                # Unknown charset: one bad message must not stop the import
+                return payload.decode("utf-8", "replace")
+    return ""
+
+
+def _decoded(message, name):
+    value = message.get(name)
+    if not value:
+        return ""
+    try:
+        return str(make_header(decode_header(value)))
+    except (LookupError, HeaderParseError, UnicodeDecodeError):
+        pass
+    # An unknown charset or a broken encoded word: decode what can be
+    # decoded, like _text_body, rather than stop the import
+    try:
+        words = decode_header(value)
+    except HeaderParseError:
+        return str(value)
+    decoded = []
+    for word, charset in words:
+        if isinstance(word, str):
+            decoded.append(word)
+            continue
+        try:
+            decoded.append(word.decode(charset or "ascii", "replace"))
+        except LookupError:
+            decoded.append(word.decode("utf-8", "replace"))
+    return "".join(decoded)
+
+
+def import_attachment(part, user):
+    """
+    An unsaved Attachment (email not yet set) for one attachment part,
+    stored encrypted to `user`, or None if a part exported encrypted cannot
+    be opened with their key.
+    """
+    data = part.get_payload(decode=True) or b""
+    wrapped = part.get("X-JyoMail-Key")
+    content_type = part.get("X-JyoMail-Content-Type") if wrapped else part.get_content_type()
+    upload = TemporaryUploadedFile(part.get_filename() or "attachment", content_type, 0, None)
+    try:
+        if wrapped:
+            try:
+                key = attachment_key(Attachment(key=base64.b64decode("".join(wrapped.split()))), user)
+                size, chunk_size = map(int, part.get("X-JyoMail-Blob", "").split())
+                # Decrypting authenticates every chunk; the blob is then stored
+                # under the id of what it decrypts to, never the exported one
+                for chunk in unseal(io.BytesIO(data), key, size, chunk_size):
+                    upload.write(chunk)
+            except Exception:
+                return None
+        else:
+            upload.write(data)
+        upload.size = upload.tell()
+        return prepare_attachment(upload, [public_key_for(user)])
+    finally:
+        upload.close()
+
+
+def parse_message(raw, folder=None):
+    """
+    Turn one raw mbox entry into unsaved (Email, folder, is_read, attachment
+    parts).
+
+    `folder` overrides the X-JyoMail-Folder header; messages from other
+    mail clients land in the inbox.
+    """
+    # The legacy (compat32) parser: policy.default's header objects make
+    # parsing several times slower and only a few headers are needed here
+    message = BytesParser().parsebytes(raw)
+    body = _text_body(message)
+    folder = folder or message.get("X-JyoMail-Folder", Delivery.INBOX)
+    if folder not in (Delivery.INBOX, Delivery.SENT):
+        folder = Delivery.INBOX
+    read = message.get("X-JyoMail-Read")
+    is_read = read == "yes" if read else folder == Delivery.SENT
+    encrypted = message.get("X-JyoMail-Encrypted")
+    is_encrypted = encrypted == "yes" if encrypted else body.lstrip().startswith(PGP_ARMOR)
+
+    try:
+        timestamp = parsedate_to_datetime(message["Date"])
+        if timezone.is_naive(timestamp):
+            timestamp = timezone.make_aware(timestamp, datetime.timezone.utc)
+    except (TypeError, ValueError):
+        timestamp = timezone.now()
+
+    if is_encrypted and binary_bodies():
+        try:
+            body = to_binary(body)
+        except Exception:
+            pass  # keep text PGPy cannot parse as it is
+    email = Email(
+        sender=_decoded(message, "From")[:254],
+        recipients=_decoded(message, "To")[:500],
+        subject=_decoded(message, "Subject")[:255],
+        is_encrypted=is_encrypted,
+        timestamp=timestamp,
+        **threading_headers(message),
+        **Email.body_fields(body),
+    )
+    parts = [part for part in message.walk() if part.get_content_disposition() == "attachment"]
+    return email, folder, is_read, parts
+
+
+def import_mailbox(user, fh, folder=None, encrypt=False, batch_size=BULK_BATCH_SIZE):
+    """
+    Read an mbox file (binary) into `user`'s mailbox, `batch_size` messages
+    per transaction. With `encrypt`, plaintext bodies are encrypted to the
+    user's public key first; attachments always are. Returns (messages,
+    bytes_read, attachments_skipped): attachments are skipped when the user
+    has no keys yet or one exported encrypted cannot be opened.
+    """
+    messages = size = skipped = 0
+    for raws in _chunks(iter_messages(fh), batch_size):
+        parsed = [parse_message(raw, folder) for raw in raws]
+        emails = [email for email, _, _, _ in parsed]
+        # Stored before the transaction, which need not wait on the file work
+        attachments = []
+        for email, _, _, parts in parsed:
+            for part in parts:
+                attachment = None if user.keys_pending else import_attachment(part, user)
+                if attachment is None:
+                    skipped += 1
+                else:
+                    attachments.append((email, attachment))
+        if encrypt and not user.keys_pending:
+            plain = [email for email in emails if not email.is_encrypted]
+            bodies = _encrypt_in_parallel([(email.body, [user.pgp_public_key]) for email in plain])
+            for email, body in zip(plain, bodies):
+                email.body, email.body_blob = Email.body_fields(body).values()
+                email.is_encrypted = True
+
+        timestamps = [email.timestamp for email in emails]
+        with transaction.atomic():
+            Email.objects.bulk_create(emails, batch_size=batch_size)
+            # bulk_create applies auto_now_add; put the original dates back
+            for email, timestamp in zip(emails, timestamps):
+                email.timestamp = timestamp
+            Email.objects.bulk_update(emails, ["timestamp"], batch_size=batch_size)
+            deliveries = [
+                Delivery(email=email, user=user, folder=box, is_read=is_read, timestamp=email.timestamp)
+                for email, box, is_read, _ in parsed
+            ]
+            assign_threads(deliveries)
+            Delivery.objects.bulk_create(deliveries, batch_size=batch_size)
+            if attachments:
+                for email, attachment in attachments:
+                    attachment.email = email
+                # Blobs are shared by identical files: keep the existing row
+                blobs = {attachment.blob.id: attachment.blob for _, attachment in attachments}
+                AttachmentBlob.objects.bulk_create(blobs.values(), ignore_conflicts=True)
+                Attachment.objects.bulk_create([attachment for _, attachment in attachments], batch_size=batch_size)
+        messages += len(raws)
+        size += sum(len(raw) for raw in raws)
+    return messages, size, skipped
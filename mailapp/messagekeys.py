@@ -0,0 +1,110 @@
+"""
+Cached message session keys, so a message pays for RSA only once per reader.
+
+At login a secret is derived from the user's password (PBKDF2 with a
+per-user salt) and kept in the session. The first time the user decrypts a
+message, its symmetric session key is wrapped under that secret and stored
+in MessageKey. Later reads in any session of that user unwrap it and run
+AES only. Without the password-derived secret (e.g. after a password
+change) a wrapped key simply fails to open and the RSA path is used again,
+which re-records the key under the new secret.
+"""
+import hashlib
+import os
+import secrets
+
+from django.conf import settings
+
+from .crypto import aead, decrypt_message_and_key, decrypt_with_session_key
+from .keycache import private_key_for
+from .metrics import timed
+from .models import MessageKey
+
+SESSION_SECRET = "_message_key_secret"
+
+
+def kdf_iterations():
+    return getattr(settings, "MESSAGE_KEY_KDF_ITERATIONS", 100_000)
+
+
+def derive_secret(user, password):
+    """Derive the user's key-wrapping secret from their password."""
+    if not user.message_key_salt:
+        user.message_key_salt = secrets.token_hex(16)
+        user.save(update_fields=["message_key_salt"])
+    return hashlib.pbkdf2_hmac("sha256", password.encode(), bytes.fromhex(user.message_key_salt),
+                               kdf_iterations())
+
+
+def remember_secret(session, user, password):
+    """Called at login: keep the derived secret for the rest of the session."""
+    session[SESSION_SECRET] = derive_secret(user, password).hex()
+
+
+def secret_for(session):
+    """The session's key-wrapping secret, or None if it has none (e.g. API sessions)."""
+    if session is None or SESSION_SECRET not in session:
+        return None
+    return bytes.fromhex(session[SESSION_SECRET])
+
+
+def wrap(secret, user_id, email_id, cipher, session_key):
+    nonce = os.urandom(12)
+    # Bind the wrapped key to its row so keys cannot be moved between messages
+    aad = f"{user_id}:{email_id}".encode()
+    return nonce + aead(secret).encrypt(nonce, bytes([int(cipher)]) + session_key, aad)
+
+
+def unwrap(secret, user_id, email_id, wrapped):
+    """Return (cipher, session_key), raising InvalidTag for the wrong secret."""
+    wrapped = bytes(wrapped)
+    aad = f"{user_id}:{email_id}".encode()
+    plain = aead(secret).decrypt(wrapped[:12], wrapped[12:], aad)
+    return plain[0], plain[1:]
+
+
+def wrapped_keys(user, email_ids):
+    """{email_id: wrapped} for the user's recorded keys among email_ids, in one query."""
+    return dict(MessageKey.objects.filter(user=user, email_id__in=email_ids).values_list("email_id", "wrapped"))
+
+
+def decrypt_cached(mail, user, secret, wrapped):
+    """Decrypt with a recorded session key; None if there is none or it does not open."""
+    from cryptography.exceptions import InvalidTag
+
+    if wrapped is None:
+        return None
+    try:
+        cipher, session_key = unwrap(secret, user.pk, mail.pk, wrapped)
+    except InvalidTag:
+        return None
+    result = decrypt_with_session_key(mail.ciphertext, cipher, session_key)
+    return result if result.error is None else None
+
+
+def record_keys(user, secret, keys):
+    """Store (email_id, (cipher, session_key)) pairs for user, replacing stale ones."""
+    keys = [(email_id, key) for email_id, key in keys if key is not None]
+    if not keys:
+        return
+    MessageKey.objects.filter(user=user, email_id__in=[email_id for email_id, _ in keys]).delete()
+    MessageKey.objects.bulk_create(
+        [MessageKey(email_id=email_id, user=user, wrapped=wrap(secret, user.pk, email_id, *key))
+         for email_id, key in keys],
+        ignore_conflicts=True,
+    )
+
+
+@timed
+def decrypt_with_secret(mail, user, secret):
+    """
+    Decrypt one email for user: AES-only when its session key is recorded,
+    otherwise the RSA path, recording the key for next time. Returns a
+    DecryptResult.
+    """
+    result = decrypt_cached(mail, user, secret, wrapped_keys(user, [mail.pk]).get(mail.pk))
+    if result is not None:
+        return result
+    result, key = decrypt_message_and_key(mail.ciphertext, private_key_for(user))
+    record_keys(user, secret, [(mail.pk, key)])
+    return result
@@ -0,0 +1,195 @@
+"""
+In-process timings for views and crypto operations.
+
+MetricsMiddleware records each request's duration and ORM query count under
+its view name. `timed`/`timer` wrap the PGP hot paths (encrypt_email,
+decrypt_email, generate_keys, ...). For every series the last
+METRICS_WINDOW samples are kept, so p50/p99 reflect recent traffic, along
+with an all-time count and sum. The /metrics view renders them in the
+Prometheus text format, and each request is also logged as one JSON line on
+the "mailapp.metrics" logger.
+
+Figures are per process: scrape every worker, or run one.
+"""
+import contextvars
+import functools
+import json
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+logger = logging.getLogger(__name__)
+
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+class Series:
+    def __init__(self, window):
+        self.samples = deque(maxlen=window)
+        self.count = 0
+        self.sum = 0.0
+
+    def add(self, value):
+        self.samples.append(value)
+        self.count += 1
+        self.sum += value
+
+    def quantiles(self):
+        ordered = sorted(self.samples)
+        return [(q, ordered[min(len(ordered) - 1, int(len(ordered) * q))]) for q in QUANTILES]
+
+
+class Registry:
+    def __init__(self, window=1024):
+        self.window = window
+        self._series = defaultdict(lambda: Series(self.window))  # (metric, label) -> Series
+        self._lock = threading.Lock()
+
+    def observe(self, metric, label, value):
+        with self._lock:
+            self._series[metric, label].add(value)
+
+    def snapshot(self, metric):
+        """{label: (quantiles, count, sum)} for one metric."""
+        with self._lock:
+            return {
+                label: (series.quantiles(), series.count, series.sum)
+                for (name, label), series in self._series.items() if name == metric
+            }
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+
+registry = Registry(getattr(settings, "METRICS_WINDOW", 1024))
+
+# Summaries exposed at /metrics: name -> (label name, help text)
+SUMMARIES = {
+    "view_seconds": ("view", "Request duration per view."),
+    "view_queries": ("view", "ORM queries per request, per view."),
+    "crypto_seconds": ("op", "Duration of PGP operations."),
+}
+
+
+@contextmanager
+def timer(op):
+    """Record the duration of the block under crypto_seconds{op=op}."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        registry.observe("crypto_seconds", op, elapsed)
+        logger.debug(json.dumps({"event": "crypto", "op": op, "ms": round(elapsed * 1000, 2)}))
+
+
+def timed(func):
+    """Decorator form of timer(), named after the function."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with timer(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+class MetricsMiddleware:
+    """Time every request and count its queries, under the resolved view name."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        counter = [0]
+        token = _query_counter.set(counter)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _query_counter.reset(token)
+        self.record(request, response, time.perf_counter() - start, counter[0])
+        return response
+
+    async def __acall__(self, request):
+        counter = [0]
+        token = _query_counter.set(counter)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _query_counter.reset(token)
+        self.record(request, response, time.perf_counter() - start, counter[0])
+        return response
+
+    def record(self, request, response, elapsed, queries):
+        match = request.resolver_match
+        view = match.view_name if match else "unresolved"
+        registry.observe("view_seconds", view, elapsed)
+        registry.observe("view_queries", view, queries)
+        logger.info(json.dumps({
+            "event": "request",
+            "view": view,
+            "method": request.method,
+            "status": response.status_code,
+            "ms": round(elapsed * 1000, 2),
+            "queries": queries,
+        }))
+
+
+# The current request's query count. A context variable rather than a
+# per-connection wrapper: sync_to_async threads use their own connections
+# but inherit the request's context.
+_query_counter = contextvars.ContextVar("query_counter", default=None)
+
+
+def _count_query(execute, sql, params, many, context):
+    counter = _query_counter.get()
+    if counter is not None:
+        counter[0] += 1
+    return execute(sql, params, many, context)
+
+
+@receiver(connection_created)
+def _install_query_counter(sender, connection, **kwargs):
+    if _count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_count_query)
+
+
+def _labels(**labels):
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels.items()) + "}"
+
+
+def render(stats):
+    """
+    Prometheus text exposition of the recorded summaries plus `stats`, a
+    {name: {field: number}} mapping of other components' counters (caches,
+    queues), rendered as jyomail_<name>_<field> gauges.
+    """
+    lines = []
+    for metric, (label, help_text) in SUMMARIES.items():
+        name = f"jyomail_{metric}"
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} summary"]
+        for value, (quantiles, count, total) in sorted(registry.snapshot(metric).items()):
+            for q, sample in quantiles:
+                lines.append(f"{name}{_labels(**{label: value, 'quantile': q})} {sample:.6g}")
+            lines.append(f"{name}_count{_labels(**{label: value})} {count}")
+            lines.append(f"{name}_sum{_labels(**{label: value})} {total:.6g}")
+    for component, fields in stats.items():
+        for field, value in fields.items():
+            if value is not None:
+                lines += [f"# TYPE jyomail_{component}_{field} gauge", f"jyomail_{component}_{field} {value}"]
+    return "\n".join(lines) + "\n"
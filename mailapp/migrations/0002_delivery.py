@@ -0,0 +1,54 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:25
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def split_recipients(apps, schema_editor):
+    """Create deliveries for existing mail from the comma-separated recipients column."""
+    Email = apps.get_model("mailapp", "Email")
+    Delivery = apps.get_model("mailapp", "Delivery")
+    CustomUser = apps.get_model("mailapp", "CustomUser")
+
+    users = {email.lower(): pk for pk, email in CustomUser.objects.values_list("id", "email") if email}
+    batch = []
+    for mail in Email.objects.order_by("id").iterator(chunk_size=1000):
+        addresses = {a.strip().lower() for a in mail.recipients.split(",") if a.strip()}
+        for address in addresses:
+            if address in users:
+                batch.append(Delivery(email_id=mail.id, user_id=users[address], folder="inbox",
+                                      is_read=mail.is_read, timestamp=mail.timestamp))
+        if mail.sender.lower() in users:
+            batch.append(Delivery(email_id=mail.id, user_id=users[mail.sender.lower()], folder="sent",
+                                  is_read=True, timestamp=mail.timestamp))
+        if len(batch) >= 1000:
+            Delivery.objects.bulk_create(batch)
+            batch = []
+    Delivery.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailapp', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Delivery',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('folder', models.CharField(choices=[('inbox', 'Inbox'), ('sent', 'Sent')], default='inbox', max_length=16)),
+                ('is_read', models.BooleanField(default=False)),
+                ('timestamp', models.DateTimeField()),
+                ('email', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='deliveries', to='mailapp.email')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='deliveries', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', 'folder', '-timestamp', '-id'], name='delivery_mailbox_idx')],
+                'constraints': [models.UniqueConstraint(fields=('email', 'user', 'folder'), name='unique_delivery')],
+            },
+        ),
+        migrations.RunPython(split_recipients, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,64 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:31
+
+from django.db import migrations, models
+
+# Full-text index over deliveries (rowid = delivery id). `owner` holds a
+# "u<user id>" token so per-user queries intersect inside the index. Triggers
+# keep it in step with every insert path, including bulk_create.
+CREATE_SEARCH_INDEX = [
+    """
+    CREATE VIRTUAL TABLE mailapp_search USING fts5(
+        owner, subject, sender, body, tokenize = 'unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER mailapp_search_delivery_insert AFTER INSERT ON mailapp_delivery BEGIN
+        INSERT INTO mailapp_search (rowid, owner, subject, sender, body)
+        SELECT new.id, 'u' || new.user_id, e.subject, e.sender,
+               CASE WHEN e.is_encrypted THEN '' ELSE e.body END
+        FROM mailapp_email e WHERE e.id = new.email_id;
+    END
+    """,
+    """
+    CREATE TRIGGER mailapp_search_delivery_delete AFTER DELETE ON mailapp_delivery BEGIN
+        DELETE FROM mailapp_search WHERE rowid = old.id;
+    END
+    """,
+    """
+    INSERT INTO mailapp_search (rowid, owner, subject, sender, body)
+    SELECT d.id, 'u' || d.user_id, e.subject, e.sender,
+           CASE WHEN e.is_encrypted THEN '' ELSE e.body END
+    FROM mailapp_delivery d JOIN mailapp_email e ON e.id = d.email_id
+    """,
+]
+
+DROP_SEARCH_INDEX = [
+    "DROP TRIGGER IF EXISTS mailapp_search_delivery_insert",
+    "DROP TRIGGER IF EXISTS mailapp_search_delivery_delete",
+    "DROP TABLE IF EXISTS mailapp_search",
+]
+
+
+def run_sqlite(statements):
+    def run(apps, schema_editor):
+        # FTS5 is SQLite-only; other backends fall back to LIKE queries
+        if schema_editor.connection.vendor == "sqlite":
+            for statement in statements:
+                schema_editor.execute(statement)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailapp', '0003_sparekey'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customuser',
+            name='index_message_bodies',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.RunPython(run_sqlite(CREATE_SEARCH_INDEX), run_sqlite(DROP_SEARCH_INDEX)),
+    ]
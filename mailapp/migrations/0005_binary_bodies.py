@@ -0,0 +1,57 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:42
+
+from django.db import migrations, models
+
+CHUNK_SIZE = 500
+
+
+def convert(apps, to_binary):
+    """Rewrite encrypted bodies between armored text and binary, CHUNK_SIZE rows at a time."""
+    import pgpy
+
+    Email = apps.get_model("mailapp", "Email")
+    rows = Email.objects.filter(is_encrypted=True, body_blob__isnull=to_binary).only("id", "body", "body_blob")
+    last = 0
+    while chunk := list(rows.filter(pk__gt=last).order_by("pk")[:CHUNK_SIZE]):
+        last = chunk[-1].pk
+        changed = []
+        for email in chunk:
+            try:
+                if to_binary:
+                    email.body_blob, email.body = bytes(pgpy.PGPMessage.from_blob(email.body)), ""
+                else:
+                    email.body, email.body_blob = str(pgpy.PGPMessage.from_blob(bytes(email.body_blob))), None
+            except Exception:
+                # Leave anything PGPy cannot parse as it is; it stays readable
+                continue
+            changed.append(email)
+        Email.objects.bulk_update(changed, ["body", "body_blob"])
+
+
+def dearmor_bodies(apps, schema_editor):
+    convert(apps, to_binary=True)
+
+
+def armor_bodies(apps, schema_editor):
+    convert(apps, to_binary=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailapp', '0004_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='email',
+            name='body_blob',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='email',
+            name='body',
+            field=models.TextField(blank=True),
+        ),
+        migrations.RunPython(dearmor_bodies, armor_bodies),
+    ]
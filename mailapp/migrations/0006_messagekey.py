@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:46
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailapp', '0005_binary_bodies'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customuser',
+            name='message_key_salt',
+            field=models.CharField(blank=True, max_length=32),
+        ),
+        migrations.CreateModel(
+            name='MessageKey',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('wrapped', models.BinaryField()),
+                ('email', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='message_keys', to='mailapp.email')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='message_keys', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('email', 'user'), name='unique_message_key')],
+            },
+        ),
+    ]
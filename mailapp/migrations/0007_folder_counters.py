@@ -0,0 +1,76 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:48
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+# Keep mailapp_foldercounter in step with mailapp_delivery. The triggers run
+# inside the statement that changes a delivery, so counts are updated
+# atomically on every write path (including bulk_create and cascades).
+CREATE_COUNTER_TRIGGERS = [
+    """
+    CREATE TRIGGER mailapp_counter_delivery_insert AFTER INSERT ON mailapp_delivery BEGIN
+        INSERT INTO mailapp_foldercounter (user_id, folder, total, unread)
+        VALUES (new.user_id, new.folder, 1, NOT new.is_read)
+        ON CONFLICT (user_id, folder) DO UPDATE SET total = total + 1, unread = unread + (NOT new.is_read);
+    END
+    """,
+    """
+    CREATE TRIGGER mailapp_counter_delivery_delete AFTER DELETE ON mailapp_delivery BEGIN
+        UPDATE mailapp_foldercounter SET total = total - 1, unread = unread - (NOT old.is_read)
+        WHERE user_id = old.user_id AND folder = old.folder;
+    END
+    """,
+    """
+    CREATE TRIGGER mailapp_counter_delivery_update AFTER UPDATE OF is_read, folder, user_id ON mailapp_delivery BEGIN
+        UPDATE mailapp_foldercounter SET total = total - 1, unread = unread - (NOT old.is_read)
+        WHERE user_id = old.user_id AND folder = old.folder;
+        INSERT INTO mailapp_foldercounter (user_id, folder, total, unread)
+        VALUES (new.user_id, new.folder, 1, NOT new.is_read)
+        ON CONFLICT (user_id, folder) DO UPDATE SET total = total + 1, unread = unread + (NOT new.is_read);
+    END
+    """,
+    """
+    INSERT INTO mailapp_foldercounter (user_id, folder, total, unread)
+    SELECT user_id, folder, COUNT(*), SUM(NOT is_read) FROM mailapp_delivery GROUP BY user_id, folder
+    """,
+]
+
+DROP_COUNTER_TRIGGERS = [
+    "DROP TRIGGER IF EXISTS mailapp_counter_delivery_insert",
+    "DROP TRIGGER IF EXISTS mailapp_counter_delivery_delete",
+    "DROP TRIGGER IF EXISTS mailapp_counter_delivery_update",
+]
+
+
+def run_sqlite(statements):
+    def run(apps, schema_editor):
+        # Other backends compute counts with aggregate queries instead
+        if schema_editor.connection.vendor == "sqlite":
+            for statement in statements:
+                schema_editor.execute(statement)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailapp', '0006_messagekey'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FolderCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('folder', models.CharField(choices=[('inbox', 'Inbox'), ('sent', 'Sent')], max_length=16)),
+                ('total', models.IntegerField(default=0)),
+                ('unread', models.IntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='folder_counters', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('user', 'folder'), name='unique_folder_counter')],
+            },
+        ),
+        migrations.RunPython(run_sqlite(CREATE_COUNTER_TRIGGERS), run_sqlite(DROP_COUNTER_TRIGGERS)),
+    ]
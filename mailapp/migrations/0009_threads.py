@@ -0,0 +1,188 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:18
+
+import datetime
+import re
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+# Keep each mailapp_thread's activity and counts in step with its deliveries,
+# in the same statement as the change (see migration 0007). Threads left
+# without deliveries are removed.
+CREATE_THREAD_TRIGGERS = [
+    """
+    CREATE TRIGGER mailapp_thread_delivery_insert AFTER INSERT ON mailapp_delivery
+    WHEN new.thread_id IS NOT NULL BEGIN
+        UPDATE mailapp_thread SET
+            message_count = message_count + 1,
+            unread_count = unread_count + (NOT new.is_read),
+            inbox_count = inbox_count + (new.folder = 'inbox'),
+            last_activity = max(last_activity, new.timestamp)
+        WHERE id = new.thread_id;
+    END
+    """,
+    """
+    CREATE TRIGGER mailapp_thread_delivery_delete AFTER DELETE ON mailapp_delivery
+    WHEN old.thread_id IS NOT NULL BEGIN
+        UPDATE mailapp_thread SET
+            message_count = message_count - 1,
+            unread_count = unread_count - (NOT old.is_read),
+            inbox_count = inbox_count - (old.folder = 'inbox'),
+            last_activity = coalesce(
+                (SELECT max(timestamp) FROM mailapp_delivery WHERE thread_id = old.thread_id), last_activity)
+        WHERE id = old.thread_id;
+        DELETE FROM mailapp_thread WHERE id = old.thread_id AND message_count = 0;
+    END
+    """,
+    """
+    CREATE TRIGGER mailapp_thread_delivery_update AFTER UPDATE OF is_read, folder, thread_id ON mailapp_delivery BEGIN
+        UPDATE mailapp_thread SET
+            message_count = message_count - 1,
+            unread_count = unread_count - (NOT old.is_read),
+            inbox_count = inbox_count - (old.folder = 'inbox')
+        WHERE id = old.thread_id;
+        UPDATE mailapp_thread SET
+            message_count = message_count + 1,
+            unread_count = unread_count + (NOT new.is_read),
+            inbox_count = inbox_count + (new.folder = 'inbox'),
+            last_activity = max(last_activity, new.timestamp)
+        WHERE id = new.thread_id;
+        UPDATE mailapp_thread SET last_activity = coalesce(
+            (SELECT max(timestamp) FROM mailapp_delivery WHERE thread_id = old.thread_id), last_activity)
+        WHERE id = old.thread_id AND old.thread_id IS NOT new.thread_id;
+        DELETE FROM mailapp_thread WHERE id = old.thread_id AND message_count = 0;
+    END
+    """,
+]
+
+DROP_THREAD_TRIGGERS = [
+    "DROP TRIGGER IF EXISTS mailapp_thread_delivery_insert",
+    "DROP TRIGGER IF EXISTS mailapp_thread_delivery_delete",
+    "DROP TRIGGER IF EXISTS mailapp_thread_delivery_update",
+]
+
+# Existing mail has no Message-ID headers, so it is threaded by subject only:
+# a reply or forward joins the latest thread with its subject, if active in
+# the last 30 days
+SUBJECT_PREFIX_RE = re.compile(r"^(\s*(re|fwd?|aw|sv)\s*(\[\d+\])?\s*:)+", re.I)
+SUBJECT_WINDOW = datetime.timedelta(days=30)
+BATCH_SIZE = 1000
+
+
+def backfill_threads(apps, schema_editor):
+    Delivery = apps.get_model("mailapp", "Delivery")
+    Thread = apps.get_model("mailapp", "Thread")
+    for user_id in Delivery.objects.values_list("user_id", flat=True).distinct().order_by():
+        threads = []
+        latest = {}  # subject key -> Thread
+        by_email = {}  # email id -> Thread, so mail to oneself is one thread
+        assigned = []  # (delivery id, Thread)
+        rows = Delivery.objects.filter(user_id=user_id).order_by("timestamp", "id").values_list(
+            "id", "timestamp", "is_read", "folder", "email_id", "email__subject",
+        )
+        for delivery_id, timestamp, is_read, folder, email_id, subject in rows.iterator(chunk_size=BATCH_SIZE):
+            stripped = SUBJECT_PREFIX_RE.sub("", subject).strip()
+            key = " ".join(stripped.lower().split())[:255]
+            thread = by_email.get(email_id) or latest.get(key)
+            if email_id not in by_email and not (
+                key and stripped != subject.strip() and thread and thread.last_activity >= timestamp - SUBJECT_WINDOW
+            ):
+                thread = Thread(user_id=user_id, subject=stripped[:255], subject_key=key, last_activity=timestamp)
+                threads.append(thread)
+            by_email[email_id] = thread
+            thread.last_activity = max(thread.last_activity, timestamp)
+            thread.message_count += 1
+            thread.unread_count += not is_read
+            thread.inbox_count += folder == "inbox"
+            if key:
+                latest[key] = thread
+            assigned.append((delivery_id, thread))
+        Thread.objects.bulk_create(threads, batch_size=BATCH_SIZE)
+        for start in range(0, len(assigned), BATCH_SIZE):
+            batch = [Delivery(id=delivery_id, thread_id=thread.id) for delivery_id, thread in assigned[start:start + BATCH_SIZE]]
+            Delivery.objects.bulk_update(batch, ["thread"])
+
+
+def run_sqlite(statements):
+    def run(apps, schema_editor):
+        # Other backends would need another way to keep thread counts
+        if schema_editor.connection.vendor == "sqlite":
+            for statement in statements:
+                schema_editor.execute(statement)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailapp', '0008_attachments'),
+    ]
+
+    operations = [
+        # Plain ADD COLUMNs: on SQLite AddField of a NOT NULL column rebuilds
+        # mailapp_email, which the search triggers (0004) do not survive
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunSQL(
+                    [
+                        "ALTER TABLE mailapp_email ADD COLUMN message_id varchar(255) NOT NULL DEFAULT ''",
+                        "ALTER TABLE mailapp_email ADD COLUMN in_reply_to varchar(255) NOT NULL DEFAULT ''",
+                        "ALTER TABLE mailapp_email ADD COLUMN \"references\" text NOT NULL DEFAULT ''",
+                        "CREATE INDEX mailapp_email_message_id_idx ON mailapp_email (message_id)",
+                    ],
+                    [
+                        "DROP INDEX mailapp_email_message_id_idx",
+                        "ALTER TABLE mailapp_email DROP COLUMN \"references\"",
+                        "ALTER TABLE mailapp_email DROP COLUMN in_reply_to",
+                        "ALTER TABLE mailapp_email DROP COLUMN message_id",
+                    ],
+                ),
+            ],
+            state_operations=[
+                migrations.AddField(
+                    model_name='email',
+                    name='in_reply_to',
+                    field=models.CharField(blank=True, max_length=255),
+                ),
+                migrations.AddField(
+                    model_name='email',
+                    name='message_id',
+                    field=models.CharField(blank=True, db_index=True, max_length=255),
+                ),
+                migrations.AddField(
+                    model_name='email',
+                    name='references',
+                    field=models.TextField(blank=True),
+                ),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Thread',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('subject', models.CharField(max_length=255)),
+                ('subject_key', models.CharField(max_length=255)),
+                ('last_activity', models.DateTimeField()),
+                ('message_count', models.IntegerField(default=0)),
+                ('unread_count', models.IntegerField(default=0)),
+                ('inbox_count', models.IntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='threads', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='delivery',
+            name='thread',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='deliveries', to='mailapp.thread'),
+        ),
+        migrations.AddIndex(
+            model_name='thread',
+            index=models.Index(fields=['user', '-last_activity', '-id'], name='thread_activity_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='thread',
+            index=models.Index(fields=['user', 'subject_key', '-last_activity'], name='thread_subject_idx'),
+        ),
+        migrations.RunPython(backfill_threads, migrations.RunPython.noop),
+        migrations.RunPython(run_sqlite(CREATE_THREAD_TRIGGERS), run_sqlite(DROP_THREAD_TRIGGERS)),
+    ]
@@ -0,0 +1,72 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:26
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailapp', '0009_threads'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customuser',
+            name='archive_after_days',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='customuser',
+            name='delete_after_days',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='ArchivedMessage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('email_id', models.BigIntegerField()),
+                ('folder', models.CharField(choices=[('inbox', 'Inbox'), ('sent', 'Sent')], max_length=16)),
+                ('timestamp', models.DateTimeField()),
+                ('offset', models.BigIntegerField()),
+                ('length', models.IntegerField()),
+                ('position', models.IntegerField()),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_messages', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ArchivedAttachment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('attachment_id', models.BigIntegerField(db_index=True)),
+                ('filename', models.CharField(max_length=255)),
+                ('content_type', models.CharField(max_length=100)),
+                ('key', models.BinaryField()),
+                ('blob', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='archived_attachments', to='mailapp.attachmentblob')),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='attachments', to='mailapp.archivedmessage')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ArchiveSegment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('size', models.BigIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archive_segments', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='archivedmessage',
+            name='segment',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='messages', to='mailapp.archivesegment'),
+        ),
+        migrations.AddIndex(
+            model_name='archivedmessage',
+            index=models.Index(fields=['user', 'timestamp'], name='archived_user_time_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='archivedmessage',
+            constraint=models.UniqueConstraint(fields=('user', 'email_id', 'folder'), name='unique_archived_message'),
+        ),
+    ]
@@ -1,4 +1,5 @@
 # mailapp/models.py
+from django.conf import settings
 from django.contrib.auth.models import AbstractUser
 from django.db import models
 
@@ -8,6 +9,14 @@ class CustomUser(AbstractUser):
     """
     pgp_private_key = models.TextField(blank=True, null=True)
     pgp_public_key = models.TextField(blank=True, null=True)
+    # Opt-in: add decrypted bodies to the (local, unencrypted) search index
+    index_message_bodies = models.BooleanField(default=False)
+    # Salt for the login-derived secret that wraps cached message session keys
+    message_key_salt = models.CharField(max_length=32, blank=True)
+    # Retention policy in days (see archive.py); None means the site-wide
+    # ARCHIVE_AFTER_DAYS / DELETE_AFTER_DAYS setting, 0 means never
+    archive_after_days = models.PositiveIntegerField(null=True, blank=True)
+    delete_after_days = models.PositiveIntegerField(null=True, blank=True)
 
     # Override default related_names to avoid clashes with auth.User
     groups = models.ManyToManyField(
@@ -28,6 +37,31 @@ class CustomUser(AbstractUser):
     def __str__(self):
         return self.username
 
+    @property
+    def keys_pending(self):
+        """True while the user's keypair is still being generated in the background."""
+        return not (self.pgp_public_key and self.pgp_private_key)
+
+
+class SpareKey(models.Model):
+    """
+    A pre-generated PGP key with no user id, waiting to be assigned on signup.
+    """
+    private_key = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Spare key {self.pk}"
+
+
+class EmailQuerySet(models.QuerySet):
+    # Columns needed to render a mailbox listing; the body is deliberately
+    # left out so listing never loads (or decrypts) ciphertext.
+    HEADER_FIELDS = ("id", "sender", "recipients", "subject", "timestamp", "is_read", "is_encrypted")
+
+    def headers(self):
+        return self.only(*self.HEADER_FIELDS)
+
 
 class Email(models.Model):
     """
@@ -36,10 +70,239 @@ class Email(models.Model):
     sender = models.EmailField()
     recipients = models.CharField(max_length=500)  # comma-separated emails
     subject = models.CharField(max_length=255)
-    body = models.TextField()
+    # Plaintext and armored ciphertext live in body; ciphertext stored as
+    # binary PGP packets (EMAIL_BINARY_BODIES) lives in body_blob instead
+    body = models.TextField(blank=True)
+    body_blob = models.BinaryField(null=True, blank=True)
     timestamp = models.DateTimeField(auto_now_add=True)
     is_read = models.BooleanField(default=False)
     is_encrypted = models.BooleanField(default=False)
+    # RFC 5322 threading headers: <id@host> values; references is a
+    # space-separated chain, oldest first
+    message_id = models.CharField(max_length=255, blank=True, db_index=True)
+    in_reply_to = models.CharField(max_length=255, blank=True)
+    references = models.TextField(blank=True)
+
+    objects = EmailQuerySet.as_manager()
 
     def __str__(self):
         return f"{self.subject} from {self.sender}"
+
+    @staticmethod
+    def body_fields(body):
+        """Model field values for a stored body: text, or binary ciphertext as bytes."""
+        if isinstance(body, bytes):
+            return {"body": "", "body_blob": body}
+        return {"body": body, "body_blob": None}
+
+    @property
+    def ciphertext(self):
+        """The stored PGP message, as bytes (binary) or str (armored)."""
+        if self.body_blob is not None:
+            return bytes(self.body_blob)
+        return self.body
+
+
+class Thread(models.Model):
+    """
+    A conversation in one user's mailbox (see threads.py).
+
+    Deliveries are assigned a thread when they are written. On SQLite the
+    activity time and counts are maintained by triggers on mailapp_delivery
+    (see migration 0009), like FolderCounter, so the threaded inbox pages
+    over the (user, last_activity) index.
+    """
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="threads")
+    subject = models.CharField(max_length=255)
+    # Lower-cased subject without Re:/Fwd: prefixes, for subject matching
+    subject_key = models.CharField(max_length=255)
+    last_activity = models.DateTimeField()
+    message_count = models.IntegerField(default=0)
+    unread_count = models.IntegerField(default=0)
+    inbox_count = models.IntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["user", "-last_activity", "-id"], name="thread_activity_idx"),
+            models.Index(fields=["user", "subject_key", "-last_activity"], name="thread_subject_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.subject} ({self.message_count}) for {self.user_id}"
+
+
+class DeliveryQuerySet(models.QuerySet):
+    HEADER_FIELDS = (
+        "id", "timestamp", "is_read", "folder", "email_id",
+        "email__sender", "email__recipients", "email__subject", "email__is_encrypted",
+    )
+
+    def headers(self):
+        return self.select_related("email").only(*self.HEADER_FIELDS)
+
+
+class Delivery(models.Model):
+    """
+    One copy of an email in a user's mailbox folder.
+
+    An email has one delivery per local recipient (folder "inbox") plus one
+    for its sender (folder "sent"). The email timestamp is copied here so
+    mailbox listings are served from the (user, folder, timestamp) index.
+    """
+    INBOX = "inbox"
+    SENT = "sent"
+    FOLDER_CHOICES = [(INBOX, "Inbox"), (SENT, "Sent")]
+
+    email = models.ForeignKey(Email, on_delete=models.CASCADE, related_name="deliveries")
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="deliveries")
+    folder = models.CharField(max_length=16, choices=FOLDER_CHOICES, default=INBOX)
+    is_read = models.BooleanField(default=False)
+    timestamp = models.DateTimeField()
+    thread = models.ForeignKey(Thread, null=True, blank=True, on_delete=models.SET_NULL, related_name="deliveries")
+
+    objects = DeliveryQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["user", "folder", "-timestamp", "-id"], name="delivery_mailbox_idx"),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=["email", "user", "folder"], name="unique_delivery"),
+        ]
+
+    def __str__(self):
+        return f"{self.email_id} in {self.user_id}/{self.folder}"
+
+
+class MessageKey(models.Model):
+    """
+    A message's symmetric session key, recorded the first time a user
+    decrypts it, so later reads skip the RSA step.
+
+    The key is wrapped (AES-GCM) under a secret derived from the user's
+    password at login, so it is useless without that user's session.
+    """
+    email = models.ForeignKey(Email, on_delete=models.CASCADE, related_name="message_keys")
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="message_keys")
+    wrapped = models.BinaryField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["email", "user"], name="unique_message_key"),
+        ]
+
+    def __str__(self):
+        return f"Key for {self.email_id} ({self.user_id})"
+
+
+class FolderCounter(models.Model):
+    """
+    Denormalised message counts for one of a user's folders.
+
+    On SQLite these rows are maintained by triggers on mailapp_delivery (see
+    migration 0007), so every insert, delete and read-state change updates
+    them in the same transaction. mailbox.folder_counts() reads them in O(1).
+    """
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="folder_counters")
+    folder = models.CharField(max_length=16, choices=Delivery.FOLDER_CHOICES)
+    total = models.IntegerField(default=0)
+    unread = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "folder"], name="unique_folder_counter"),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id}/{self.folder}: {self.unread}/{self.total}"
+
+
+class AttachmentBlob(models.Model):
+    """
+    Encrypted attachment content on disk (see attachments.py), stored once
+    however many messages carry the same file.
+
+    The id is an HMAC of the content hash, so equal files share a blob
+    without their hash being stored.
+    """
+    id = models.CharField(primary_key=True, max_length=64)
+    size = models.BigIntegerField()
+    chunk_size = models.IntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Blob {self.id[:12]} ({self.size} bytes)"
+
+
+class Attachment(models.Model):
+    """
+    A file attached to an email. `key` is the blob's AES key as a PGP
+    message encrypted to the email's readers, like the body.
+    """
+    email = models.ForeignKey(Email, on_delete=models.CASCADE, related_name="attachments")
+    blob = models.ForeignKey(AttachmentBlob, on_delete=models.PROTECT, related_name="attachments")
+    filename = models.CharField(max_length=255)
+    content_type = models.CharField(max_length=100)
+    key = models.BinaryField()
+
+    def __str__(self):
+        return f"{self.filename} on {self.email_id}"
+
+
+class ArchiveSegment(models.Model):
+    """
+    An append-only file of one user's archived messages, in compressed
+    blocks (see archive.py). Bytes past `size` belong to an append that
+    never committed and are overwritten by the next one.
+    """
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="archive_segments")
+    size = models.BigIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Segment {self.pk} of {self.user_id} ({self.size} bytes)"
+
+
+class ArchivedMessage(models.Model):
+    """
+    Index entry for one archived delivery: the block of its segment that
+    holds the message (offset and compressed length) and its position there.
+    """
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="archived_messages")
+    # The archived Email's id, which links keep using
+    email_id = models.BigIntegerField()
+    folder = models.CharField(max_length=16, choices=Delivery.FOLDER_CHOICES)
+    timestamp = models.DateTimeField()
+    segment = models.ForeignKey(ArchiveSegment, on_delete=models.CASCADE, related_name="messages")
+    offset = models.BigIntegerField()
+    length = models.IntegerField()
+    position = models.IntegerField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["user", "timestamp"], name="archived_user_time_idx"),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=["user", "email_id", "folder"], name="unique_archived_message"),
+        ]
+
+    def __str__(self):
+        return f"Archived {self.email_id} in {self.user_id}/{self.folder}"
+
+
+class ArchivedAttachment(models.Model):
+    """
+    An attachment of an archived message. Holds the same fields as
+    Attachment, so downloads work unchanged and the blob is kept.
+    """
+    message = models.ForeignKey(ArchivedMessage, on_delete=models.CASCADE, related_name="attachments")
+    # The archived Attachment's id, which links keep using
+    attachment_id = models.BigIntegerField(db_index=True)
+    blob = models.ForeignKey(AttachmentBlob, on_delete=models.PROTECT, related_name="archived_attachments")
+    filename = models.CharField(max_length=255)
+    content_type = models.CharField(max_length=100)
+    key = models.BinaryField()
+
+    def __str__(self):
+        return f"{self.filename} on archived {self.message_id}"
+
@@ -0,0 +1,112 @@
+"""
+The default crypto backend (see crypto.py), built on PGPy.
+
+Imported on first use of a key or message, since PGPy and its cryptography
+stack take longer to import than the rest of the app.
+"""
+import functools
+
+import pgpy
+from pgpy.constants import CompressionAlgorithm, HashAlgorithm, KeyFlags, PubKeyAlgorithm, SymmetricKeyAlgorithm
+
+KEY_SIZE = 2048
+
+# Symmetric cipher and compression for message bodies; both are in every
+# JyoMail key's preferences
+SESSION_CIPHER = SymmetricKeyAlgorithm.AES256
+COMPRESSION = CompressionAlgorithm.ZLIB
+
+
+def new_key():
+    """Generate a bare RSA primary key with no user id attached."""
+    return pgpy.PGPKey.new(PubKeyAlgorithm.RSAEncryptOrSign, KEY_SIZE)
+
+
+def add_user_id(key, email):
+    """Bind `email` to `key` with the preferences JyoMail advertises."""
+    key.add_uid(
+        pgpy.PGPUID.new(email),
+        usage={KeyFlags.Sign, KeyFlags.EncryptCommunications},
+        hashes=[HashAlgorithm.SHA256],
+        ciphers=[SymmetricKeyAlgorithm.AES256],
+        compression=[CompressionAlgorithm.ZLIB]
+    )
+    return key
+
+
+def load_key(armored):
+    return pgpy.PGPKey.from_blob(armored)[0]
+
+
+def armor_keypair(key):
+    return str(key.pubkey), str(key)
+
+
+def prepare_private_key(key):
+    """
+    Memoise the backend RSA object on a parsed private key, in place.
+
+    PGPy rebuilds (and re-validates) the cryptography private key from its
+    numbers on every operation, which costs far more than the RSA decryption
+    itself. Keys that are kept around (caches, pool workers) build it once.
+    """
+    for k in [key, *key.subkeys.values()]:
+        material = k._key.keymaterial
+        if hasattr(material, "__privkey__"):
+            material.__privkey__ = functools.lru_cache(maxsize=1)(material.__privkey__)
+    return key
+
+
+def encrypt(body, public_keys, binary=False):
+    """
+    Compress and encrypt body once under a fresh session key, then wrap that
+    session key for each public key.
+    """
+    session_key = SESSION_CIPHER.gen_key()
+    message = pgpy.PGPMessage.new(body, compression=COMPRESSION)
+    for public_key in public_keys:
+        message = public_key.encrypt(message, cipher=SESSION_CIPHER, sessionkey=session_key)
+    return bytes(message) if binary else str(message)
+
+
+def decrypt(ciphertext, private_key):
+    return private_key.decrypt(pgpy.PGPMessage.from_blob(ciphertext)).message
+
+
+def decrypt_session_key(message, private_key):
+    """
+    The RSA half of decryption: recover (cipher, session_key) from the
+    parsed PGPMessage's PKESK packet addressed to private_key (or a subkey).
+    """
+    encrypters = message.encrypters
+    for key in [private_key, *private_key.subkeys.values()]:
+        if key.fingerprint.keyid in encrypters:
+            pkesk = next(pk for pk in message._sessionkeys if pk.encrypter == key.fingerprint.keyid)
+            return pkesk.decrypt_sk(key._key)
+    raise pgpy.errors.PGPError("Cannot decrypt the provided message with this key")
+
+
+def _open_with_session_key(message, cipher, session_key):
+    # The symmetric half of decryption, as PGPKey.decrypt() does it
+    decrypted = pgpy.PGPMessage()
+    decrypted.parse(message.message.decrypt(session_key, cipher))
+    return decrypted.message
+
+
+def decrypt_and_key(ciphertext, private_key):
+    message = pgpy.PGPMessage.from_blob(ciphertext)
+    cipher, session_key = decrypt_session_key(message, private_key)
+    return _open_with_session_key(message, cipher, session_key), (int(cipher), bytes(session_key))
+
+
+def decrypt_with_session_key(ciphertext, cipher, session_key):
+    message = pgpy.PGPMessage.from_blob(ciphertext)
+    return _open_with_session_key(message, SymmetricKeyAlgorithm(cipher), session_key)
+
+
+def to_binary(armored):
+    return bytes(pgpy.PGPMessage.from_blob(armored))
+
+
+def to_armored(binary):
+    return str(pgpy.PGPMessage.from_blob(binary))
@@ -0,0 +1,111 @@
+"""
+Per-process cache of decrypted message bodies, so reopening a message skips
+the RSA decryption.
+
+Bodies are held AES-GCM encrypted under a random key that lives only in the
+user's session, so the in-memory cache alone never holds readable plaintext
+and nothing decrypted is written to disk. Entries expire after
+PREVIEW_CACHE_TTL seconds, the cache is LRU-bounded at PREVIEW_CACHE_SIZE
+entries, and a session's entries are dropped when the user logs out. The
+cache is off unless PREVIEW_CACHE_TTL is set.
+"""
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .crypto import aead
+
+SESSION_KEY = "_preview_cache_key"
+SESSION_TOKEN = "_preview_cache_token"
+
+
+class PreviewCache:
+    def __init__(self, maxsize=1000, ttl=0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.ttl > 0 and self.maxsize > 0
+
+    def _session_secret(self, session, create):
+        """Return (token, AESGCM) for the session, creating them on first use."""
+        if SESSION_KEY not in session:
+            if not create:
+                return None, None
+            session[SESSION_KEY] = secrets.token_bytes(32).hex()
+            session[SESSION_TOKEN] = secrets.token_hex(16)
+        return session[SESSION_TOKEN], aead(bytes.fromhex(session[SESSION_KEY]))
+
+    def get(self, session, user_id, email_id):
+        """Return the cached body for this session, or None."""
+        from cryptography.exceptions import InvalidTag
+
+        if not self.enabled:
+            return None
+        token, aead = self._session_secret(session, create=False)
+        cache_key = (token, user_id, email_id)
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is None or entry[0] < time.monotonic():
+                self._entries.pop(cache_key, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(cache_key)
+        try:
+            body = aead.decrypt(entry[1], entry[2], repr(cache_key).encode()).decode()
+        except InvalidTag:
+            with self._lock:
+                self._entries.pop(cache_key, None)
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return body
+
+    def put(self, session, user_id, email_id, body):
+        if not self.enabled:
+            return
+        token, aead = self._session_secret(session, create=True)
+        cache_key = (token, user_id, email_id)
+        nonce = os.urandom(12)
+        # The cache key is authenticated too, so entries cannot be swapped
+        sealed = aead.encrypt(nonce, body.encode(), repr(cache_key).encode())
+        with self._lock:
+            self._entries[cache_key] = (time.monotonic() + self.ttl, nonce, sealed)
+            self._entries.move_to_end(cache_key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear_session(self, session):
+        """Drop every entry cached for `session` (called on logout)."""
+        token = session.get(SESSION_TOKEN)
+        if token is None:
+            return
+        with self._lock:
+            for cache_key in [k for k in self._entries if k[0] == token]:
+                del self._entries[cache_key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries), "maxsize": self.maxsize}
+
+
+preview_cache = PreviewCache(
+    maxsize=getattr(settings, "PREVIEW_CACHE_SIZE", 1000),
+    ttl=getattr(settings, "PREVIEW_CACHE_TTL", 0),
+)
@@ -0,0 +1,89 @@
+"""
+Full-text search over a user's mailbox.
+
+On SQLite every delivery is indexed in the mailapp_search FTS5 table (see
+migration 0004), kept current by triggers on mailapp_delivery. Subjects,
+senders and plaintext bodies are indexed on delivery; decrypted bodies are
+added the first time a message is read, only for users who opted in with
+CustomUser.index_message_bodies. Other backends fall back to LIKE over headers.
+"""
+import re
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+
+from .models import Delivery
+
+TOKEN_RE = re.compile(r"\w+")
+
+
+def result_limit():
+    return getattr(settings, "SEARCH_RESULT_LIMIT", 50)
+
+
+def fts_available():
+    return connection.vendor == "sqlite"
+
+
+def match_expression(user, query):
+    """
+    Build an FTS5 MATCH expression from free text: every word becomes a prefix
+    term, all of which must match, scoped to the user's own deliveries.
+    Returns None if the query has no searchable words.
+    """
+    terms = TOKEN_RE.findall(query)
+    if not terms:
+        return None
+    return f"owner : u{user.pk} AND " + " ".join(f'"{term}"*' for term in terms)
+
+
+def search(user, query, limit=None):
+    """Return the user's deliveries matching `query`, newest first."""
+    limit = limit or result_limit()
+    if not fts_available():
+        return list(
+            Delivery.objects.headers()
+            .filter(user=user)
+            .filter(Q(email__subject__icontains=query) | Q(email__sender__icontains=query))
+            .order_by("-timestamp", "-id")[:limit]
+        )
+
+    expression = match_expression(user, query)
+    if expression is None:
+        return []
+    with connection.cursor() as cursor:
+        # Delivery ids grow with time, so rowid order is newest-first and lets
+        # FTS5 stop after `limit` hits instead of ranking every match.
+        cursor.execute(
+            "SELECT rowid FROM mailapp_search WHERE mailapp_search MATCH %s ORDER BY rowid DESC LIMIT %s",
+            [expression, limit],
+        )
+        ids = [row[0] for row in cursor.fetchall()]
+    deliveries = Delivery.objects.headers().in_bulk(ids)
+    return [deliveries[i] for i in ids if i in deliveries]
+
+
+def index_body(user, email, body):
+    """Add a decrypted body to the user's index entries for `email`, if they opted in."""
+    if not user.index_message_bodies or not fts_available():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "UPDATE mailapp_search SET body = %s WHERE rowid IN "
+            "(SELECT id FROM mailapp_delivery WHERE user_id = %s AND email_id = %s) AND body = ''",
+            [body, user.pk, email.pk],
+        )
+
+
+def forget_bodies(user):
+    """Remove every decrypted body from the user's index entries (on opt-out)."""
+    if not fts_available():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "UPDATE mailapp_search SET body = '' WHERE rowid IN "
+            "(SELECT d.id FROM mailapp_delivery d JOIN mailapp_email e ON e.id = d.email_id "
+            "WHERE d.user_id = %s AND e.is_encrypted)",
+            [user.pk],
+        )
@@ -0,0 +1,312 @@
+"""
+Asyncio SMTP listener that delivers incoming mail into local mailboxes.
+
+Each session runs as its own coroutine, so many clients are served
+concurrently, and commands are read line by line, so pipelined clients
+(RFC 2920) work as-is. Recipients are checked against CustomUser at RCPT
+time. Accepted messages go onto a bounded queue drained by a single writer
+task. The writer encrypts each message to its recipients' public keys and
+stores a whole batch with store_messages() in one transaction, using a
+process pool kept for the listener's lifetime. A batch that fails is retried
+one message at a time, so only the bad message is refused. A message is
+acknowledged only after its batch commits. When the queue is full, DATA
+waits for room, which pushes back on fast senders.
+"""
+import asyncio
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from email import policy
+from email.parser import BytesParser
+from email.utils import getaddresses, parseaddr
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from .mail_utils import Outgoing, parse_recipients, store_messages
+from .models import CustomUser
+from .threads import threading_headers
+
+logger = logging.getLogger(__name__)
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+class Envelope:
+    def __init__(self):
+        self.mail_from = None
+        self.recipients = []  # CustomUser instances accepted at RCPT
+
+
+class DeliveryQueue:
+    """Bounded queue of accepted messages, written to the database in batches."""
+
+    def __init__(self, maxsize, batch_size, batch_wait, crypto_workers):
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        # SQLite allows one writer at a time, so all writes go through one thread
+        self.db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="smtp-writer")
+        # One long-lived pool: store_messages() would otherwise start one per batch
+        self.crypto_workers = crypto_workers
+        self.crypto_executor = ProcessPoolExecutor(max_workers=crypto_workers) if crypto_workers > 1 else None
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        await self.queue.join()
+        self.task.cancel()
+        self.db_executor.shutdown()
+        if self.crypto_executor is not None:
+            self.crypto_executor.shutdown()
+
+    async def submit(self, message):
+        """Queue an Outgoing message; resolves once it has been committed."""
+        done = asyncio.get_running_loop().create_future()
+        await self.queue.put((message, done))
+        return await done
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.batch_wait
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                await self._write(batch)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    async def _write(self, batch):
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(self.db_executor, self._store, [m for m, _ in batch])
+        except Exception as e:
+            if len(batch) > 1:
+                # Retry one by one so a bad message fails alone, not its whole
+                # batch (as writer.WriteQueue does)
+                for entry in batch:
+                    await self._write([entry])
+                return
+            logger.exception("Failed to store message from %s", batch[0][0].sender_email)
+            if not batch[0][1].done():
+                batch[0][1].set_exception(e)
+            return
+        for _, done in batch:
+            if not done.done():
+                done.set_result(True)
+
+    def _store(self, messages):
+        close_old_connections()
+        store_messages(messages, is_encrypted=True, workers=self.crypto_workers, executor=self.crypto_executor)
+
+
+class SMTPSession:
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.envelope = Envelope()
+        self.greeted = False
+
+    async def reply(self, line):
+        self.writer.write(line.encode() + b"\r\n")
+        await self.writer.drain()
+
+    async def readline(self):
+        return await asyncio.wait_for(self.reader.readline(), self.server.idle_timeout)
+
+    async def run(self):
+        await self.reply(f"220 {self.server.hostname} JyoMail ESMTP ready")
+        while True:
+            line = await self.readline()
+            if not line:
+                return
+            command, _, arg = line.decode("utf-8", "replace").rstrip("\r\n").partition(" ")
+            handler = getattr(self, f"smtp_{command.upper()}", None)
+            if handler is None:
+                await self.reply("500 5.5.1 Command not recognized")
+                continue
+            if await handler(arg.strip()) is False:
+                return
+
+    async def smtp_HELO(self, arg):
+        self.greeted = True
+        self.envelope = Envelope()
+        await self.reply(f"250 {self.server.hostname}")
+
+    async def smtp_EHLO(self, arg):
+        self.greeted = True
+        self.envelope = Envelope()
+        self.writer.write(
+            f"250-{self.server.hostname}\r\n"
+            f"250-SIZE {self.server.max_message_size}\r\n"
+            "250-8BITMIME\r\n"
+            "250 PIPELINING\r\n".encode()
+        )
+        await self.writer.drain()
+
+    async def smtp_NOOP(self, arg):
+        await self.reply("250 2.0.0 OK")
+
+    async def smtp_RSET(self, arg):
+        self.envelope = Envelope()
+        await self.reply("250 2.0.0 OK")
+
+    async def smtp_QUIT(self, arg):
+        await self.reply("221 2.0.0 Bye")
+        return False
+
+    async def smtp_MAIL(self, arg):
+        if not self.greeted:
+            await self.reply("503 5.5.1 Send HELO/EHLO first")
+            return
+        if not arg.upper().startswith("FROM:"):
+            await self.reply("501 5.5.4 Syntax: MAIL FROM:<address>")
+            return
+        address = parseaddr(arg[5:].split(" ")[0])[1].lower()
+        self.envelope = Envelope()
+        self.envelope.mail_from = address
+        await self.reply("250 2.1.0 OK")
+
+    async def smtp_RCPT(self, arg):
+        if self.envelope.mail_from is None:
+            await self.reply("503 5.5.1 Need MAIL before RCPT")
+            return
+        if not arg.upper().startswith("TO:"):
+            await self.reply("501 5.5.4 Syntax: RCPT TO:<address>")
+            return
+        address = parseaddr(arg[3:])[1].lower()
+        user = await CustomUser.objects.filter(email__iexact=address).order_by("id").afirst()
+        if user is None:
+            await self.reply(f"550 5.1.1 <{address}>: no such user here")
+        elif user.keys_pending:
+            await self.reply(f"450 4.2.0 <{address}>: mailbox not ready, try again later")
+        else:
+            if user not in self.envelope.recipients:
+                self.envelope.recipients.append(user)
+            await self.reply("250 2.1.5 OK")
+
+    async def smtp_DATA(self, arg):
+        if not self.envelope.recipients:
+            await self.reply("503 5.5.1 Need RCPT before DATA")
+            return
+        await self.reply("354 End data with <CR><LF>.<CR><LF>")
+
+        lines = []
+        size = 0
+        while True:
+            line = await self.readline()
+            if not line:
+                return False
+            if line in (b".\r\n", b".\n"):
+                break
+            if line.startswith(b".."):
+                line = line[1:]
+            size += len(line)
+            if size <= self.server.max_message_size:
+                lines.append(line)
+
+        envelope, self.envelope = self.envelope, Envelope()
+        if size > self.server.max_message_size:
+            await self.reply("552 5.3.4 Message too big")
+            return
+        try:
+            message = self.server.build_message(envelope, b"".join(lines))
+        except Exception:
+            # Permanent: retrying the same bytes would fail the same way
+            logger.exception("Could not parse message from %s", envelope.mail_from)
+            await self.reply("554 5.6.0 Message could not be parsed")
+            return
+        try:
+            await self.server.queue.submit(message)
+        except Exception:
+            await self.reply("451 4.3.0 Temporary failure storing message")
+            return
+        await self.reply("250 2.0.0 Message accepted for delivery")
+
+
+def _body_text(part):
+    try:
+        return part.get_content()
+    except LookupError:
+        # Unknown charset
+        return (part.get_payload(decode=True) or b"").decode("utf-8", "replace")
+
+
+class SMTPServer:
+    def __init__(self, hostname="jyomail.local"):
+        self.hostname = hostname
+        self.max_message_size = _setting("SMTP_MAX_MESSAGE_SIZE", 10 * 1024 * 1024)
+        self.idle_timeout = _setting("SMTP_IDLE_TIMEOUT", 300)
+        self.sessions = asyncio.Semaphore(_setting("SMTP_MAX_SESSIONS", 1000))
+        self.queue = DeliveryQueue(
+            maxsize=_setting("SMTP_QUEUE_SIZE", 1000),
+            batch_size=_setting("SMTP_BATCH_SIZE", 200),
+            batch_wait=_setting("SMTP_BATCH_WAIT", 0.05),
+            crypto_workers=_setting("CRYPTO_WORKERS", None) or os.cpu_count() or 1,
+        )
+        self.server = None
+
+    def build_message(self, envelope, raw):
+        parsed = BytesParser(policy=policy.default).parsebytes(raw.replace(b"\r\n", b"\n"))
+        part = parsed.get_body(preferencelist=("plain", "html"))
+        # The To header is what the recipients see; fall back to the envelope
+        addresses = parse_recipients([a for _, a in getaddresses(parsed.get_all("To", []))])
+        # SMTP senders are unauthenticated, so mail is never filed in a local Sent folder
+        return Outgoing(
+            sender_email=envelope.mail_from,
+            sender=None,
+            addresses=addresses or [user.email.lower() for user in envelope.recipients],
+            subject=str(parsed.get("Subject", ""))[:255],
+            body=_body_text(part) if part is not None else "",
+            recipients=envelope.recipients,
+            **threading_headers(parsed),
+        )
+
+    async def handle(self, reader, writer):
+        if self.sessions.locked():
+            writer.write(b"421 4.3.2 Too many connections, try again later\r\n")
+            await writer.drain()
+            writer.close()
+            return
+        async with self.sessions:
+            try:
+                await SMTPSession(self, reader, writer).run()
+            except (asyncio.TimeoutError, ConnectionError, ValueError):
+                # Idle timeout, dropped connection or an over-long line
+                pass
+            finally:
+                writer.close()
+
+    async def start(self, host, port):
+        self.queue.start()
+        self.server = await asyncio.start_server(self.handle, host, port)
+        return self.server
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+        await self.queue.stop()
+
+
+async def serve(host="127.0.0.1", port=2525, hostname="jyomail.local"):
+    server = SMTPServer(hostname)
+    await server.start(host, port)
+    logger.info("SMTP listening on %s:%s", host, port)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
@@ -1,3 +1,405 @@
+"""
+Checks for the state kept by SQLite triggers on mailapp_delivery: the search
+index (migration 0004), folder counters (0007) and conversation threads
+(0009). A migration that rebuilds mailapp_delivery (an AlterField on SQLite,
+say) drops its triggers without an error, and these tests are what notice.
+
+Then round trips through mailbox pagination cursors, through an mbox
+export and import (mbox.py), through encrypted attachment storage and
+through the mail archive (archive.py).
+"""
+import base64
+import io
+import os
+import tempfile
+import zlib
+from datetime import timedelta
+from pathlib import Path
+from unittest import skipUnless
+
+from cryptography.exceptions import InvalidTag
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.db.models import Count, Q
 from django.test import TestCase
+from django.urls import reverse
+from django.utils import timezone
+
+from .archive import archive_user, iter_archived, purge_user, read_archived
+from .attachments import CHUNK_SIZE, TAG_SIZE, attachment_key, blob_path, iter_plaintext
+from .crypto import add_user_id, new_key
+from .mail_utils import Outgoing, install_key, send_local_email, store_messages
+from .mailbox import (
+    INBOX, InvalidCursor, all_folder_counts, mailbox_queryset, mark_read, paginate,
+    reconcile_counters,
+)
+from .mbox import export_mailbox, import_mailbox
+from .models import ArchivedMessage, ArchiveSegment, Attachment, CustomUser, Delivery, Email, Thread
+from .search import search
+
+DELIVERY_TRIGGERS = {
+    "mailapp_search_delivery_insert",
+    "mailapp_search_delivery_delete",
+    "mailapp_counter_delivery_insert",
+    "mailapp_counter_delivery_delete",
+    "mailapp_counter_delivery_update",
+    "mailapp_thread_delivery_insert",
+    "mailapp_thread_delivery_delete",
+    "mailapp_thread_delivery_update",
+}
+
+
+def send(sender, recipients, subject, body="hello", **headers):
+    """Store one plaintext message from sender to recipients (users); returns the Email."""
+    message = Outgoing(sender.email, sender, [user.email for user in recipients], subject, body,
+                       recipients, **headers)
+    return store_messages([message])[0]
+
+
+@skipUnless(connection.vendor == "sqlite", "the triggers are SQLite-only")
+class DeliveryTriggerTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = CustomUser.objects.create_user(username="alice@jyomail", email="alice@jyomail", password="pw")
+        cls.bob = CustomUser.objects.create_user(username="bob@jyomail", email="bob@jyomail", password="pw")
+
+    def assertConsistent(self):
+        # Folder counters
+        self.assertEqual(reconcile_counters(fix=False), [])
+        # Thread counts, against a recount of their deliveries
+        actual = {
+            row["thread_id"]: (row["messages"], row["unread"], row["inbox"])
+            for row in Delivery.objects.values("thread_id").order_by().annotate(
+                messages=Count("id"),
+                unread=Count("id", filter=Q(is_read=False)),
+                inbox=Count("id", filter=Q(folder=Delivery.INBOX)),
+            )
+        }
+        self.assertNotIn(None, actual)
+        stored = {
+            thread.id: (thread.message_count, thread.unread_count, thread.inbox_count)
+            for thread in Thread.objects.all()
+        }
+        self.assertEqual(stored, actual)
+        # One search index row per delivery
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT rowid FROM mailapp_search")
+            indexed = {row[0] for row in cursor.fetchall()}
+        self.assertEqual(indexed, set(Delivery.objects.values_list("id", flat=True)))
+
+    def test_triggers_exist(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name = 'mailapp_delivery'")
+            names = {row[0] for row in cursor.fetchall()}
+        self.assertLessEqual(DELIVERY_TRIGGERS, names)
+
+    def test_bulk_create(self):
+        send(self.alice, [self.bob], "Lunch", "pizza on friday")
+        send(self.alice, [self.alice, self.bob], "Note to self")
+        self.assertConsistent()
+        self.assertEqual(all_folder_counts(self.bob)["inbox"], {"total": 2, "unread": 2})
+        self.assertEqual(all_folder_counts(self.alice)["sent"], {"total": 2, "unread": 0})
+        self.assertEqual([d.email.subject for d in search(self.bob, "pizza")], ["Lunch"])
+
+    def test_reply_joins_thread(self):
+        email = send(self.alice, [self.bob], "Plans")
+        send(self.bob, [self.alice], "Re: Plans", in_reply_to=email.message_id,
+                  references=email.message_id)
+        self.assertConsistent()
+        thread = Thread.objects.get(user=self.alice)
+        self.assertEqual((thread.message_count, thread.inbox_count, thread.unread_count), (2, 1, 1))
+
+    def test_mark_read(self):
+        email = send(self.alice, [self.bob], "Hello")
+        mark_read(self.bob, email.id)
+        self.assertConsistent()
+        self.assertEqual(all_folder_counts(self.bob)["inbox"], {"total": 1, "unread": 0})
+        mark_read(self.bob, email.id, is_read=False)
+        self.assertConsistent()
+        self.assertEqual(Thread.objects.get(user=self.bob).unread_count, 1)
+
+    def test_delete(self):
+        first = send(self.alice, [self.bob], "One", "first body")
+        send(self.alice, [self.bob], "Two")
+        Delivery.objects.filter(user=self.bob, email=first).delete()
+        self.assertConsistent()
+        self.assertEqual(all_folder_counts(self.bob)["inbox"], {"total": 1, "unread": 1})
+        self.assertEqual(search(self.bob, "first"), [])
+        # Emptied threads are removed
+        self.assertEqual(Thread.objects.filter(user=self.bob).count(), 1)
+
+    def test_reconcile_counters_repairs_drift(self):
+        send(self.alice, [self.bob], "Hello")
+        self.assertEqual(reconcile_counters(), [])
+        self.bob.folder_counters.filter(folder=Delivery.INBOX).update(total=5)
+        drift = reconcile_counters()
+        self.assertEqual(drift, [(self.bob.id, Delivery.INBOX, (5, 1), (1, 1))])
+        self.assertEqual(reconcile_counters(fix=False), [])
+
+
+class PaginationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = CustomUser.objects.create_user(username="alice@jyomail", email="alice@jyomail", password="pw")
+        cls.bob = CustomUser.objects.create_user(username="bob@jyomail", email="bob@jyomail", password="pw")
+        for n in range(7):
+            send(cls.alice, [cls.bob], f"Message {n}")
+        # Five of them share a timestamp, so pages must split on the id
+        deliveries = Delivery.objects.filter(user=cls.bob).order_by("id")
+        start = timezone.now() - timedelta(days=1)
+        for n, delivery in enumerate(deliveries):
+            delivery.timestamp = start + timedelta(minutes=max(n - 4, 0))
+        Delivery.objects.bulk_update(deliveries, ["timestamp"])
+
+    def test_pages_cover_the_folder_once(self):
+        seen, cursor = [], None
+        while True:
+            page, cursor = paginate(mailbox_queryset(self.bob, INBOX), cursor, size=2)
+            seen += [delivery.email.subject for delivery in page]
+            if cursor is None:
+                break
+        self.assertEqual(seen, [f"Message {n}" for n in (6, 5, 4, 3, 2, 1, 0)])
+
+    def test_invalid_cursors(self):
+        for cursor in [
+            "not a cursor!",
+            base64.urlsafe_b64encode(b"no separator").decode(),
+            base64.urlsafe_b64encode(b"yesterday|12").decode(),
+            base64.urlsafe_b64encode(b"2024-01-01T00:00:00|twelve").decode(),
+            base64.urlsafe_b64encode(b"\xff\xfe|1").decode(),
+            base64.urlsafe_b64encode(b"2024-01-01T00:|5").decode(),
+        ]:
+            with self.subTest(cursor=cursor):
+                with self.assertRaises(InvalidCursor):
+                    paginate(mailbox_queryset(self.bob, INBOX), cursor)
+
+    def test_views_reject_invalid_cursors(self):
+        self.client.force_login(self.bob)
+        response = self.client.get(reverse("api_inbox"), {"cursor": "garbage"})
+        self.assertEqual(response.status_code, 400)
+        self.assertRedirects(self.client.get(reverse("inbox"), {"cursor": "garbage"}), reverse("inbox"))
+
+    def test_cursor_only_pages_the_users_own_mail(self):
+        # A cursor is just a position: reused by another user it pages their mail
+        page, cursor = paginate(mailbox_queryset(self.bob, INBOX), None, size=3)
+        response = self.client.get(reverse("api_inbox"), {"cursor": cursor})
+        self.assertEqual(response.status_code, 401)
+        self.client.force_login(self.alice)
+        response = self.client.get(reverse("api_inbox"), {"cursor": cursor})
+        self.assertEqual(response.json()["messages"], [])
+        self.client.force_login(self.bob)
+        response = self.client.get(reverse("api_inbox"), {"cursor": cursor})
+        self.assertEqual([m["subject"] for m in response.json()["messages"]],
+                         [f"Message {n}" for n in (3, 2, 1, 0)])
+
+
+class MboxTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = CustomUser.objects.create_user(username="alice@jyomail", email="alice@jyomail", password="pw")
+        cls.bob = CustomUser.objects.create_user(username="bob@jyomail", email="bob@jyomail", password="pw")
+
+    def mailbox(self, user):
+        return [
+            (d.folder, d.is_read, d.email.sender, d.email.recipients, d.email.subject, d.email.body,
+             d.email.message_id, d.email.in_reply_to, d.email.references, d.timestamp.replace(microsecond=0))
+            for d in Delivery.objects.filter(user=user).select_related("email").order_by("timestamp", "id")
+        ]
+
+    def test_round_trip(self):
+        first = send(self.alice, [self.bob], "Grüße", "From the top\n>From quoted\n\nlast line\n")
+        send(self.bob, [self.alice], "Re: Grüße", "thanks\n", in_reply_to=first.message_id,
+             references=first.message_id)
+        send(self.alice, [self.bob], "Plain", "no newline")
+        mark_read(self.bob, first.id)
+        out = io.BytesIO()
+        messages, written, failures = export_mailbox(self.bob, out)
+        self.assertEqual((messages, written, failures), (3, len(out.getvalue()), 0))
+
+        carol = CustomUser.objects.create_user(username="carol@jyomail", email="carol@jyomail", password="pw")
+        self.assertEqual(import_mailbox(carol, io.BytesIO(out.getvalue()))[::2], (3, 0))
+        expected = self.mailbox(self.bob)
+        # A body gains the final newline an mbox entry needs
+        expected[2] = expected[2][:5] + ("no newline\n",) + expected[2][6:]
+        self.assertEqual(self.mailbox(carol), expected)
+        # Imported replies thread like the originals
+        threads = Thread.objects.order_by("last_activity").values_list("subject", "message_count")
+        self.assertEqual(list(threads.filter(user=carol)), list(threads.filter(user=self.bob)))
+
+    def test_import_survives_bad_encodings(self):
+        mbox = (
+            b"From a@example.com Mon Jan 01 00:00:00 2024\n"
+            b"From: a@example.com\nSubject: =?x-unknown?q?hi?=\n"
+            b"Content-Type: text/plain; charset=x-unknown\n\nfirst\n\n"
+            b"From b@example.com Mon Jan 01 00:00:00 2024\n"
+            b"From: =?utf-8?q?B=FF?= <b@example.com>\nSubject: =?utf-8?q?caf=C3=A9?=\n\nsecond\n"
+        )
+        messages, _, skipped = import_mailbox(self.alice, io.BytesIO(mbox))
+        self.assertEqual((messages, skipped), (2, 0))
+        emails = Email.objects.order_by("id")
+        self.assertEqual([(e.subject, e.body) for e in emails], [("hi", "first\n"), ("café", "second\n")])
+        self.assertEqual(emails[1].sender, "B\ufffd <b@example.com>")
+
+
+class AttachmentTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = CustomUser.objects.create_user(username="alice@jyomail", email="alice@jyomail", password="pw")
+        install_key(cls.alice, add_user_id(new_key(), cls.alice.email))
+        cls.bob = CustomUser.objects.create_user(username="bob@jyomail", email="bob@jyomail", password="pw")
+
+    def setUp(self):
+        root = tempfile.TemporaryDirectory()
+        self.addCleanup(root.cleanup)
+        settings = self.settings(ATTACHMENT_ROOT=root.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        # Three chunks, the last one short
+        self.data = os.urandom(2 * CHUNK_SIZE + 100)
+        send_local_email(self.alice, [self.alice.email], "Files", "see attached", attachments=[
+            SimpleUploadedFile("data.bin", self.data, "application/octet-stream"),
+            SimpleUploadedFile("copy.bin", self.data, "application/octet-stream"),
+            SimpleUploadedFile("notes é.txt", b"From here\n", "text/plain"),
+        ])
+        self.attachment = Attachment.objects.select_related("blob").get(filename="data.bin")
+        self.key = attachment_key(self.attachment, self.alice)
+
+    def read(self, start, end):
+        return b"".join(iter_plaintext(self.attachment.blob, self.key, start, end))
+
+    def contents(self, user):
+        return {
+            (a.filename, a.content_type): b"".join(iter_plaintext(a.blob, attachment_key(a, user), 0, a.blob.size - 1))
+            for a in Attachment.objects.filter(email__deliveries__user=user).select_related("blob").distinct()
+        }
+
+    def test_chunks_round_trip(self):
+        size = len(self.data)
+        self.assertEqual(self.read(0, size - 1), self.data)
+        for start, end in [(0, 0), (CHUNK_SIZE - 10, CHUNK_SIZE + 10), (CHUNK_SIZE, 2 * CHUNK_SIZE - 1),
+                           (size - 1, size - 1)]:
+            with self.subTest(start=start, end=end):
+                self.assertEqual(self.read(start, end), self.data[start:end + 1])
+        # Identical files share one blob
+        copy = Attachment.objects.get(filename="copy.bin")
+        self.assertEqual(copy.blob_id, self.attachment.blob_id)
+        self.assertEqual(os.path.getsize(blob_path(self.attachment.blob_id)), size + 3 * TAG_SIZE)
+
+    def test_tampered_blob_fails(self):
+        path = blob_path(self.attachment.blob_id)
+        sealed = bytearray(path.read_bytes())
+        sealed[CHUNK_SIZE + TAG_SIZE + 5] ^= 1
+        path.write_bytes(bytes(sealed))
+        self.assertEqual(self.read(0, 99), self.data[:100])
+        with self.assertRaises(InvalidTag):
+            self.read(CHUNK_SIZE, CHUNK_SIZE)
+        # Dropping the short final chunk makes the new last chunk fail too
+        path.write_bytes(bytes(sealed[:2 * (CHUNK_SIZE + TAG_SIZE)]))
+        with self.assertRaises(InvalidTag):
+            self.read(0, len(self.data) - 1)
+
+    def test_range_responses(self):
+        size = len(self.data)
+        url = reverse("attachment", args=[self.attachment.id])
+        self.client.force_login(self.alice)
+        response = self.client.get(url)
+        self.assertEqual((response.status_code, response["Content-Length"]), (200, str(size)))
+        self.assertEqual(b"".join(response.streaming_content), self.data)
+        for header, start, end in [(f"bytes=100-{CHUNK_SIZE + 99}", 100, CHUNK_SIZE + 99),
+                                   ("bytes=-10", size - 10, size - 1),
+                                   (f"bytes={size - 5}-", size - 5, size - 1),
+                                   (f"bytes=0-{size + 1000}", 0, size - 1)]:
+            with self.subTest(header=header):
+                response = self.client.get(url, HTTP_RANGE=header)
+                self.assertEqual(response.status_code, 206)
+                self.assertEqual(response["Content-Range"], f"bytes {start}-{end}/{size}")
+                self.assertEqual(b"".join(response.streaming_content), self.data[start:end + 1])
+        response = self.client.get(url, HTTP_RANGE=f"bytes={size}-")
+        self.assertEqual((response.status_code, response["Content-Range"]), (416, f"bytes */{size}"))
+        # Only the message's readers can fetch it
+        self.client.force_login(self.bob)
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_mbox_round_trip(self):
+        expected = self.contents(self.alice)
+        for decrypt in (False, True):
+            with self.subTest(decrypt=decrypt):
+                out = io.BytesIO()
+                self.assertEqual(export_mailbox(self.alice, out, decrypt=decrypt)[2], 0)
+                # The export is ciphertext unless decryption was asked for
+                self.assertIs(base64.encodebytes(self.data[:57]) in out.getvalue(), decrypt)
+                Email.objects.all().delete()
+                self.assertEqual(import_mailbox(self.alice, io.BytesIO(out.getvalue()))[::2], (2, 0))
+                self.assertEqual(self.contents(self.alice), expected)
+                # A user without keys cannot store them
+                self.assertEqual(import_mailbox(self.bob, io.BytesIO(out.getvalue()))[::2], (2, 6))
+
+
+class ArchiveTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = CustomUser.objects.create_user(username="alice@jyomail", email="alice@jyomail", password="pw")
+        cls.bob = CustomUser.objects.create_user(username="bob@jyomail", email="bob@jyomail", password="pw")
+        # One a day, oldest first; small blocks so a segment holds several
+        now = timezone.now()
+        for n in range(6):
+            email = send(cls.alice, [cls.bob], f"Day {n}", f"body of day {n}\n")
+            Delivery.objects.filter(email=email).update(timestamp=now - timedelta(days=10 - n))
+        mark_read(cls.bob, Email.objects.get(subject="Day 1").id)
+
+    def setUp(self):
+        root = tempfile.TemporaryDirectory()
+        self.addCleanup(root.cleanup)
+        self.root = Path(root.name)
+        settings = self.settings(ARCHIVE_ROOT=self.root, ARCHIVE_BLOCK_SIZE=600)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def archived_text(self):
+        # Every block of the user's segment files, decompressed
+        text = b""
+        for path in self.root.glob(f"{self.bob.id}/*.seg"):
+            data = path.read_bytes()
+            while data:
+                block = zlib.decompressobj()
+                text += block.decompress(data)
+                data = block.unused_data
+        return text
+
+    def test_archive_and_read_back(self):
+        self.assertEqual(archive_user(self.bob, timezone.now() - timedelta(days=6.5)), 4)
+        self.assertEqual(Delivery.objects.filter(user=self.bob).count(), 2)
+        self.assertGreater(ArchivedMessage.objects.filter(user=self.bob).values("offset").distinct().count(), 1)
+        self.assertEqual(all_folder_counts(self.bob)["inbox"], {"total": 2, "unread": 2})
+        self.assertEqual(reconcile_counters(fix=False), [])
+
+        email, attachments = read_archived(self.bob, Email.objects.get(subject="Day 1").id)
+        self.assertEqual((email.subject, email.body, email.is_read), ("Day 1", "body of day 1\n", True))
+        self.assertEqual(attachments, [])
+        self.assertEqual([email.subject for _, email in iter_archived(self.bob)], [f"Day {n}" for n in range(4)])
+        # Alice's copies stay hot
+        self.assertIsNone(read_archived(self.alice, email.id))
+        self.assertEqual(Delivery.objects.filter(user=self.alice).count(), 6)
+
+        out = io.BytesIO()
+        self.assertEqual(export_mailbox(self.bob, out)[0], 6)
+        self.assertLess(out.getvalue().index(b"Subject: Day 0"), out.getvalue().index(b"Subject: Day 5"))
+
+    def test_purge_compacts_segments(self):
+        archive_user(self.bob, timezone.now())
+        segment = ArchiveSegment.objects.get(user=self.bob)
+        self.assertIn(b"body of day 0", self.archived_text())
+
+        self.assertEqual(purge_user(self.bob, timezone.now() - timedelta(days=7.5)), 3)
+        self.assertEqual([email.subject for _, email in iter_archived(self.bob)], ["Day 3", "Day 4", "Day 5"])
+        self.assertIsNone(read_archived(self.bob, Email.objects.get(subject="Day 0").id))
+        # The remaining messages moved to a new segment, without the purged ones
+        self.assertFalse(ArchiveSegment.objects.filter(pk=segment.pk).exists())
+        text = self.archived_text()
+        self.assertNotIn(b"body of day 0", text)
+        self.assertIn(b"body of day 5", text)
 
-# Create your tests here.
+        self.assertEqual(purge_user(self.bob, timezone.now()), 3)
+        self.assertFalse(ArchiveSegment.objects.filter(user=self.bob).exists())
+        self.assertEqual(list(self.root.glob(f"{self.bob.id}/*.seg")), [])
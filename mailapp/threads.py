@@ -0,0 +1,159 @@
+"""
+Conversation threading.
+
+Every delivery joins one of its owner's threads when it is written
+(assign_threads, called before the deliveries are inserted):
+
+1. the thread of the user's other copy of the same message (mail to
+   oneself has an inbox and a sent delivery), if any;
+2. the thread of the newest message it refers to, from In-Reply-To and
+   References, that the user also has;
+3. otherwise, for replies and forwards ("Re:", "Fwd:", or reply headers that
+   match nothing), the user's latest thread with the same subject, if it was
+   active within THREAD_SUBJECT_DAYS;
+4. otherwise a new thread.
+
+Thread activity and message/unread counts are then kept by triggers on
+mailapp_delivery (migration 0009), so listing threads reads a page of the
+(user, last_activity) index instead of grouping messages. As with the folder
+counters, the triggers are SQLite-only.
+"""
+import re
+from datetime import timedelta
+from email.utils import make_msgid
+
+from django.conf import settings
+from django.db.models import F
+
+from .models import Delivery, Thread
+
+# Reply/forward prefixes, including "Re[2]:" and localised AW:/SV:
+SUBJECT_PREFIX_RE = re.compile(r"^(\s*(re|fwd?|aw|sv)\s*(\[\d+\])?\s*:)+", re.I)
+MESSAGE_ID_RE = re.compile(r"<[^<>\s]+>")
+
+# Message ids kept in a References chain (the oldest are dropped)
+MAX_REFERENCES = 20
+
+
+def subject_window():
+    return timedelta(days=getattr(settings, "THREAD_SUBJECT_DAYS", 30))
+
+
+def new_message_id():
+    return make_msgid(domain=getattr(settings, "MESSAGE_ID_DOMAIN", "jyomail.local"))
+
+
+def strip_prefixes(subject):
+    """(subject without Re:/Fwd: prefixes, whether it had any)."""
+    stripped = SUBJECT_PREFIX_RE.sub("", subject).strip()
+    return stripped, stripped != subject.strip()
+
+
+def subject_key(subject):
+    return " ".join(subject.lower().split())[:255]
+
+
+def parse_message_ids(value):
+    """The <id> tokens of a Message-ID, In-Reply-To or References header."""
+    return [token for token in MESSAGE_ID_RE.findall(str(value or "")) if len(token) <= 255]
+
+
+def threading_headers(message):
+    """Email field values from a parsed message's threading headers."""
+    message_ids = parse_message_ids(message.get("Message-ID"))
+    in_reply_to = parse_message_ids(message.get("In-Reply-To"))
+    references = parse_message_ids(message.get("References"))
+    return {
+        "message_id": message_ids[0] if message_ids else "",
+        "in_reply_to": in_reply_to[0] if in_reply_to else "",
+        "references": " ".join(references[-MAX_REFERENCES:]),
+    }
+
+
+def reply_headers(parent):
+    """(in_reply_to, references) for a reply to the Email `parent`."""
+    if not parent.message_id:
+        return "", ""
+    references = parse_message_ids(parent.references) + [parent.message_id]
+    return parent.message_id, " ".join(references[-MAX_REFERENCES:])
+
+
+def reply_subject(subject):
+    return subject if strip_prefixes(subject)[1] else f"Re: {subject}"[:255]
+
+
+def _referenced(email):
+    # Newest first: In-Reply-To, then References from the end
+    ids = parse_message_ids(email.references)[::-1]
+    if email.in_reply_to:
+        ids.insert(0, email.in_reply_to)
+    return ids
+
+
+def assign_threads(deliveries):
+    """
+    Set .thread on unsaved deliveries (each with a saved .email), creating
+    new threads as needed. Deliveries are taken in order, so a reply later in
+    the same batch joins its parent's thread. At most three queries per batch.
+    """
+    deliveries = [delivery for delivery in deliveries if delivery.thread_id is None]
+    if not deliveries:
+        return
+    user_ids = {delivery.user_id for delivery in deliveries}
+    parsed = [(delivery, _referenced(delivery.email), *strip_prefixes(delivery.email.subject))
+              for delivery in deliveries]
+
+    by_reference = {}  # (user_id, message_id) -> Thread
+    # A message's own id too: a user's inbox and sent copies of the same
+    # email (mail to oneself) share a thread
+    references = {ref for _, refs, _, _ in parsed for ref in refs}
+    references |= {delivery.email.message_id for delivery in deliveries} - {""}
+    if references:
+        threads = Thread.objects.filter(
+            user_id__in=user_ids, deliveries__email__message_id__in=references,
+        ).annotate(message_id=F("deliveries__email__message_id"))
+        for thread in threads:
+            by_reference[thread.user_id, thread.message_id] = thread
+
+    by_subject = {}  # (user_id, subject_key) -> latest Thread
+    keys = {subject_key(subject) for _, refs, subject, is_reply in parsed if is_reply or refs} - {""}
+    if keys:
+        oldest = min(delivery.timestamp for delivery in deliveries) - subject_window()
+        threads = Thread.objects.filter(
+            user_id__in=user_ids, subject_key__in=keys, last_activity__gte=oldest,
+        ).order_by("last_activity")
+        for thread in threads:
+            by_subject[thread.user_id, thread.subject_key] = thread
+
+    new_threads = []
+    for delivery, refs, subject, is_reply in parsed:
+        user_id = delivery.user_id
+        key = subject_key(subject)
+        thread = by_reference.get((user_id, delivery.email.message_id)) if delivery.email.message_id else None
+        if thread is None:
+            thread = next((by_reference[user_id, ref] for ref in refs if (user_id, ref) in by_reference), None)
+        if thread is None and (is_reply or refs) and key:
+            thread = by_subject.get((user_id, key))
+            if thread is not None and thread.last_activity < delivery.timestamp - subject_window():
+                thread = None
+        if thread is None:
+            thread = Thread(user_id=user_id, subject=subject[:255], subject_key=key,
+                            last_activity=delivery.timestamp)
+            new_threads.append(thread)
+        thread.last_activity = max(thread.last_activity, delivery.timestamp)
+        if key:
+            by_subject[user_id, key] = thread
+        if delivery.email.message_id:
+            by_reference[user_id, delivery.email.message_id] = thread
+        delivery.thread = thread
+    Thread.objects.bulk_create(new_threads)
+
+
+def thread_queryset(user):
+    """The user's conversations with mail in the inbox, most recently active first."""
+    return Thread.objects.filter(user=user, inbox_count__gt=0).order_by("-last_activity", "-id")
+
+
+def thread_deliveries(user, thread):
+    """Header-only deliveries of one of the user's threads, oldest first."""
+    return Delivery.objects.headers().filter(user=user, thread=thread).order_by("timestamp", "id")
@@ -1,12 +1,30 @@
+from django.conf import settings
 from django.urls import path
 from . import views
 
+# Under ASGI the mailbox views are served by their async versions
+mailbox_views = views
+if getattr(settings, "ASYNC_VIEWS", False):
+    from . import async_views as mailbox_views
+
 urlpatterns = [
     path("signup/", views.signup_view, name="signup"),
     path("login/", views.login_view, name="login"),
     path("logout/", views.logout_view, name="logout"),
-    path("", views.inbox_view, name="inbox"),
-    path("sent/", views.sent_view, name="sent"),
-    path("email/<int:email_id>/", views.email_detail_view, name="email_detail"),
-    path('compose/', views.compose_email_view, name='compose'),
+    path("", mailbox_views.inbox_view, name="inbox"),
+    path("sent/", mailbox_views.sent_view, name="sent"),
+    path("threads/", mailbox_views.threads_view, name="threads"),
+    path("thread/<int:thread_id>/", mailbox_views.thread_view, name="thread"),
+    path("email/<int:email_id>/", mailbox_views.email_detail_view, name="email_detail"),
+    path("attachment/<int:attachment_id>/", mailbox_views.attachment_view, name="attachment"),
+    path('compose/', mailbox_views.compose_email_view, name='compose'),
+    path("search/", views.search_view, name="search"),
+    path("api/search", views.search_api_view, name="api_search"),
+    path("api/inbox", views.mailbox_api_view, {"folder": "inbox"}, name="api_inbox"),
+    path("api/sent", views.mailbox_api_view, {"folder": "sent"}, name="api_sent"),
+    path("metrics", views.metrics_view, name="metrics"),
 ]
+
+# Server-Sent Events need a long-lived async response, so only under ASGI
+if getattr(settings, "ASYNC_VIEWS", False):
+    urlpatterns.append(path("events/", mailbox_views.events_view, name="events"))
@@ -1,9 +1,25 @@
+from django.conf import settings
 from django.contrib.auth.decorators import login_required
+from django.core.exceptions import PermissionDenied
+from django.http import Http404, HttpResponse, JsonResponse
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth import authenticate, login, logout, get_user_model
-from .models import CustomUser, Email
-from .mail_utils import generate_keys, fetch_inbox, send_local_email, decrypt_email
+from .attachments import attachment_key, attachment_response
+from .archive import read_archived
+from .models import ArchivedAttachment, Attachment, Email, Thread
+from .search import forget_bodies, search
+from .mailbox import (
+    INBOX, SENT, InvalidCursor, delivery_json, folder_counts, mailbox_queryset, mark_read, paginate,
+)
+from . import metrics
+from .events import broker
+from .keycache import key_cache
+from .keygen import assign_keys
+from .mail_utils import parse_recipients, resolve_recipients, send_local_email, read_email_body, write_queue
+from .messagekeys import remember_secret
+from .previewcache import preview_cache
 from .forms import SignupForm, LoginForm, ComposeForm
+from .threads import reply_subject, thread_deliveries, thread_queryset
 
 User = get_user_model()
 
@@ -12,7 +28,8 @@ def signup_view(request):
         form = SignupForm(request.POST)
         if form.is_valid():
             user = form.save()
-            generate_keys(user)
+            # Keys come from the spare pool or are generated in the background
+            assign_keys(user)
             return redirect("login")
     else:
         form = SignupForm()
@@ -24,119 +41,201 @@ def login_view(request):
         if form.is_valid():
             user = form.get_user()
             login(request, user)
+            remember_secret(request.session, user, form.cleaned_data["password"])
             return redirect("inbox")
     else:
         form = LoginForm()
     return render(request, "login.html", {"form": form})
 
 def logout_view(request):
+    preview_cache.clear_session(request.session)
     logout(request)
     return redirect("login")
 
+def _mailbox_page(request, folder, template):
+    # Only header columns are loaded; bodies are decrypted on the detail page.
+    try:
+        page, next_cursor = paginate(mailbox_queryset(request.user, folder), request.GET.get("cursor"))
+    except InvalidCursor:
+        return redirect(folder)
+    return render(request, template, {
+        "inbox": page,
+        "next_cursor": next_cursor,
+        "counts": folder_counts(request.user, folder),
+    })
+
 @login_required
 def inbox_view(request):
+    return _mailbox_page(request, INBOX, "inbox.html")
+
+@login_required
+def sent_view(request):
+    return _mailbox_page(request, SENT, "sent.html")
+
+@login_required
+def threads_view(request):
+    # A page of the (user, last_activity) thread index; counts are kept on the rows
+    try:
+        page, next_cursor = paginate(thread_queryset(request.user), request.GET.get("cursor"), field="last_activity")
+    except InvalidCursor:
+        return redirect("threads")
+    return render(request, "threads.html", {"threads": page, "next_cursor": next_cursor})
+
+@login_required
+def thread_view(request, thread_id):
+    thread = get_object_or_404(Thread, id=thread_id, user=request.user)
+    return render(request, "thread.html", {
+        "thread": thread,
+        "deliveries": list(thread_deliveries(request.user, thread)),
+    })
+
+def mailbox_api_view(request, folder):
     user = request.user
-    # Fetch emails where recipients exactly match the logged-in user's email
-    emails = Email.objects.filter(recipients__iexact=user.email).order_by('-timestamp')
-
-    inbox = []
-
-    for mail in emails:
-        body = mail.body
-        if mail.is_encrypted:
-            try:
-                body = decrypt_email(mail.body, user)
-            except Exception as e:
-                # If decryption fails, show a placeholder
-                body = f"[Encrypted – cannot decrypt: {e}]"
-
-        inbox.append({
-            "id": mail.id,
-            "from": mail.sender,
-            "to": mail.recipients,
-            "subject": mail.subject,
-            "body": body,
-            "timestamp": mail.timestamp,
-            "is_read": mail.is_read,
-        })
+    if not user.is_authenticated:
+        return JsonResponse({"error": "Authentication required."}, status=401)
+    try:
+        page, next_cursor = paginate(mailbox_queryset(user, folder), request.GET.get("cursor"))
+    except InvalidCursor as e:
+        return JsonResponse({"error": str(e)}, status=400)
 
-    return render(request, "inbox.html", {"inbox": inbox})
+    data = {
+        "messages": [delivery_json(delivery) for delivery in page],
+        "next_cursor": next_cursor,
+    }
+    if not request.GET.get("cursor"):
+        data["counts"] = folder_counts(user, folder)
+    return JsonResponse(data)
 
 @login_required
-def sent_view(request):
+def search_view(request):
     user = request.user
-    # Fetch emails where sender matches the logged-in user's email
-    emails = Email.objects.filter(sender__iexact=user.email).order_by('-timestamp')
-
-    sent_box = []
-
-    for mail in emails:
-        body = mail.body
-        # Decrypt if possible (though sender usually has the key, we'll keep logic consistent)
-        if mail.is_encrypted:
-            try:
-                body = decrypt_email(mail.body, user)
-            except Exception as e:
-                body = f"[Encrypted – cannot decrypt: {e}]"
-
-        sent_box.append({
-            "id": mail.id,
-            "from": mail.sender,
-            "to": mail.recipients,
-            "subject": mail.subject,
-            "body": body,
-            "timestamp": mail.timestamp,
-            "is_read": True,
-        })
+    if request.method == "POST":
+        # Toggle indexing of decrypted bodies
+        user.index_message_bodies = request.POST.get("index_message_bodies") == "on"
+        user.save(update_fields=["index_message_bodies"])
+        if not user.index_message_bodies:
+            forget_bodies(user)
+        return redirect("search")
 
-    return render(request, "sent.html", {"inbox": sent_box})
+    query = request.GET.get("q", "").strip()
+    return render(request, "search.html", {
+        "query": query,
+        "results": search(user, query) if query else [],
+    })
+
+def search_api_view(request):
+    user = request.user
+    if not user.is_authenticated:
+        return JsonResponse({"error": "Authentication required."}, status=401)
+    query = request.GET.get("q", "").strip()
+    results = search(user, query) if query else []
+    return JsonResponse({"messages": [delivery_json(delivery) for delivery in results]})
 
 def email_detail_view(request, email_id):
     user = request.user
     if not user.is_authenticated:
         return redirect("login")
-    email = get_object_or_404(Email, id=email_id)
-    body = email.body
-    if email.is_encrypted:
-        try:
-            body = decrypt_email(body, user)
-        except Exception as e:
-            body = f"[Encrypted email – cannot decrypt: {e}]"
-
-    return render(request, "email_detail.html", {
+    # Only the sender and recipients of an email have a delivery for it
+    email = Email.objects.filter(deliveries__user=user).distinct().filter(id=email_id).first()
+    if email is None:
+        # Old mail is read from the user's archive, as is
+        archived = read_archived(user, email_id)
+        if archived is None:
+            raise Http404("No Email matches the given query.")
+        email, attachments = archived
+        body = read_email_body(email, user, request.session, archived=True)
+        return render(request, "email_detail.html", _email_context(email, body, attachments, archived=True))
+    if request.method == "POST":
+        # Mark-as-read/unread action from the detail page
+        is_read = request.POST.get("action") != "unread"
+        mark_read(user, email.id, is_read)
+        return redirect("email_detail", email_id=email.id) if is_read else redirect("inbox")
+    # Opening a message marks it read
+    mark_read(user, email.id)
+    body = read_email_body(email, user, request.session)
+    attachments = list(email.attachments.select_related("blob"))
+
+    return render(request, "email_detail.html", _email_context(email, body, attachments))
+
+def _email_context(email, body, attachments=(), archived=False):
+    return {
         "email": {
             "id": email.id,
             "sender": email.sender,
             "recipients": email.recipients,
             "subject": email.subject,
             "body": body,
-            "is_read": email.is_read
-        }
-    })
+            "timestamp": email.timestamp,
+            "is_read": email.is_read,
+            "is_encrypted": email.is_encrypted,
+        },
+        # Archived attachments keep the id of the attachment they replaced
+        "attachments": [
+            {"id": attachment.attachment_id if archived else attachment.id,
+             "filename": attachment.filename, "size": attachment.blob.size}
+            for attachment in attachments
+        ],
+        "archived": archived,
+    }
+
+def attachment_view(request, attachment_id):
+    user = request.user
+    if not user.is_authenticated:
+        return redirect("login")
+    # Readable by whoever can read its email
+    attachments = Attachment.objects.select_related("blob").filter(email__deliveries__user=user).distinct()
+    attachment = attachments.filter(id=attachment_id).first() or get_object_or_404(
+        ArchivedAttachment.objects.select_related("blob"), attachment_id=attachment_id, message__user=user,
+    )
+    key = attachment_key(attachment, user)
+    if key is None:
+        raise PermissionDenied("This attachment cannot be decrypted with your key.")
+    return attachment_response(attachment, key, request.headers.get("Range"))
+
+def send_compose_form(sender, form):
+    """Send a validated ComposeForm; on failure add errors to the form and return False."""
+    recipient_emails = form.cleaned_data["recipients"]
+    subject = form.cleaned_data["subject"]
+    body = form.cleaned_data["body"]
+    attachments = form.cleaned_data["attachments"]
+    parent = None
+    if form.cleaned_data["in_reply_to"]:
+        parent = Email.objects.filter(deliveries__user=sender, id=form.cleaned_data["in_reply_to"]).first()
+
+    # Make sure sender and recipients have keys, without waiting on keygen
+    assign_keys(sender)
+    addresses = parse_recipients(recipient_emails)
+    users = resolve_recipients(addresses)
+    for email in addresses:
+        recipient = users.get(email)
+        if recipient is None:
+            form.add_error("recipients", f"User '{email}' does not exist.")
+            return False
+        if not assign_keys(recipient):
+            form.add_error("recipients", f"Encryption keys for '{email}' are still being generated. Try again shortly.")
+            return False
+
+    # Send encrypted email
+    return send_local_email(sender, recipient_emails, subject, body, is_encrypted=True,
+                            attachments=attachments, in_reply_to=parent)
+
+def reply_initial(user, email_id):
+    """Initial ComposeForm data for replying to one of the user's emails."""
+    parent = Email.objects.filter(deliveries__user=user, id=email_id).first()
+    if parent is None:
+        return {}
+    # Answering your own sent mail goes back to its recipients
+    to = parent.recipients if parent.sender.lower() == user.email.lower() else parent.sender
+    return {"recipients": to, "subject": reply_subject(parent.subject), "in_reply_to": parent.id}
 
 @login_required
 def compose_email_view(request):
     context = {}
     if request.method == "POST":
-        form = ComposeForm(request.POST)
+        form = ComposeForm(request.POST, request.FILES)
         if form.is_valid():
-            sender = request.user
-            recipient_emails = form.cleaned_data["recipients"]
-            subject = form.cleaned_data["subject"]
-            body = form.cleaned_data["body"]
-
-            # Generate keys for sender and recipients
-            generate_keys(sender)
-            for email in recipient_emails.split(","):
-                try:
-                    recipient = CustomUser.objects.get(email=email.strip())
-                    generate_keys(recipient)
-                except CustomUser.DoesNotExist:
-                    form.add_error("recipients", f"User '{email.strip()}' does not exist.")
-                    return render(request, "compose.html", {"form": form})
-
-            # Send encrypted email
-            send_local_email(sender, recipient_emails, subject, body, is_encrypted=True)
+            if not send_compose_form(request.user, form):
+                return render(request, "compose.html", {"form": form})
             context["success"] = "Email sent successfully!"
             form = ComposeForm() # Reset form
             context["form"] = form
@@ -145,7 +244,20 @@ def compose_email_view(request):
             context["form"] = form
             return render(request, "compose.html", context)
     else:
-        form = ComposeForm()
+        reply_to = request.GET.get("reply_to", "")
+        form = ComposeForm(initial=reply_initial(request.user, reply_to) if reply_to.isdigit() else None)
     
     context["form"] = form
-    return render(request, "compose.html", context)
\ No newline at end of file
+    return render(request, "compose.html", context)
+
+def metrics_view(request):
+    """Prometheus scrape endpoint (see metrics.py), open to METRICS_ALLOWED_IPS only."""
+    if request.META.get("REMOTE_ADDR") not in getattr(settings, "METRICS_ALLOWED_IPS", ["127.0.0.1", "::1"]):
+        return HttpResponse(status=403)
+    stats = {
+        "key_cache": key_cache.stats(),
+        "preview_cache": preview_cache.stats(),
+        "write_queue": write_queue.stats(),
+        "sse": {"connections": broker.connections()},
+    }
+    return HttpResponse(metrics.render(stats), content_type="text/plain; version=0.0.4")
@@ -0,0 +1,72 @@
+"""
+Single-writer queue that group-commits concurrent web sends.
+
+SQLite admits one writer at a time. When every request thread opens its own
+write transaction they take the database lock in turn, each paying for its
+own commit, and past the busy timeout they fail with "database is locked".
+With DB_WRITE_QUEUE on, send_local_email encrypts in the request thread and
+queues the finished message. Whichever waiting sender holds the process's
+write lock commits everything queued so far in a single transaction, so
+while one batch is being written the next one builds up behind it. As with
+the SMTP server's DeliveryQueue, a send returns only once its rows have
+committed.
+"""
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+
+class WriteQueue:
+    def __init__(self, store, enabled=False, batch_size=200):
+        # store(items) writes a list of items in one transaction and returns
+        # one result per item
+        self.store = store
+        self.enabled = enabled
+        self.batch_size = batch_size
+        self.batches = 0
+        self.items = 0
+        self._queue = queue.SimpleQueue()
+        self._write_lock = threading.Lock()
+
+    def submit(self, *item):
+        """Queue one item and block until its batch has committed; returns its result."""
+        future = Future()
+        self._queue.put((item, future))
+        while not future.done():
+            with self._write_lock:
+                # The previous holder may have written this item already
+                if not future.done():
+                    self._write(self._drain())
+        return future.result()
+
+    def _drain(self):
+        batch = []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        try:
+            results = self.store([item for item, _ in batch])
+        except Exception as e:
+            if len(batch) == 1:
+                logger.exception("Queued write failed")
+                batch[0][1].set_exception(e)
+                return
+            # Retry one by one so a bad item fails alone, not its whole batch
+            for entry in batch:
+                self._write([entry])
+            return
+        self.batches += 1
+        self.items += len(batch)
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+
+    def stats(self):
+        return {"batches": self.batches, "items": self.items, "queued": self._queue.qsize()}
@@ -1,24 +1,33 @@
 #!/usr/bin/env python
 """
-Local mailserver-ish CLI utility.
+JyoMail SMTP server and local mail CLI.
 Usage:
-  python mailserver.py
-It will print messages in the DB and let you type `send` to create a test message.
-This is optional — primary web interface is the Django app.
+  python mailserver.py [serve] [--host 127.0.0.1] [--port 2525]
+      Accept mail over SMTP and deliver it, encrypted, to local users.
+  python mailserver.py cli
+      Interactive tool to list, view and create messages in the local DB.
 """
+import argparse
+import asyncio
 import os
 import sys
 import django
-import time
 
 # ensure this file is run from the project root (one level above manage.py)
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.insert(0, BASE_DIR)
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "postguard.settings")
+# Shares the database with the web server: WAL and a busy timeout
+os.environ.setdefault("JYOMAIL_DB_PROFILE", "production")
 django.setup()
 
-from mailapp.models import Email
+from django.db import transaction
+
+from mailapp.crypto import to_armored
+from mailapp.mail_utils import deliver_email, parse_recipients
+from mailapp.models import CustomUser, Email
+from mailapp.threads import new_message_id
 
 def show_inbox():
     print("\n=== All local emails (latest first) ===")
@@ -30,7 +39,17 @@ def create_test_email():
     to = input("To (comma separated): ").strip() or "bob@jyomail"
     subject = input("Subject: ").strip() or "Hello"
     body = input("Body: ").strip() or "Test body"
-    e = Email.objects.create(sender=sender, recipients=to, subject=subject, body=body)
+    # One transaction, and a Message-ID, as send_local_email does: a copy
+    # sent to oneself then joins the same thread as the sent copy
+    with transaction.atomic():
+        e = Email.objects.create(sender=sender, recipients=to, subject=subject, body=body,
+                                 message_id=new_message_id())
+        # Deliver to whichever sender/recipients are registered local users
+        deliver_email(
+            e,
+            CustomUser.objects.filter(email__iexact=sender).first(),
+            [u for u in (CustomUser.objects.filter(email__iexact=a).first() for a in parse_recipients(to)) if u],
+        )
     print("Created email id", e.id)
 
 def print_email_details():
@@ -47,10 +66,10 @@ def print_email_details():
     print("From:", m.sender)
     print("To:", m.recipients)
     print("Subject:", m.subject)
-    print("Body:\n", m.body)
+    print("Body:\n", to_armored(m.ciphertext) if m.is_encrypted else m.body)
     print("----")
 
-def main():
+def run_cli():
     print("Mailserver CLI (local DB). Type 'help' for commands.")
     try:
         while True:
@@ -72,5 +91,24 @@ def main():
     except Exception as e:
         print("Error:", e)
 
+def main():
+    parser = argparse.ArgumentParser(description="JyoMail SMTP server and local mail CLI.")
+    parser.add_argument("mode", nargs="?", choices=("serve", "cli"), default="serve")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=2525)
+    parser.add_argument("--hostname", default="jyomail.local", help="Name announced in the SMTP greeting.")
+    args = parser.parse_args()
+
+    if args.mode == "cli":
+        run_cli()
+        return
+
+    # mailapp logs go to the console handler configured in settings.LOGGING
+    from mailapp.smtp import serve
+    try:
+        asyncio.run(serve(args.host, args.port, args.hostname))
+    except KeyboardInterrupt:
+        print("\nStopping.")
+
 if __name__ == "__main__":
     main()
@@ -1,4 +1,6 @@
 import os
 from django.core.asgi import get_asgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "postguard.settings")
+os.environ.setdefault("JYOMAIL_ASYNC_VIEWS", "1")
+os.environ.setdefault("JYOMAIL_DB_PROFILE", "production")
 application = get_asgi_application()
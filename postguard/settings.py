@@ -3,6 +3,8 @@ import sys
 import types
 from pathlib import Path
 
+from django.core.exceptions import ImproperlyConfigured
+
 # Monkeypatch imghdr for PGPy compatibility with Python 3.13
 try:
     import imghdr
@@ -31,6 +33,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "mailapp.metrics.MetricsMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -52,6 +55,7 @@ TEMPLATES = [
                 "django.template.context_processors.request",
                 "django.contrib.auth.context_processors.auth",
                 "django.contrib.messages.context_processors.messages",
+                "mailapp.context_processors.folder_counts",
             ],
         },
     },
@@ -96,3 +100,118 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 LOGIN_URL = "login"
 LOGIN_REDIRECT_URL = "inbox"
 LOGOUT_REDIRECT_URL = "login"
+
+# Messages per page in inbox/sent listings and the JSON mailbox API
+MAILBOX_PAGE_SIZE = 50
+
+# Background PGP key generation: worker processes and spare keys kept ready for signups
+KEYGEN_WORKERS = 2
+KEYGEN_SPARE_KEYS = 10
+
+# Worker processes for batch PGP encryption/decryption (None: one per CPU)
+CRYPTO_WORKERS = None
+
+# Parsed PGP keys kept per process (keycache.py), public and private counted
+# separately
+PGP_KEY_CACHE_SIZE = 256
+
+# Serve async mailbox views (set by postguard/asgi.py) and cap the threads
+# they use for PGP work
+ASYNC_VIEWS = os.environ.get("JYOMAIL_ASYNC_VIEWS", "0") == "1"
+CRYPTO_THREADS = 4
+
+# Database profile (JYOMAIL_DB_PROFILE): "default" is stock SQLite;
+# "production" (the default under asgi.py and mailserver.py) is tuned for
+# concurrent readers and writers:
+# - WAL, so reads never wait for a write in progress
+# - synchronous=NORMAL: commits survive an app crash, a power cut may lose
+#   the last few
+# - IMMEDIATE write transactions that wait up to 20 s for the lock instead
+#   of failing with "database is locked"
+# - persistent connections under WSGI (Django closes them per request in
+#   async mode anyway)
+# - one writer at a time per process, group-committing concurrent sends (writer.py)
+DB_PROFILE = os.environ.get("JYOMAIL_DB_PROFILE", "default")
+if DB_PROFILE not in ("default", "production"):
+    raise ImproperlyConfigured(f"Unknown JYOMAIL_DB_PROFILE {DB_PROFILE!r}")
+SQLITE_PRODUCTION_OPTIONS = {
+    "init_command": "PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL",
+    "transaction_mode": "IMMEDIATE",
+    "timeout": 20,
+}
+if DB_PROFILE == "production":
+    DATABASES["default"]["OPTIONS"] = dict(SQLITE_PRODUCTION_OPTIONS)
+    DATABASES["default"]["CONN_MAX_AGE"] = 0 if ASYNC_VIEWS else 60
+    DATABASES["default"]["CONN_HEALTH_CHECKS"] = True
+# Writer queue: on/off and the most messages committed in one transaction
+DB_WRITE_QUEUE = DB_PROFILE == "production"
+DB_WRITE_BATCH_SIZE = 200
+
+# Maximum results returned by mailbox search
+SEARCH_RESULT_LIMIT = 50
+
+# SMTP listener (python mailserver.py): limits, delivery queue depth and
+# group commit (messages per transaction, seconds to wait filling a batch)
+SMTP_MAX_MESSAGE_SIZE = 10 * 1024 * 1024
+SMTP_IDLE_TIMEOUT = 300
+SMTP_MAX_SESSIONS = 1000
+SMTP_QUEUE_SIZE = 1000
+SMTP_BATCH_SIZE = 200
+SMTP_BATCH_WAIT = 0.05
+
+# Store new encrypted bodies as binary PGP packets (Email.body_blob) instead
+# of ASCII-armored text; both formats are always readable
+EMAIL_BINARY_BODIES = True
+
+# Opt-in cache of decrypted bodies for repeat detail views, encrypted under a
+# per-session key: seconds to keep an entry (0 disables) and maximum entries
+PREVIEW_CACHE_TTL = 0
+PREVIEW_CACHE_SIZE = 1000
+
+# PBKDF2 rounds for the login-derived secret that wraps recorded message
+# session keys (messagekeys.py)
+MESSAGE_KEY_KDF_ITERATIONS = 100_000
+
+# Threading: how long a reply without matching headers may still join the
+# latest thread with its subject, and the domain of generated Message-IDs
+THREAD_SUBJECT_DAYS = 30
+MESSAGE_ID_DOMAIN = "jyomail.local"
+
+# Encrypted attachment storage (attachments.py) and the largest file
+# accepted per attachment, in bytes
+ATTACHMENT_ROOT = BASE_DIR / "attachments"
+ATTACHMENT_MAX_SIZE = 100 * 1024 * 1024
+
+# Retention (archive.py, run by manage.py archive_mail). Mail older than
+# ARCHIVE_AFTER_DAYS moves to compressed segment files under ARCHIVE_ROOT;
+# mail older than DELETE_AFTER_DAYS is deleted. None turns either off (the
+# default). Users may override either in their archive_after_days /
+# delete_after_days.
+# Segments take new blocks until ARCHIVE_SEGMENT_SIZE bytes; a block of
+# about ARCHIVE_BLOCK_SIZE bytes is decompressed to read one message.
+ARCHIVE_ROOT = BASE_DIR / "archive"
+ARCHIVE_AFTER_DAYS = None
+DELETE_AFTER_DAYS = None
+ARCHIVE_SEGMENT_SIZE = 64 * 1024 * 1024
+ARCHIVE_BLOCK_SIZE = 64 * 1024
+
+# Seconds between keep-alive comments on idle live-update (SSE) streams, and
+# between checks for mail stored by other processes (the SMTP listener);
+# 0 turns the checks off
+SSE_KEEPALIVE = 25
+SSE_POLL_INTERVAL = 5
+
+# Request and crypto timings (metrics.py): samples kept per series for
+# p50/p99, and the addresses allowed to scrape /metrics
+METRICS_WINDOW = 1024
+METRICS_ALLOWED_IPS = ["127.0.0.1", "::1"]
+
+# One JSON line per request (and per crypto op at DEBUG) on mailapp.metrics
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "handlers": {"console": {"class": "logging.StreamHandler"}},
+    "loggers": {
+        "mailapp": {"handlers": ["console"], "level": os.environ.get("JYOMAIL_LOG_LEVEL", "INFO")},
+    },
+}
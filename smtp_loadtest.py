@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+"""
+SMTP load generator for the JyoMail SMTP server (python mailserver.py).
+
+Usage:
+  python smtp_loadtest.py --port 2525 --to bob@jyomail --connections 50 --duration 20
+
+Each connection sends messages back to back, pipelining MAIL/RCPT/DATA
+(RFC 2920). It reports sustained messages/sec and the accept latency, which
+is the time from the final "." to the server's 250 reply and so includes
+the batched, encrypted write to the database. Only the standard library is used.
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+
+async def expect(reader, code):
+    # Read one (possibly multi-line) reply and check its status code
+    while True:
+        line = await reader.readline()
+        if not line:
+            raise ConnectionError("connection closed")
+        if not line.startswith(code.encode()):
+            raise RuntimeError(f"expected {code}, got {line.decode().strip()}")
+        if line[3:4] != b"-":
+            return
+
+
+async def client(args, deadline, latencies, errors):
+    reader, writer = await asyncio.open_connection(args.host, args.port)
+    try:
+        await expect(reader, "220")
+        writer.write(b"EHLO loadtest\r\n")
+        await expect(reader, "250")
+        body = ("Load test message body.\r\n" * args.lines).encode()
+        n = 0
+        while time.perf_counter() < deadline:
+            n += 1
+            writer.write(
+                f"MAIL FROM:<{args.sender}>\r\nRCPT TO:<{args.to}>\r\nDATA\r\n".encode()
+            )
+            await expect(reader, "250")
+            await expect(reader, "250")
+            await expect(reader, "354")
+            writer.write(
+                f"From: {args.sender}\r\nTo: {args.to}\r\nSubject: load test {n}\r\n\r\n".encode()
+                + body + b".\r\n"
+            )
+            start = time.perf_counter()
+            try:
+                await expect(reader, "250")
+            except RuntimeError as e:
+                errors.append(str(e))
+                continue
+            latencies.append((time.perf_counter() - start) * 1000)
+        writer.write(b"QUIT\r\n")
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+async def main(args):
+    latencies, errors = [], []
+    started = time.perf_counter()
+    deadline = started + args.duration
+    results = await asyncio.gather(
+        *(client(args, deadline, latencies, errors) for _ in range(args.connections)),
+        return_exceptions=True,
+    )
+    elapsed = time.perf_counter() - started
+    errors += [repr(r) for r in results if isinstance(r, Exception)]
+
+    if not latencies:
+        raise SystemExit(f"No messages accepted ({len(errors)} errors: {errors[:5]})")
+    print(f"messages: {len(latencies)}  errors: {len(errors)}  elapsed: {elapsed:.1f}s")
+    print(f"throughput: {len(latencies) / elapsed:.1f} messages/s")
+    print(f"accept latency ms: p50={statistics.median(latencies):.1f}  p99={percentile(latencies, 99):.1f}  "
+          f"max={max(latencies):.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=2525)
+    parser.add_argument("--sender", default="loadtest@example.com")
+    parser.add_argument("--to", required=True, help="A local user's address.")
+    parser.add_argument("--connections", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds to run.")
+    parser.add_argument("--lines", type=int, default=20, help="Body lines per message.")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+"""
+Connection-scale test for the new-mail event stream (/events/, ASGI only).
+
+Usage:
+  uvicorn postguard.asgi:application --workers 1 --limit-concurrency 20000
+  python sse_loadtest.py --url http://127.0.0.1:8000 --email bob@jyomail --password secret \\
+      --connections 5000 --messages 5
+
+Opens N idle Server-Sent Events streams for one user, holds them through a
+keep-alive period, then sends messages to that user through the compose form
+and measures how long each event takes to reach every stream (fan-out
+latency). Watch the server's RSS while it runs to see the per-connection
+cost. Only the standard library is used; raise `ulimit -n` for large N.
+"""
+import argparse
+import asyncio
+import http.client
+import json
+import statistics
+import time
+import urllib.parse
+
+from loadtest import login, percentile
+
+
+async def open_stream(host, port, cookie, ready):
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(
+        f"GET /events/ HTTP/1.1\r\nHost: {host}\r\nAccept: text/event-stream\r\nCookie: {cookie}\r\n\r\n".encode()
+    )
+    status = await reader.readline()
+    if b" 200 " not in status:
+        raise RuntimeError(f"stream refused: {status.decode().strip()}")
+    ready.append(1)
+    return reader, writer
+
+
+async def watch(reader, arrivals):
+    # Record when each inbox delivery event (by subject) reaches this stream
+    while True:
+        line = await reader.readline()
+        if not line:
+            return
+        if line.startswith(b"data: ") and b"sse-loadtest-" in line:
+            event = json.loads(line[6:])
+            if event["folder"] == "inbox":
+                subject = event["subject"].removeprefix("sse-loadtest-")
+                arrivals.setdefault(subject, []).append(time.perf_counter())
+
+
+def send(base, cookie, to, subject):
+    url = urllib.parse.urlsplit(base)
+    csrf = cookie.split("csrftoken=")[1].split(";")[0]
+    conn = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=60)
+    form = urllib.parse.urlencode({"recipients": to, "subject": subject, "body": "ping",
+                                   "csrfmiddlewaretoken": csrf})
+    conn.request("POST", "/compose/", body=form, headers={
+        "Content-Type": "application/x-www-form-urlencoded", "Cookie": cookie, "Referer": base,
+    })
+    response = conn.getresponse()
+    response.read()
+    conn.close()
+    if response.status != 200:
+        raise RuntimeError(f"compose returned HTTP {response.status}")
+
+
+async def main(args):
+    url = urllib.parse.urlsplit(args.url)
+    cookie = login(args.url, args.email, args.password)
+
+    ready = []
+    started = time.perf_counter()
+    streams = []
+    for i in range(0, args.connections, 500):
+        # Open in batches so the listen backlog is not overrun
+        batch = [open_stream(url.hostname, url.port or 80, cookie, ready)
+                 for _ in range(min(500, args.connections - i))]
+        streams += await asyncio.gather(*batch, return_exceptions=True)
+    failed = [s for s in streams if isinstance(s, Exception)]
+    streams = [s for s in streams if not isinstance(s, Exception)]
+    print(f"open streams: {len(streams)}  failed: {len(failed)}  in {time.perf_counter() - started:.1f}s")
+    if not streams:
+        raise SystemExit(f"No streams opened: {failed[:3]}")
+
+    arrivals = {}
+    watchers = [asyncio.create_task(watch(reader, arrivals)) for reader, _ in streams]
+    await asyncio.sleep(args.idle)
+
+    latencies = []
+    for n in range(args.messages):
+        subject = f"{n}-{time.time_ns()}"
+        sent_at = time.perf_counter()
+        await asyncio.to_thread(send, args.url, cookie, args.email, f"sse-loadtest-{subject}")
+        deadline = time.perf_counter() + args.timeout
+        while len(arrivals.get(subject, [])) < len(streams) and time.perf_counter() < deadline:
+            await asyncio.sleep(0.01)
+        times = arrivals.get(subject, [])
+        latencies += [(t - sent_at) * 1000 for t in times]
+        print(f"message {n}: reached {len(times)}/{len(streams)} streams, "
+              f"last after {(max(times) - sent_at) * 1000 if times else float('nan'):.0f} ms")
+
+    for task in watchers:
+        task.cancel()
+    for _, writer in streams:
+        writer.close()
+    if latencies:
+        print(f"fan-out latency ms: p50={statistics.median(latencies):.1f}  "
+              f"p99={percentile(latencies, 99):.1f}  max={max(latencies):.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--email", required=True, help="Login (also the recipient of the test messages).")
+    parser.add_argument("--password", required=True)
+    parser.add_argument("--connections", type=int, default=1000)
+    parser.add_argument("--messages", type=int, default=3)
+    parser.add_argument("--idle", type=float, default=30.0, help="Seconds to hold streams idle first.")
+    parser.add_argument("--timeout", type=float, default=30.0, help="Seconds to wait for each fan-out.")
+    asyncio.run(main(parser.parse_args()))
@@ -1,4 +1,133 @@
 document.addEventListener('DOMContentLoaded', () => {
     // Mobile sidebar toggle logic can go here
     console.log('JyoMail frontend loaded.');
+
+    const list = document.querySelector('.mail-list');
+    if (list) {
+        setupInfiniteScroll(list);
+    }
+
+    const main = document.querySelector('.main-content');
+    if (main && main.dataset.eventsUrl) {
+        setupLiveUpdates(main.dataset.eventsUrl);
+    }
 });
+
+function buildMailRow(mail, label, field) {
+    const row = document.createElement('a');
+    row.href = mail.url;
+    row.style.cssText = 'display: flex; justify-content: space-between; align-items: center; padding: 1rem; ' +
+        'border-bottom: 1px solid var(--border-color); color: inherit; transition: background-color 0.2s;';
+
+    const headers = document.createElement('div');
+    headers.style.cssText = 'display: flex; flex-direction: column; gap: 0.25rem;';
+
+    const subject = document.createElement('div');
+    subject.style.cssText = 'font-weight: 600; color: var(--text-main);';
+    subject.textContent = mail.subject;
+
+    const party = document.createElement('div');
+    party.className = 'text-sm text-muted';
+    party.textContent = `${label}: ${mail[field]}`;
+
+    const time = document.createElement('div');
+    time.className = 'text-sm text-muted';
+    time.style.whiteSpace = 'nowrap';
+    time.textContent = mail.display_time;
+
+    headers.append(subject, party);
+    row.append(headers, time);
+    return row;
+}
+
+// Replace the "Older messages" link with pages fetched from the JSON
+// mailbox API as the user scrolls to the bottom of the list.
+function setupInfiniteScroll(list) {
+    const more = document.querySelector('.mail-list-more');
+    if (!more || !('IntersectionObserver' in window)) {
+        return;
+    }
+
+    let loading = false;
+    const observer = new IntersectionObserver(async (entries) => {
+        const cursor = list.dataset.nextCursor;
+        if (!entries[0].isIntersecting || loading || !cursor) {
+            return;
+        }
+        loading = true;
+        try {
+            const response = await fetch(`${list.dataset.apiUrl}?cursor=${encodeURIComponent(cursor)}`, {
+                headers: { 'Accept': 'application/json' },
+                credentials: 'same-origin',
+            });
+            if (!response.ok) {
+                throw new Error(`HTTP ${response.status}`);
+            }
+            const page = await response.json();
+            for (const mail of page.messages) {
+                list.appendChild(buildMailRow(mail, list.dataset.rowLabel, list.dataset.rowField));
+            }
+            list.dataset.nextCursor = page.next_cursor || '';
+            if (!page.next_cursor) {
+                observer.disconnect();
+                more.remove();
+            } else {
+                more.href = `?cursor=${page.next_cursor}`;
+                // Re-observe so a still-visible sentinel triggers the next page.
+                observer.unobserve(more);
+                observer.observe(more);
+            }
+        } catch (err) {
+            console.error('Failed to load more messages:', err);
+            observer.disconnect();
+        } finally {
+            loading = false;
+        }
+    });
+    observer.observe(more);
+}
+
+// Prepend newly delivered mail pushed over Server-Sent Events, instead of
+// the user reloading the mailbox to see it.
+function setupLiveUpdates(url) {
+    if (!('EventSource' in window)) {
+        return;
+    }
+    const seen = new Set();
+    const source = new EventSource(url);
+    source.addEventListener('delivery', (event) => {
+        const mail = JSON.parse(event.data);
+        // A reconnect can replay a delivery that was already pushed
+        if (seen.has(mail.delivery_id)) {
+            return;
+        }
+        seen.add(mail.delivery_id);
+
+        if (mail.folder === 'inbox' && !mail.is_read) {
+            bumpUnreadCount();
+        }
+        const list = document.querySelector(`.mail-list[data-folder="${mail.folder}"]`);
+        const onFirstPage = !new URLSearchParams(window.location.search).has('cursor');
+        if (list && onFirstPage) {
+            list.prepend(buildMailRow(mail, list.dataset.rowLabel, list.dataset.rowField));
+        } else if (document.querySelector(`.mail-empty[data-folder="${mail.folder}"]`)) {
+            // Empty folder: render the real list
+            window.location.reload();
+        }
+    });
+}
+
+function bumpUnreadCount() {
+    const inbox = document.querySelector('.nav-links a[data-folder="inbox"]');
+    if (!inbox) {
+        return;
+    }
+    let badge = inbox.querySelector('.nav-count');
+    if (!badge) {
+        badge = document.createElement('span');
+        badge.className = 'nav-count';
+        badge.textContent = '0';
+        inbox.appendChild(badge);
+    }
+    badge.textContent = String(Number(badge.textContent) + 1);
+}